@@ -0,0 +1,304 @@
+"""Optional ASGI entry point: uvicorn asgi:app
+
+Serves the same Flask app, but sends from webhook turns don't hold the turn.
+Each request runs the unchanged handlers in its own worker thread (at most
+ASGI_MAX_TURNS at once; the rest wait as coroutines), and every Graph send
+made while handling a webhook is handed to the event loop. There, one lane
+per recipient posts its queue in order through a shared async HTTP client,
+taking rate-limit tokens and writing the send ledger through the async Upstash
+client, while lanes for different recipients run concurrently; each attempt
+is judged by the same helpers graph_post uses. A turn that replies to the
+customer and notifies the owner therefore overlaps the two instead of paying
+for each round trip in turn. Text sends, whose callers only log failures,
+return as soon as they are queued. Interactive and media sends wait for their
+own response, so the text and re-upload fallbacks still run when Meta
+rejects them.
+
+Webhooks from the same sender are handled one at a time, in arrival order.
+Idle keep-alive connections and queued sends cost coroutines, not threads.
+
+Needs asgiref, httpx and an ASGI server such as uvicorn (listed in
+requirements.txt), none of which the Vercel deployment uses.
+"""
+import os
+import json
+import asyncio
+import logging
+
+import httpx
+import requests
+from asgiref.sync import ThreadSensitiveContext
+from asgiref.wsgi import WsgiToAsgi
+from requests.structures import CaseInsensitiveDict
+from upstash_redis.asyncio import Redis as AsyncRedis
+
+import main
+
+ASGI_MAX_TURNS = int(os.environ.get("ASGI_MAX_TURNS", "64"))
+ASGI_MAX_CONNECTIONS = int(os.environ.get("ASGI_MAX_CONNECTIONS", "100"))
+ASGI_DRAIN_TIMEOUT = float(os.environ.get("ASGI_DRAIN_TIMEOUT", "30"))
+DEFERRED_SEND_TYPES = {'text'}
+
+flask_app = WsgiToAsgi(main.app)
+
+
+def as_requests_response(response):
+    """Present an httpx response as the requests.Response the handlers expect"""
+    converted = requests.Response()
+    converted.status_code = response.status_code
+    converted.headers = CaseInsensitiveDict(response.headers)
+    converted._content = response.content
+    converted.url = str(response.url)
+    converted.encoding = response.encoding
+    return converted
+
+
+class SendLanes:
+    """Per-recipient send queues drained on the event loop"""
+
+    def __init__(self):
+        self.loop = None
+        self.http = None
+        self.redis = None
+        self.lanes = {}
+        self.idle = None
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.http = httpx.AsyncClient(
+            timeout=main.SEND_TIMEOUT,
+            limits=httpx.Limits(max_connections=ASGI_MAX_CONNECTIONS),
+        )
+        self.redis = AsyncRedis(
+            url=os.environ.get('UPSTASH_REDIS_URL'),
+            token=os.environ.get('UPSTASH_REDIS_TOKEN'),
+        )
+        self.idle = asyncio.Event()
+        self.idle.set()
+
+    async def stop(self):
+        """Let queued sends finish, up to ASGI_DRAIN_TIMEOUT, then close the clients"""
+        try:
+            await asyncio.wait_for(self.idle.wait(), ASGI_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logging.error(f"Shutting down with sends still queued for {len(self.lanes)} recipients")
+        await self.http.aclose()
+        await self.redis.close()
+
+    def dispatch(self, payload, phone_id, ledger_attempt=0, retry_of=None):
+        """graph_post's replacement inside webhook turns; called from worker threads"""
+        deferred = payload.get('type') in DEFERRED_SEND_TYPES
+        # Only sends the turn waits for are held to its deadline
+        deadline = None if deferred else main.send_deadline.get()
+        future = asyncio.run_coroutine_threadsafe(
+            self.submit(payload, phone_id, ledger_attempt, retry_of, deadline), self.loop
+        )
+        if deferred:
+            return main.queued_send_response()
+        return future.result()
+
+    async def submit(self, payload, phone_id, ledger_attempt, retry_of, deadline):
+        # Queued before the first await, so sends keep the order they were dispatched in
+        recipient = payload.get('to') or ''
+        done = self.loop.create_future()
+        queue = self.lanes.get(recipient)
+        if queue is None:
+            queue = self.lanes[recipient] = asyncio.Queue()
+            self.idle.clear()
+            asyncio.create_task(self.run_lane(recipient, queue))
+        queue.put_nowait((payload, phone_id, ledger_attempt, retry_of, deadline, done))
+        return await done
+
+    async def run_lane(self, recipient, queue):
+        while not queue.empty():
+            payload, phone_id, ledger_attempt, retry_of, deadline, done = queue.get_nowait()
+            try:
+                done.set_result(await self.post(payload, phone_id, ledger_attempt, retry_of, deadline))
+            except Exception as e:
+                if payload.get('type') in DEFERRED_SEND_TYPES:
+                    logging.error(f"Queued send to {recipient} failed: {e}")
+                done.set_exception(e)
+                # Nobody awaits deferred sends; don't warn about their exceptions
+                done.exception()
+        del self.lanes[recipient]
+        if not self.lanes:
+            self.idle.set()
+
+    async def acquire_slot(self, recipient, max_wait):
+        keys, args = main.send_slot_args(recipient)
+        waited = 0.0
+        while True:
+            try:
+                wait = float(await self.redis.eval(main.TOKEN_BUCKET_SCRIPT, keys, [main.time.time()] + args))
+            except Exception as e:
+                logging.error(f"Rate limiter unavailable, sending without a token: {e}")
+                return True
+            if wait < 0:
+                return main.SEND_QUEUED_BEHIND
+            if wait == 0:
+                return True
+            if waited + wait > max_wait:
+                return False
+            await asyncio.sleep(wait)
+            waited += wait
+
+    async def record(self, response, payload, attempt, retry_of):
+        try:
+            wamid, entry = main.ledger_entry(response, payload, attempt, retry_of)
+            if not wamid:
+                return
+            pipeline = self.redis.pipeline()
+            pipeline.hset(f"send_ledger:{wamid}", values=entry)
+            pipeline.expire(f"send_ledger:{wamid}", main.SEND_LEDGER_TTL)
+            await pipeline.exec()
+        except Exception as e:
+            logging.error(f"Failed to record send in ledger: {e}")
+
+    async def post(self, payload, phone_id, ledger_attempt=0, retry_of=None, deadline=None):
+        """graph_post, on the event loop"""
+        url = main.graph_messages_url(phone_id)
+        recipient = payload.get('to')
+        response = None
+        error = None
+
+        for attempt in range(main.SEND_MAX_RETRIES + 1):
+            slot = await self.acquire_slot(recipient, main.send_wait_limit(deadline))
+            gate = main.send_gate(slot, recipient)
+            if gate == 'queue':
+                return await asyncio.to_thread(main.queue_send, payload, phone_id, ledger_attempt, retry_of)
+            if gate == 'skip':
+                response = None
+                error = None
+                delay = main.send_retry_delay(attempt, None, deadline)
+                if delay is None:
+                    return await asyncio.to_thread(main.queue_send, payload, phone_id, ledger_attempt, retry_of)
+                if attempt < main.SEND_MAX_RETRIES:
+                    await asyncio.sleep(delay)
+                continue
+
+            started = main.time.time()
+            try:
+                response = as_requests_response(
+                    await self.http.post(url, headers=main.graph_headers(), content=json.dumps(payload))
+                )
+                error = None
+            except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout) as e:
+                # Never sent, so safe to retry
+                response = None
+                error = requests.exceptions.ConnectTimeout(str(e))
+            except httpx.HTTPError as e:
+                response = None
+                error = requests.exceptions.ConnectionError(str(e))
+            outcome = main.send_attempt_outcome(recipient, attempt, response, error, main.time.time() - started)
+            if outcome == 'accepted':
+                await self.record(response, payload, ledger_attempt, retry_of)
+                return response
+            if outcome in ('rejected', 'ambiguous'):
+                return await asyncio.to_thread(main.send_failed, payload, outcome, response, error)
+
+            if attempt < main.SEND_MAX_RETRIES:
+                delay = main.send_retry_delay(attempt, response, deadline)
+                if delay is None:
+                    return await asyncio.to_thread(main.queue_send, payload, phone_id, ledger_attempt, retry_of)
+                await asyncio.sleep(delay)
+
+        return await asyncio.to_thread(main.send_exhausted, payload, response, error)
+
+
+send_lanes = SendLanes()
+turn_slots = None
+sender_locks = {}
+
+
+def webhook_senders(body):
+    """Normalised senders of the messages in a webhook body"""
+    try:
+        data = json.loads(body or b'{}')
+    except ValueError:
+        return []
+    senders = set()
+    for entry in data.get('entry', []):
+        for change in entry.get('changes', []):
+            for message in (change.get('value') or {}).get('messages', []):
+                if message.get('from'):
+                    senders.add(main.normalize_phone_number(message['from']))
+    return sorted(senders)
+
+def hold_sender_lock(sender):
+    """The lock serialising a sender's webhooks, counted so it can be dropped when unused"""
+    lock, users = sender_locks.get(sender, (None, 0))
+    lock = lock or asyncio.Lock()
+    sender_locks[sender] = (lock, users + 1)
+    return lock
+
+def drop_sender_lock(sender):
+    lock, users = sender_locks[sender]
+    if users <= 1:
+        del sender_locks[sender]
+    else:
+        sender_locks[sender] = (lock, users - 1)
+
+async def read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+async def run_flask(scope, receive, send):
+    """Run the Flask app for one request in a thread of its own"""
+    async with turn_slots:
+        async with ThreadSensitiveContext():
+            await flask_app(scope, receive, send)
+
+async def handle_webhook(scope, receive, send):
+    body = await read_body(receive)
+    delivered = False
+
+    async def replay_body():
+        nonlocal delivered
+        if delivered:
+            return {'type': 'http.disconnect'}
+        delivered = True
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+
+    held = []
+    acquired = []
+    try:
+        for sender in webhook_senders(body):
+            lock = hold_sender_lock(sender)
+            held.append(sender)
+            await lock.acquire()
+            acquired.append(lock)
+        token = main.send_dispatcher.set(send_lanes.dispatch)
+        try:
+            await run_flask(scope, replay_body, send)
+        finally:
+            main.send_dispatcher.reset(token)
+    finally:
+        for lock in acquired:
+            lock.release()
+        for sender in held:
+            drop_sender_lock(sender)
+
+async def lifespan(receive, send):
+    global turn_slots
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            turn_slots = asyncio.Semaphore(ASGI_MAX_TURNS)
+            await send_lanes.start()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send_lanes.stop()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+    elif scope['type'] == 'http' and scope['path'] == '/webhook' and scope['method'] == 'POST':
+        await handle_webhook(scope, receive, send)
+    elif scope['type'] == 'http':
+        await run_flask(scope, receive, send)
@@ -0,0 +1,124 @@
+"""Throughput of the production server at several concurrency levels.
+
+    python bench.py --concurrency 1,8,32,64 --requests 400 [--workers 2 --threads 16]
+
+Starts serve.py against the in-memory Redis and mock Graph API from
+traces.py, each adding a fixed delay per call (BENCH_REDIS_RTT and
+BENCH_GRAPH_RTT, in milliseconds) to stand in for the network. The workload
+is therefore I/O bound like production, and nothing is sent anywhere. Every
+request is a new customer's first message. The table shows, for each level,
+requests per second and latency percentiles.
+"""
+import os
+import sys
+import time
+import json
+import socket
+import argparse
+import itertools
+import subprocess
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+_senders = itertools.count(1)
+
+
+def create_app():
+    """gunicorn app factory for the benchmark server"""
+    import traces
+    main, _ = traces.load_offline_app(
+        redis_latency=float(os.environ.get('BENCH_REDIS_RTT', '5')) / 1000,
+        graph_latency=float(os.environ.get('BENCH_GRAPH_RTT', '60')) / 1000,
+    )
+    return main.app
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def wait_for_server(url, process, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            sys.exit("Benchmark server exited during startup")
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.exceptions.ConnectionError:
+            time.sleep(0.2)
+    sys.exit("Benchmark server did not start")
+
+def webhook_body():
+    sender = f"+26371{next(_senders):07d}"
+    message = {'from': sender, 'id': f"bench.{sender}", 'type': 'text', 'text': {'body': 'hi'}}
+    return {
+        'object': 'whatsapp_business_account',
+        'entry': [{'changes': [{'field': 'messages', 'value': {'messages': [message]}}]}],
+    }
+
+def run_level(url, concurrency, total):
+    session = requests.Session()
+    session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=concurrency))
+
+    def one(_):
+        started = time.perf_counter()
+        try:
+            ok = session.post(url, json=webhook_body(), timeout=60).status_code == 200
+        except requests.exceptions.RequestException:
+            ok = False
+        return ok, time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(one, range(total)))
+    elapsed = time.perf_counter() - started
+    latencies = sorted(latency for _, latency in results)
+    return {
+        'concurrency': concurrency,
+        'requests_per_second': round(total / elapsed, 1),
+        'p50_ms': round(statistics.median(latencies) * 1000, 1),
+        'p95_ms': round(latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)] * 1000, 1),
+        'errors': sum(1 for ok, _ in results if not ok),
+    }
+
+
+def bench(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--concurrency', default='1,8,32,64')
+    parser.add_argument('--requests', type=int, default=400, help='Requests per concurrency level')
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--threads', type=int)
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args(argv)
+
+    port = free_port()
+    command = [sys.executable, os.path.join(HERE, 'serve.py'), '--app', 'bench:create_app()',
+               '--bind', f"127.0.0.1:{port}", '--access-logfile', '/dev/null']
+    if args.workers:
+        command += ['--workers', str(args.workers)]
+    if args.threads:
+        command += ['--threads', str(args.threads)]
+    server = subprocess.Popen(command, cwd=HERE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        base = f"http://127.0.0.1:{port}"
+        wait_for_server(base + '/webhook', server)
+        results = [run_level(base + '/webhook', int(level), args.requests) for level in args.concurrency.split(',')]
+    finally:
+        server.terminate()
+        server.wait(timeout=60)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'concurrency':>11} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'errors':>7}")
+    for row in results:
+        print(f"{row['concurrency']:>11} {row['requests_per_second']:>8} {row['p50_ms']:>8} {row['p95_ms']:>8} {row['errors']:>7}")
+
+
+if __name__ == '__main__':
+    bench()
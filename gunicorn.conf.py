@@ -0,0 +1,96 @@
+"""gunicorn settings for serve.py. Environment variables override the defaults."""
+import os
+import sys
+import time
+import signal
+import threading
+import multiprocessing
+
+bind = os.environ.get('BIND', f"0.0.0.0:{os.environ.get('PORT', '8000')}")
+
+# The bot is I/O bound: a turn is around ten Upstash round trips and one or
+# two Graph API calls (traces.py replay reports the exact counts), so a request
+# spends nearly all its time waiting on the network. Waiting threads are
+# cheap, so each worker runs many; extra processes are only there to use more
+# cores and to contain a crash.
+worker_class = 'gthread'
+workers = int(os.environ.get('WEB_CONCURRENCY', max(2, multiprocessing.cpu_count())))
+threads = int(os.environ.get('WEB_THREADS', '16'))
+
+# Import the app once in the master so workers share its pages copy-on-write;
+# post_fork gives each worker its own connections
+preload_app = True
+
+# A worker that stops checking in for this long is restarted. Requests are
+# bounded well inside it by the app's own SEND_TIMEOUT on outbound calls.
+timeout = int(os.environ.get('WORKER_TIMEOUT', '60'))
+# Time a stopping worker has to finish its requests and drain background sends
+graceful_timeout = int(os.environ.get('GRACEFUL_TIMEOUT', '30'))
+keepalive = int(os.environ.get('KEEPALIVE', '5'))
+# Recycle workers now and then, staggered so they don't all restart together
+max_requests = int(os.environ.get('MAX_REQUESTS', '5000'))
+max_requests_jitter = max_requests // 10
+
+accesslog = os.environ.get('ACCESS_LOG', '-')
+errorlog = '-'
+
+
+def post_fork(server, worker):
+    import main
+    main.reset_connections()
+
+
+# Shutdown drain
+# The master SIGKILLs a stopping worker graceful_timeout seconds after
+# signalling it, however long its requests take to finish. So the drain starts
+# the moment the signal arrives, alongside the requests still running, and
+# works to a deadline fixed then rather than one counted from worker_exit.
+DRAIN_MARGIN = 2  # seconds left for the process itself to exit
+_shutdown = {'deadline': None, 'drain': None}
+
+
+def drain_time_left():
+    return max(0.0, _shutdown['deadline'] - time.time())
+
+
+def start_drain(worker):
+    """Start draining background work against the master's kill deadline, once"""
+    import main
+    if _shutdown['deadline'] is not None:
+        return
+    _shutdown['deadline'] = time.time() + max(0, worker.cfg.graceful_timeout - DRAIN_MARGIN)
+    _shutdown['drain'] = threading.Thread(
+        target=main.drain_background_work, args=(drain_time_left(),), daemon=True
+    )
+    _shutdown['drain'].start()
+
+
+def post_worker_init(worker):
+    # SIGTERM (graceful stop) has no hook of its own; run start_drain ahead of
+    # the worker's handler, which only stops it accepting new requests
+    handle_exit = worker.handle_exit
+
+    def stopping(sig, frame):
+        start_drain(worker)
+        handle_exit(sig, frame)
+
+    signal.signal(signal.SIGTERM, stopping)
+    signal.siginterrupt(signal.SIGTERM, False)
+
+
+def worker_int(worker):
+    # SIGINT/SIGQUIT: the worker exits as soon as this returns
+    start_drain(worker)
+    _shutdown['drain'].join(drain_time_left())
+
+
+def worker_exit(server, worker):
+    import main
+    # A worker recycled by max_requests is never signalled
+    start_drain(worker)
+    _shutdown['drain'].join(drain_time_left())
+    if drain_time_left():
+        # Work left behind by requests that finished after the first pass began
+        main.drain_background_work(drain_time_left())
+    sys.stdout.flush()
+    sys.stderr.flush()
@@ -3,14 +3,31 @@ import logging
 import requests
 import random
 import string
-from datetime import datetime
-from flask import Flask, request, jsonify, render_template
+import re
+import time
+import hmac
+import threading
+import contextvars
+from functools import wraps
+from contextlib import contextmanager
+from datetime import datetime, date, timedelta, timezone
+from flask import Flask, request, jsonify, render_template, send_file, Response, stream_with_context
 import json
+import csv
+import hashlib
 import traceback
 from enum import Enum
+from collections import OrderedDict
 from upstash_redis import Redis
+from upstash_redis.errors import UpstashError
+from urllib3.exceptions import NewConnectionError
+try:
+    import sqlalchemy
+    from sqlalchemy.dialects import mysql, postgresql, sqlite
+except ImportError:  # durable storage is disabled without SQLAlchemy
+    sqlalchemy = None
 import base64
-from io import BytesIO
+from io import BytesIO, StringIO
 
 app = Flask(__name__)
 
@@ -23,11 +40,245 @@ AGENT_NUMBERS = ["+263773218242"]
 HARARE = ["+263788264258", "+263788264257"]
 BULAWAYO = ["+263773218242", "+263718339551"]
 
-# Redis client setup
-redis_client = Redis(
-    url=os.environ.get('UPSTASH_REDIS_URL'),
-    token=os.environ.get('UPSTASH_REDIS_TOKEN')
+# Metrics
+# Per-process counters, plus gauges read when /metrics is scraped, rendered in
+# the Prometheus text format. Each worker reports its own numbers; a scraper
+# sums them. Upstream latency is kept as an exponentially weighted average per
+# dependency, which admission control reads on every webhook.
+METRICS_PREFIX = "cakefairy"
+LATENCY_SMOOTHING = 0.2
+LATENCY_STALE_AFTER = 30  # seconds without a sample before an average stops counting
+
+_metrics_lock = threading.Lock()
+_metric_counters = {}
+_metric_gauges = {}
+_upstream_latency = {}  # dependency -> (average seconds, last sample time)
+
+def metric_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in sorted(labels.items())) + '}'
+
+def count_metric(name, amount=1, **labels):
+    key = (name, metric_labels(labels))
+    with _metrics_lock:
+        _metric_counters[key] = _metric_counters.get(key, 0) + amount
+
+def register_gauge(name, read):
+    """read() returns a number, or a list of (labels dict, number)"""
+    _metric_gauges[name] = read
+
+def observe_latency(dependency, seconds):
+    with _metrics_lock:
+        average, _ = _upstream_latency.get(dependency, (seconds, 0))
+        _upstream_latency[dependency] = (average + LATENCY_SMOOTHING * (seconds - average), time.time())
+
+def upstream_latency(dependency=None):
+    """Recent average latency of one dependency, or the slowest of them"""
+    now = time.time()
+    with _metrics_lock:
+        recent = {
+            name: average for name, (average, at) in _upstream_latency.items()
+            if now - at < LATENCY_STALE_AFTER
+        }
+    if dependency:
+        return recent.get(dependency, 0.0)
+    return max(recent.values(), default=0.0)
+
+@contextmanager
+def timed_call(dependency):
+    started = time.time()
+    try:
+        yield
+    finally:
+        observe_latency(dependency, time.time() - started)
+
+def render_metrics():
+    lines = []
+    with _metrics_lock:
+        counters = sorted(_metric_counters.items())
+        latency = sorted(_upstream_latency.items())
+    for (name, labels), value in counters:
+        lines.append(f"{METRICS_PREFIX}_{name}{labels} {value}")
+    for dependency, (average, _) in latency:
+        lines.append(f'{METRICS_PREFIX}_upstream_latency_seconds{{dependency="{dependency}"}} {average:.4f}')
+    for name, read in sorted(_metric_gauges.items()):
+        try:
+            value = read()
+        except Exception as e:
+            logging.error(f"Failed to read gauge {name}: {e}")
+            continue
+        for labels, sample in (value if isinstance(value, list) else [({}, value)]):
+            lines.append(f"{METRICS_PREFIX}_{name}{metric_labels(labels)} {sample}")
+    return '\n'.join(lines) + '\n'
+
+# Circuit breakers
+# One breaker per dependency, shared by the threads of a process. Failures and
+# calls slower than slow_call count against it; after failure_threshold in a
+# row it opens and callers take their fallback at once instead of each waiting
+# on a dependency that is down. After reset_timeout a single probe call is let
+# through (half-open): success closes the breaker, failure opens it again.
+BREAKER_STATES = {'closed': 0, 'half_open': 1, 'open': 2}
+
+class CircuitOpenError(Exception):
+    pass
+
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold, reset_timeout, slow_call=None, on_close=None, is_failure=None):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.slow_call = slow_call
+        self.on_close = on_close
+        # Which exceptions mean the dependency is unhealthy, rather than a bad request
+        self.is_failure = is_failure or (lambda error: True)
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """Whether a call may go ahead; in half-open, only one caller gets through"""
+        with self.lock:
+            if self.state == 'open' and time.time() - self.opened_at >= self.reset_timeout:
+                self.state = 'half_open'
+                self.probing = False
+            if self.state == 'closed':
+                return True
+            if self.state == 'half_open' and not self.probing:
+                self.probing = True
+                return True
+        count_metric('circuit_rejected_total', dependency=self.name)
+        return False
+
+    def record(self, ok, seconds=0.0):
+        """Report the outcome of a call that allow() let through"""
+        if ok and self.slow_call and seconds > self.slow_call:
+            ok = False
+        recovered = False
+        with self.lock:
+            self.probing = False
+            if ok:
+                recovered = self.state != 'closed'
+                self.state = 'closed'
+                self.failures = 0
+            else:
+                self.failures += 1
+                if self.state == 'half_open' or self.failures >= self.failure_threshold:
+                    if self.state != 'open':
+                        logging.warning(f"Circuit for {self.name} opened after {self.failures} failures")
+                        count_metric('circuit_opened_total', dependency=self.name)
+                    self.state = 'open'
+                    self.opened_at = time.time()
+        if recovered:
+            logging.info(f"Circuit for {self.name} closed")
+            if self.on_close:
+                run_in_background(self.on_close)
+
+    @contextmanager
+    def call(self):
+        """Run the block through the breaker; raises CircuitOpenError while open"""
+        if not self.allow():
+            raise CircuitOpenError(f"{self.name} circuit is open")
+        started = time.time()
+        try:
+            yield
+        except Exception as e:
+            self.record(not self.is_failure(e), time.time() - started)
+            raise
+        self.record(True, time.time() - started)
+
+circuit_breakers = {}
+
+def circuit_breaker(name, **settings):
+    prefix = f"BREAKER_{name.upper()}_"
+    breaker = CircuitBreaker(
+        name,
+        failure_threshold=int(os.environ.get(prefix + "FAILURES", settings.pop('failure_threshold'))),
+        reset_timeout=float(os.environ.get(prefix + "RESET", settings.pop('reset_timeout'))),
+        slow_call=float(os.environ.get(prefix + "SLOW_CALL", settings.pop('slow_call'))),
+        **settings,
+    )
+    circuit_breakers[name] = breaker
+    return breaker
+
+register_gauge('circuit_state', lambda: [
+    ({'dependency': name}, BREAKER_STATES[breaker.state]) for name, breaker in sorted(circuit_breakers.items())
+])
+
+# Upstash: every command goes through it (see GuardedRedis); state reads and
+# writes fall back to the copy this worker last saw. Command errors such as a
+# failing script are answers from a healthy server and don't count.
+redis_breaker = circuit_breaker(
+    'redis', failure_threshold=5, reset_timeout=10, slow_call=1.5,
+    on_close=lambda: save_unsaved_states(),
+    is_failure=lambda error: not isinstance(error, UpstashError),
 )
+# Graph: sends are queued in Redis and posted once it recovers
+graph_breaker = circuit_breaker('graph', failure_threshold=5, reset_timeout=30, slow_call=8)
+
+# Redis client setup
+# The REST client waits indefinitely for a response and retries after three
+# seconds by default. Both are bounded so a slow Upstash fails fast, and every
+# command and pipeline goes through the Redis circuit breaker, so while it is
+# open each call fails at once instead of holding a worker thread for
+# REDIS_TIMEOUT.
+REDIS_TIMEOUT = float(os.environ.get("REDIS_TIMEOUT", "3"))
+REDIS_RETRIES = int(os.environ.get("REDIS_RETRIES", "0"))
+
+class GuardedPipeline:
+    """A pipeline whose exec goes through the breaker; commands are only queued"""
+
+    def __init__(self, pipeline, breaker):
+        self._pipeline = pipeline
+        self._breaker = breaker
+
+    def exec(self):
+        with self._breaker.call():
+            return self._pipeline.exec()
+
+    def __getattr__(self, name):
+        return getattr(self._pipeline, name)
+
+class GuardedRedis:
+    """The Upstash client with every command run through a circuit breaker"""
+
+    def __init__(self, client, breaker):
+        self._client = client
+        self._breaker = breaker
+
+    def pipeline(self):
+        return GuardedPipeline(self._client.pipeline(), self._breaker)
+
+    def multi(self):
+        return GuardedPipeline(self._client.multi(), self._breaker)
+
+    def __getattr__(self, name):
+        command = getattr(self._client, name)
+        if not callable(command):
+            return command
+
+        def call(*args, **kwargs):
+            with self._breaker.call():
+                return command(*args, **kwargs)
+        return call
+
+def make_redis_client():
+    client = Redis(
+        url=os.environ.get('UPSTASH_REDIS_URL'),
+        token=os.environ.get('UPSTASH_REDIS_TOKEN'),
+        rest_retries=REDIS_RETRIES,
+    )
+    # upstash_redis has no timeout option; set it on its httpx client (the
+    # version is pinned in requirements.txt because this relies on its layout)
+    try:
+        client._http._client.timeout = REDIS_TIMEOUT
+    except AttributeError:
+        logging.warning("Could not set a timeout on the Upstash client; Redis calls can hang until the breaker opens")
+    return GuardedRedis(client, redis_breaker)
+
+redis_client = make_redis_client()
 
 # Test connection
 try:
@@ -58,50 +309,218 @@ class CakeTypeOptions(Enum):
     PLASTIC_ICING = "Plastic Icing Cakes"
     BACK = "Back to main menu"
 
-class FreshCreamOptions(Enum):
-    CAKE_FAIRY = "Cake Fairy Cake - $20"
-    DOUBLE_DELITE = "Double Delite (2 flavours) - $25"
-    TRIPLE_DELITE = "Triple Delite (3 flavours) - $30"
-    THEMED_CAKES = "Themed Cakes"
-    BACK = "Back to cake types"
+# Price catalog
+# The single source of prices. Menu labels ("4 inch + 6 inch - $60"), the
+# pricing messages and order totals are all derived from this spec once, when
+# the catalog is compiled. An item's aliases are labels it used to have, so
+# drafts and list replies from before a relabel still resolve.
+CATALOG_SPEC = {
+    'currency': '$',
+    'extra_flavor_price': 5,
+    'color_surcharge': {'price': 5, 'colors': ['black', 'gold']},
+    'addons': {'fondant': 20, 'ganache': 10, 'smbc': 15},
+    'menus': {
+        'fresh_cream': {
+            'enum': 'FreshCreamOptions',
+            'heading': None,
+            'color_surcharge': True,
+            'items': [
+                {'key': 'CAKE_FAIRY', 'name': 'Cake Fairy Cake', 'price': 20, 'flavors': 1},
+                {'key': 'DOUBLE_DELITE', 'name': 'Double Delite (2 flavours)', 'price': 25, 'flavors': 2},
+                {'key': 'TRIPLE_DELITE', 'name': 'Triple Delite (3 flavours)', 'price': 30, 'flavors': 3},
+                {'key': 'THEMED_CAKES', 'name': 'Themed Cakes', 'price': None, 'flavors': 1},
+                {'name': 'Small 6 inches', 'price': 30, 'menu': False},
+                {'name': 'Medium 8 inches', 'price': 40, 'menu': False},
+                {'name': 'Large 10 inches', 'price': 60, 'menu': False},
+                {'name': 'Extra Large 12 inches', 'price': 80, 'menu': False},
+                {'name': 'Extra Tall Cake', 'price': 65, 'menu': False},
+            ],
+            'back': 'Back to cake types',
+        },
+        'two_tier': {
+            'enum': 'TwoTierOptions',
+            'heading': '2-Tier Cakes',
+            'color_surcharge': True,
+            'items': [
+                {'key': 'SIZE_4_6', 'name': '4 inch + 6 inch', 'price': 60},
+                {'key': 'SIZE_5_7', 'name': '5 inch + 7 inch', 'price': 80},
+                {'key': 'SIZE_6_8', 'name': '6 inch + 8 inch', 'price': 110},
+                {'key': 'SIZE_7_9', 'name': '7 inch + 9 inch', 'price': 140},
+                {'key': 'SIZE_8_10', 'name': '8 inch + 10 inch', 'price': 170},
+                {'key': 'FONDANT', 'name': 'Fondant Additional', 'addon': 'fondant'},
+                {'key': 'GANACHE', 'name': 'Ganache Additional', 'addon': 'ganache'},
+                {'key': 'SMBC', 'name': 'SMBC Additional', 'addon': 'smbc'},
+            ],
+            'back': 'Back to tier options',
+        },
+        'three_tier': {
+            'enum': 'ThreeTierOptions',
+            'heading': '3-Tier Cakes',
+            'color_surcharge': True,
+            'items': [
+                {'key': 'SIZE_4_6_8', 'name': '4 inch + 6 inch + 8 inch', 'price': 140},
+                {'key': 'SIZE_5_7_9', 'name': '5 inch + 7 inch + 9 inch', 'price': 170},
+                {'key': 'SIZE_6_8_10', 'name': '6 inch + 8 inch + 10 inch', 'price': 210},
+                {'key': 'FONDANT', 'name': 'Fondant Additional', 'addon': 'fondant'},
+                {'key': 'GANACHE', 'name': 'Ganache Additional', 'addon': 'ganache'},
+                {'key': 'SMBC', 'name': 'SMBC Additional', 'addon': 'smbc'},
+            ],
+            'back': 'Back to tier options',
+        },
+        'fruit': {
+            'enum': 'FruitCakeOptions',
+            'heading': None,
+            'color_surcharge': False,
+            'items': [
+                {'key': 'SIZE_6', 'name': '6 inch', 'price': 60},
+                {'key': 'SIZE_8', 'name': '8 inch', 'price': 80},
+            ],
+            'back': 'Back to cake types',
+        },
+        'plastic_icing': {
+            'enum': 'PlasticIcingOptions',
+            'heading': None,
+            'color_surcharge': True,
+            'items': [
+                {'key': 'SMALL', 'name': 'Small 6 inches', 'price': 40, 'aliases': ['Small 6 inches- $40']},
+                {'key': 'MEDIUM', 'name': 'Medium 8 inches', 'price': 50, 'aliases': ['Medium 8 inches- $50']},
+                {'key': 'LARGE', 'name': 'Large 10 inches', 'price': 70},
+                {'key': 'XL', 'name': 'Extra Large 12 inches', 'price': 100, 'aliases': ['Extra Large 12 inches- $100']},
+            ],
+            'back': 'Back to cake types',
+        },
+    },
+    # Pricing message per cake type: title and the menus listed in it
+    'pricing': {
+        'Fresh Cream Cakes': {'title': 'Fresh Cream Cakes Pricing', 'menus': ['fresh_cream', 'two_tier', 'three_tier']},
+        'Fruit Cakes': {'title': 'Fruit Cakes Pricing', 'menus': ['fruit']},
+        'Plastic Icing Cakes': {'title': 'Plastic Icing Cakes Pricing', 'menus': ['plastic_icing']},
+    },
+}
+
+def count_flavors(text):
+    """How many flavours a free-text answer names ("vanilla and chocolate" is two)"""
+    parts = re.split(r",|&|/|\+|\band\b|\n", text or '', flags=re.IGNORECASE)
+    return len({part.strip().lower() for part in parts if part.strip()})
+
+class PriceCatalog:
+    """Compiled form of a catalog spec: menu Enums, label index, pricing messages and quotes"""
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.currency = spec['currency']
+        self.addons = spec['addons']
+        self.extra_flavor_price = spec['extra_flavor_price']
+        self.surcharge_price = spec['color_surcharge']['price']
+        self.surcharge_colors = tuple(spec['color_surcharge']['colors'])
+        self.enums = {}
+        # Names repeat across menus (fresh cream and plastic icing both sell a
+        # "Small 6 inches"), so items are compiled and indexed per menu
+        self.menu_items = {}  # menu -> [item (with its menu)]
+        self.items = {}  # menu -> {lower-cased label, name or alias: item}
+        self.option_aliases = {}  # menu -> [(alias, option key)]
+        prices = []
+
+        for menu_key, menu in spec['menus'].items():
+            members = []
+            self.menu_items[menu_key] = []
+            self.items[menu_key] = index = {}
+            self.option_aliases[menu_key] = []
+            for item in menu['items']:
+                item = dict(item, menu=menu_key, color_surcharge=menu['color_surcharge'],
+                            listed_only=item.get('menu') is False)
+                if item.get('addon'):
+                    item['price'] = self.addons[item['addon']]
+                item['label'] = self.label(item)
+                if item.get('price') is not None and not item.get('addon'):
+                    prices.append(item['price'])
+                self.menu_items[menu_key].append(item)
+                index.setdefault(item['label'].lower(), item)
+                index.setdefault(item['name'].lower(), item)
+                for alias in item.get('aliases', ()):
+                    index.setdefault(alias.lower(), item)
+                    if not item['listed_only']:
+                        self.option_aliases[menu_key].append((alias, item['key']))
+                if not item['listed_only']:
+                    members.append((item['key'], item['label']))
+            members.append(('BACK', menu['back']))
+            self.enums[menu_key] = Enum(menu['enum'], members)
+
+        self.min_price = min(prices)
+        self.max_price = max(prices)
+        self.pricing_messages = {
+            cake_type: self.render_pricing(pricing) for cake_type, pricing in spec['pricing'].items()
+        }
+
+    def money(self, amount):
+        return f"{self.currency}{amount}"
+
+    def label(self, item):
+        if item.get('price') is None:
+            return item['name']
+        return f"{item['name']} - {self.money(item['price'])}"
+
+    def render_pricing(self, pricing):
+        lines = [f"💰 *{pricing['title']}* 💰", ""]
+        for menu_key in pricing['menus']:
+            menu = self.spec['menus'][menu_key]
+            if menu.get('heading'):
+                lines += ["", f"*{menu['heading']}:*"]
+            for item in self.menu_items[menu_key]:
+                if item.get('price') is not None and not item.get('addon'):
+                    lines.append(f"• {item['label']}")
+        return "\n".join(lines)
+
+    def find_item(self, selected_item, cake_type=None):
+        """The item a draft was chosen from, looked up in the menus of its cake type
+        (every menu for drafts saved without one)"""
+        pricing = self.spec['pricing'].get(cake_type)
+        indexes = [self.items[menu_key] for menu_key in (pricing['menus'] if pricing else self.items)]
+        key = (selected_item or '').strip().lower()
+        # Drafts keep the label they were chosen with; fall back to the item
+        # name so a price change since then still resolves
+        for candidate in (key, key.rsplit(' - ', 1)[0]):
+            for index in indexes:
+                if candidate in index:
+                    return index[candidate]
+        return None
+
+    def quote(self, selected_item, user, cake_type=None):
+        """Total for an order draft as {'total', 'lines'}, or None if the item is priced by an agent"""
+        item = self.find_item(selected_item, cake_type)
+        if not item or item.get('price') is None:
+            return None
+
+        total = item['price']
+        lines = [f"{item['name']}: {self.money(item['price'])}"]
+
+        extra_flavors = max(0, count_flavors(user.flavor) - item['flavors']) if item.get('flavors') else 0
+        if extra_flavors:
+            total += extra_flavors * self.extra_flavor_price
+            lines.append(f"Extra flavor{'s' if extra_flavors > 1 else ''}: {self.money(extra_flavors * self.extra_flavor_price)}")
+
+        colors = (user.colors or '').lower()
+        if item['color_surcharge'] and any(color in colors for color in self.surcharge_colors):
+            total += self.surcharge_price
+            lines.append(f"Color surcharge: {self.money(self.surcharge_price)}")
+
+        return {'total': total, 'lines': lines}
+
+    def price_line(self, selected_item, user, cake_type=None):
+        """The *Price:* line for order summaries"""
+        quote = self.quote(selected_item, user, cake_type)
+        if not quote:
+            return "*Price:* To be confirmed by our team"
+        if len(quote['lines']) == 1:
+            return f"*Price:* {self.money(quote['total'])}"
+        breakdown = "\n".join(f"  • {line}" for line in quote['lines'])
+        return f"*Price:* {self.money(quote['total'])}\n{breakdown}"
 
 class TierCakesOptions(Enum):
     TWO_TIER = "2 Tier Cakes - Fresh Cream"
     THREE_TIER = "3 Tier Cakes - Fresh Cream"
     BACK = "Back to cake types"
 
-class TwoTierOptions(Enum):
-    SIZE_4_6 = "4 inch + 6 inch - $60"
-    SIZE_5_7 = "5 inch + 7 inch - $80"
-    SIZE_6_8 = "6 inch + 8 inch - $110"
-    SIZE_7_9 = "7 inch + 9 inch - $140"
-    SIZE_8_10 = "8 inch + 10 inch - $170"
-    FONDANT = "Fondant Additional - $20"
-    GANACHE = "Ganache Additional - $10"
-    SMBC = "SMBC Additional - $15"
-    BACK = "Back to tier options"
-
-class ThreeTierOptions(Enum):
-    SIZE_4_6_8 = "4 inch + 6 inch + 8 inch - $140"
-    SIZE_5_7_9 = "5 inch + 7 inch + 9 inch - $170"
-    SIZE_6_8_10 = "6 inch + 8 inch + 10 inch - $210"
-    FONDANT = "Fondant Additional - $20"
-    GANACHE = "Ganache Additional - $10"
-    SMBC = "SMBC Additional - $15"
-    BACK = "Back to tier options"
-
-class FruitCakeOptions(Enum):
-    SIZE_6 = "6 inch - $60"
-    SIZE_8 = "8 inch - $80"
-    BACK = "Back to cake types"
-
-class PlasticIcingOptions(Enum):
-    SMALL = "Small 6 inches- $40"
-    MEDIUM = "Medium 8 inches- $50"
-    LARGE = "Large 10 inches - $70"
-    XL = "Extra Large 12 inches- $100"
-    BACK = "Back to cake types"
-
 class OrderOptions(Enum):
     NEW_ORDER = "Start New Order"
     EXISTING_ORDER = "Check Existing Order"
@@ -112,6 +531,152 @@ class ContactOptions(Enum):
     DIRECT = "Direct contact information"
     BACK = "Back to main menu"
 
+# Catalog store
+# Prices, menus, agent rosters and contact text are data rather than code. The
+# published catalog document lives in the "catalog" hash in Redis (or in a
+# local JSON file when CATALOG_FILE is set) next to a version number. Each
+# worker keeps the compiled catalog in memory and checks the version at most
+# once every CATALOG_CHECK_INTERVAL seconds; a new version is compiled once and
+# swapped in whole, so a handler that took a catalog sees one consistent view.
+CATALOG_KEY = "catalog"
+CATALOG_FILE = os.environ.get("CATALOG_FILE")
+CATALOG_CHECK_INTERVAL = float(os.environ.get("CATALOG_CHECK_INTERVAL", "30"))
+
+DEFAULT_CONTACT_INFO = """
+📞 *Contact Information* 📞
+
+You can reach us at:
+• Email: sales@cakefairy1.com
+• Website: www.cakefairy1.com
+
+Business Hours:
+• Monday-Friday: 8:00 AM - 5:00 PM
+• Saturday: 8:00 AM - 6:00 PM
+• Sunday: 8:00 AM - 3:00 PM
+
+We're located at:
+
+Bulawayo: 13 and 14th Avenue along R Mugabe Way Cake Fairy Shop | + ‪+263 77 321 8242‬
+
+Harare: 30 Rhodesville Avenue, Greendale | ‪+263 78 826 4258
+            """
+
+# Built-in catalog, used until one is published. Sections missing from a
+# published document are taken from here.
+DEFAULT_CATALOG = {
+    'prices': CATALOG_SPEC,
+    # 'general' agents take relayed chats; the city rosters serve the dispatcher
+    'agents': {'general': AGENT_NUMBERS, 'harare': HARARE, 'bulawayo': BULAWAYO},
+    'contact_info': DEFAULT_CONTACT_INFO,
+    # Daily production slots per collection point; tier cakes take more than one
+    'capacity': {
+        'slots': {'harare': 10, 'bulawayo': 10},
+        'weights': {'two_tier': 2, 'three_tier': 3},
+        'lead_hours': 24,
+    },
+}
+
+# KEYS: catalog hash. ARGV: document JSON. Returns the new version.
+PUBLISH_CATALOG_SCRIPT = """
+local version = redis.call('HINCRBY', KEYS[1], 'version', 1)
+redis.call('HSET', KEYS[1], 'document', ARGV[1])
+return version
+"""
+
+class Catalog:
+    """One compiled catalog version: prices, menu option lists and match index, agent rosters"""
+
+    def __init__(self, document, version=0):
+        document = dict(DEFAULT_CATALOG, **document)
+        self.version = version
+        self.document = document
+        self.prices = PriceCatalog(document['prices'])
+        self.enums = self.prices.enums
+        self.menu_options = {
+            menu_key: [option.value for option in enum] for menu_key, enum in self.enums.items()
+        }
+        self.option_index = {
+            menu_key: [(option.value.lower(), option) for option in enum]
+                      + [(alias.lower(), enum[key]) for alias, key in self.prices.option_aliases[menu_key]]
+            for menu_key, enum in self.enums.items()
+        }
+        self.agent_cities = {
+            city: [normalize_phone_number(number) for number in numbers]
+            for city, numbers in document['agents'].items() if city != 'general'
+        }
+        self.all_agents = frozenset(
+            normalize_phone_number(number) for numbers in document['agents'].values() for number in numbers
+        )
+        self.contact_info = document['contact_info']
+        self.capacity = document['capacity']
+
+    def order_weight(self, selected_item, cake_type=None):
+        """Production slots an item takes: its menu's weight, 1 by default"""
+        item = self.prices.find_item(selected_item, cake_type)
+        return self.capacity['weights'].get(item['menu'], 1) if item else 1
+
+    def match_option(self, menu_key, prompt):
+        """First option of a menu whose label contains the prompt"""
+        prompt = prompt.lower()
+        for label, option in self.option_index[menu_key]:
+            if prompt in label:
+                return option
+        return None
+
+_catalog = None
+_catalog_checked_at = 0.0
+_catalog_lock = threading.Lock()
+
+def load_catalog(current):
+    """The catalog for the source's current version, reusing `current` if it is unchanged"""
+    if CATALOG_FILE:
+        version = os.stat(CATALOG_FILE).st_mtime_ns
+        if current and current.version == version:
+            return current
+        with open(CATALOG_FILE) as f:
+            return Catalog(json.load(f), version)
+
+    version = int(redis_client.hget(CATALOG_KEY, 'version') or 0)
+    if current and current.version == version:
+        return current
+    if not version:
+        return Catalog({})
+    version, document = redis_client.hmget(CATALOG_KEY, 'version', 'document')
+    return Catalog(json.loads(document), int(version))
+
+def get_catalog():
+    """The in-memory catalog, checked against its source at most every CATALOG_CHECK_INTERVAL seconds"""
+    global _catalog, _catalog_checked_at
+    if _catalog is not None and time.monotonic() - _catalog_checked_at < CATALOG_CHECK_INTERVAL:
+        return _catalog
+    # Only one thread checks; the others keep using the current version meanwhile
+    if not _catalog_lock.acquire(blocking=_catalog is None):
+        return _catalog
+    try:
+        if _catalog is None or time.monotonic() - _catalog_checked_at >= CATALOG_CHECK_INTERVAL:
+            _catalog_checked_at = time.monotonic()
+            try:
+                catalog = load_catalog(_catalog)
+                if catalog is not _catalog:
+                    logging.info(f"Loaded catalog version {catalog.version}")
+                _catalog = catalog
+            except Exception as e:
+                logging.error(f"Catalog reload failed: {e}")
+                if _catalog is None:
+                    _catalog = Catalog({})
+        return _catalog
+    finally:
+        _catalog_lock.release()
+
+def publish_catalog(document):
+    """Validate and publish a catalog document to Redis. Returns the new version."""
+    global _catalog_checked_at
+    Catalog(document)  # raises if the document does not compile
+    version = redis_client.eval(PUBLISH_CATALOG_SCRIPT, [CATALOG_KEY], [json.dumps(document)])
+    # This worker picks it up on its next turn; the others within CATALOG_CHECK_INTERVAL
+    _catalog_checked_at = 0.0
+    return int(version)
+
 class User:
     def __init__(self, name, phone):
         self.name = name                 
@@ -210,25 +775,498 @@ def normalize_phone_number(phone):
         return cleaned
 
 # Redis state functions
+# Last-activity timestamps for customers part-way through an order; read by the reaper
+FUNNEL_ACTIVITY_KEY = "funnel_activity"
+ORDER_FUNNEL_STEPS = {
+    'order_decision', 'get_order_info', 'design_request', 'get_collection_point',
+    'choose_payment', 'confirm_order', 'proof_of_payment',
+}
+
+# Conversation logs
+# Logging is split into three tiers, each with its own retention and sampling
+# so memory per customer has a fixed ceiling:
+#   - messages: what was said in each direction, as compact entries (a
+#     one-letter direction, the message type and the text a person saw) in a
+#     per-phone Redis Stream capped at MESSAGE_LOG_LIMIT entries;
+#   - state changes: only the fields an update_user_state call changed, in a
+#     second per-phone stream, written in the same pipeline as the state;
+#   - raw payloads: whole webhook messages in hourly buckets shared by all
+#     phones, off by default and kept for a shorter time, for debugging.
+# Sampling is by phone rather than by entry, so a sampled customer's log has
+# no gaps. Stream ids carry the time, and reads page backwards from an id
+# with XREVRANGE, so a read costs O(page) however long the stream is.
+MESSAGE_LOG_LIMIT = int(os.environ.get("MESSAGE_LOG_LIMIT", "200"))
+MESSAGE_LOG_TTL = int(os.environ.get("MESSAGE_LOG_TTL", str(30 * 86400)))
+MESSAGE_LOG_SAMPLE = float(os.environ.get("MESSAGE_LOG_SAMPLE", "1"))
+STATE_LOG_LIMIT = int(os.environ.get("STATE_LOG_LIMIT", "50"))
+STATE_LOG_TTL = int(os.environ.get("STATE_LOG_TTL", str(7 * 86400)))
+STATE_LOG_SAMPLE = float(os.environ.get("STATE_LOG_SAMPLE", "1"))
+RAW_LOG_BUCKET_LIMIT = int(os.environ.get("RAW_LOG_BUCKET_LIMIT", "5000"))
+RAW_LOG_TTL = int(os.environ.get("RAW_LOG_TTL", str(2 * 86400)))
+RAW_LOG_SAMPLE = float(os.environ.get("RAW_LOG_SAMPLE", "0"))
+CONVERSATION_PAGE_LIMIT = 100
+CONVERSATION_TEXT_LIMIT = 500
+AGENT_CONTEXT_TURNS = int(os.environ.get("AGENT_CONTEXT_TURNS", "8"))
+CONVERSATION_DIRECTIONS = {'in': 'i', 'out': 'o'}
+CONVERSATION_DIRECTION_NAMES = {v: k for k, v in CONVERSATION_DIRECTIONS.items()}
+STATE_LOG_IGNORED_FIELDS = {'sender', 'phone_number', 'step_at'}
+
+def message_log_key(phone_number):
+    return f"messages:{phone_number}"
+
+def state_log_key(phone_number):
+    return f"state_log:{phone_number}"
+
+def raw_log_key(at=None):
+    return f"raw_log:{time.strftime('%Y%m%d%H', time.gmtime(at if at is not None else time.time()))}"
+
+def log_sampled(phone_number, rate):
+    """Whether a phone falls inside a tier's sample; stable for a given phone"""
+    if rate >= 1:
+        return True
+    if rate <= 0:
+        return False
+    bucket = int(hashlib.sha1(phone_number.encode()).hexdigest()[:8], 16)
+    return bucket < rate * 0x100000000
+
+def inbound_text(message):
+    """What the customer sent, from a raw webhook message"""
+    message_type = message.get('type')
+    if message_type == 'text':
+        return message.get('text', {}).get('body', '')
+    if message_type == 'interactive':
+        interactive = message.get('interactive', {})
+        reply = interactive.get('button_reply') or interactive.get('list_reply') or {}
+        return reply.get('title') or reply.get('id') or ''
+    if message_type == 'location':
+        location = message.get('location', {})
+        return location.get('name') or f"{location.get('latitude')},{location.get('longitude')}"
+    media = message.get(message_type) or {}
+    if isinstance(media, dict) and media.get('id'):
+        caption = media.get('caption') or media.get('filename') or ''
+        return f"[{message_type}] {caption}".strip()
+    return f"[{message_type}]"
+
+def compact_message(direction, message_type, payload):
+    """Reduce a message to the fields the history actually shows"""
+    payload = payload or {}
+    if 'from' in payload:
+        text = inbound_text(payload)
+    else:
+        text = str(payload.get('text') or '')
+        choices = payload.get('buttons') or payload.get('options') or []
+        titles = [c.get('title', '') if isinstance(c, dict) else str(c) for c in choices]
+        if titles:
+            text = f"{text} [{' | '.join(titles)}]"
+    return {
+        'd': CONVERSATION_DIRECTIONS.get(direction, direction),
+        'k': message_type,
+        'x': text[:CONVERSATION_TEXT_LIMIT],
+    }
+
 def log_conversation(phone_number, direction, message_type, payload):
+    """Append a message to the phone's message log"""
+    if not log_sampled(phone_number, MESSAGE_LOG_SAMPLE):
+        return
     try:
-        log_entry = {
-            'timestamp': datetime.now().isoformat(),
-            'direction': direction,  # 'in' or 'out' or 'state'
-            'type': message_type,    # 'text' | 'button' | 'list' | 'state' | 'raw'
-            'payload': payload,
-        }
-        redis_client.lpush(f"conversation:{phone_number}", json.dumps(log_entry))
-        redis_client.ltrim(f"conversation:{phone_number}", 0, 499)
+        key = message_log_key(phone_number)
+        pipeline = redis_client.pipeline()
+        pipeline.xadd(key, '*', compact_message(direction, message_type, payload),
+                      maxlen=MESSAGE_LOG_LIMIT, approximate_trim=False)
+        pipeline.expire(key, MESSAGE_LOG_TTL)
+        pipeline.exec()
     except Exception as e:
         logging.error(f"Failed to log conversation: {e}")
+
+def log_state_change(pipeline, phone_number, previous, current):
+    """Queue the fields that changed between two states onto a pipeline"""
+    if not log_sampled(phone_number, STATE_LOG_SAMPLE):
+        return
+    changes = {
+        k: v for k, v in current.items()
+        if k not in STATE_LOG_IGNORED_FIELDS and previous.get(k) != v
+    }
+    if not changes:
+        return
+    key = state_log_key(phone_number)
+    pipeline.xadd(key, '*', {'c': json.dumps(changes, separators=(',', ':'))},
+                  maxlen=STATE_LOG_LIMIT, approximate_trim=False)
+    pipeline.expire(key, STATE_LOG_TTL)
+
+def archive_raw_payload(phone_number, payload):
+    """Keep a whole webhook message in the current hour's raw bucket"""
+    if not log_sampled(phone_number, RAW_LOG_SAMPLE):
+        return
+    try:
+        key = raw_log_key()
+        entry = json.dumps({'phone': phone_number, 't': int(time.time()), 'payload': payload})
+        pipeline = redis_client.pipeline()
+        pipeline.rpush(key, entry)
+        pipeline.ltrim(key, -RAW_LOG_BUCKET_LIMIT, -1)
+        pipeline.expire(key, RAW_LOG_TTL)
+        pipeline.exec()
+    except Exception as e:
+        logging.error(f"Failed to archive raw payload: {e}")
+
+def stream_fields(fields):
+    """Stream entry fields as a dict, whether the client returns a dict or a flat list"""
+    if isinstance(fields, dict):
+        return fields
+    return dict(zip(fields[::2], fields[1::2]))
+
+def stream_id_before(entry_id):
+    """The largest stream id that sorts before entry_id, for exclusive paging"""
+    ms, seq = (int(part) for part in entry_id.split('-'))
+    if seq > 0:
+        return f"{ms}-{seq - 1}"
+    if ms > 0:
+        return f"{ms - 1}-18446744073709551615"
+    return None
+
+def conversation_entry_view(entry_id, fields, kind):
+    fields = stream_fields(fields)
+    view = {
+        'id': entry_id,
+        'timestamp': datetime.fromtimestamp(int(entry_id.split('-')[0]) / 1000, timezone.utc).isoformat(),
+    }
+    if kind == 'state':
+        view.update({'direction': 'state', 'type': 'state', 'changes': json.loads(fields.get('c') or '{}')})
+    else:
+        view.update({
+            'direction': CONVERSATION_DIRECTION_NAMES.get(fields.get('d'), fields.get('d')),
+            'type': fields.get('k'),
+            'text': fields.get('x', ''),
+        })
+    return view
+
+def read_conversation(phone_number, before=None, limit=20, include_state=False):
+    """Return (entries newest first, next 'before' cursor or None)"""
+    end = '+'
+    if before:
+        end = stream_id_before(before)
+        if end is None:
+            return [], None
+    keys = [('message', message_log_key(phone_number))]
+    if include_state:
+        keys.append(('state', state_log_key(phone_number)))
+    pipeline = redis_client.pipeline()
+    for _, key in keys:
+        pipeline.xrevrange(key, end, '-', count=limit + 1)
+    results = pipeline.exec()
+
+    # Each stream holds at least a page before the cursor, so the newest
+    # `limit` of their merge are exactly the next page
+    entries = []
+    more = False
+    for (kind, _), rows in zip(keys, results):
+        rows = rows or []
+        more = more or len(rows) > limit
+        entries.extend(conversation_entry_view(entry_id, fields, kind) for entry_id, fields in rows)
+    entries.sort(key=lambda e: tuple(int(part) for part in e['id'].split('-')), reverse=True)
+    if len(entries) > limit:
+        more = True
+        entries = entries[:limit]
+    return entries, (entries[-1]['id'] if more and entries else None)
+
+def conversation_summary(phone_number, turns=AGENT_CONTEXT_TURNS):
+    """The last few messages in a chat as a short block of text, oldest first"""
+    entries, _ = read_conversation(phone_number, limit=turns)
+    lines = []
+    for entry in reversed(entries):
+        text = ' '.join(entry['text'].split())
+        if len(text) > 120:
+            text = text[:117] + '...'
+        lines.append(f"{'👤' if entry['direction'] == 'in' else '🤖'} {text}")
+    return '\n'.join(lines)
+
+# Funnel analytics
+# Every step change bumps counters in a per-day hash, queued on the same
+# pipeline as the state write: entries into each step, moves between steps,
+# time spent in the step being left and the menu option picked, plus a
+# HyperLogLog of senders per step and day. Reports read only these aggregates,
+# so a month costs two pipelined round trips rather than a replay of the logs.
+FUNNEL_STATS_RETENTION = 400 * 86400
+FUNNEL_MAX_DWELL = 6 * 3600
+FUNNEL_REPORT_MAX_DAYS = 366
+FUNNEL_STEPS = (
+    'welcome', 'main_menu', 'cake_types_menu', 'order_decision',
+    'get_order_info', 'choose_payment', 'confirm_order', 'proof_of_payment',
+)
+
+def funnel_stats_key(day):
+    return f"funnel_stats:{day.isoformat()}"
+
+def funnel_users_key(day, step):
+    return f"funnel_users:{day.isoformat()}:{step}"
+
+def record_step_change(pipeline, phone_number, previous, current):
+    """Queue funnel counters for a state write, stamping when the new step began"""
+    step, before = current.get('step'), previous.get('step')
+    if not step or step == before:
+        return
+    now = time.time()
+    current['step_at'] = int(now)
+    day = bakery_today()
+    stats = funnel_stats_key(day)
+    pipeline.hincrby(stats, f"enter:{step}", 1)
+    pipeline.pfadd(funnel_users_key(day, step), phone_number)
+    pipeline.expire(funnel_users_key(day, step), FUNNEL_STATS_RETENTION)
+    if before:
+        pipeline.hincrby(stats, f"move:{before}>{step}", 1)
+        # The step left is counted too, so entry steps like welcome show up
+        pipeline.pfadd(funnel_users_key(day, before), phone_number)
+        pipeline.expire(funnel_users_key(day, before), FUNNEL_STATS_RETENTION)
+        if previous.get('step_at'):
+            dwell = min(max(now - previous['step_at'], 0), FUNNEL_MAX_DWELL)
+            pipeline.hincrby(stats, f"dwell:{before}", int(dwell))
+            pipeline.hincrby(stats, f"exit:{before}", 1)
+        option = current.get('selected_option')
+        if option and option != previous.get('selected_option'):
+            pipeline.hincrby(stats, f"option:{before}:{option}", 1)
+    pipeline.expire(stats, FUNNEL_STATS_RETENTION)
+
+def funnel_report(start, end, steps=FUNNEL_STEPS):
+    """Conversion, dwell time and option popularity between two dates, inclusive"""
+    days = [start + timedelta(days=i) for i in range((end - start).days + 1)]
+    pipeline = redis_client.pipeline()
+    for day in days:
+        pipeline.hgetall(funnel_stats_key(day))
+    totals = {}
+    for day_stats in pipeline.exec():
+        for field, value in (day_stats or {}).items():
+            totals[field] = totals.get(field, 0) + int(value)
+
+    seen = {field.split(':', 1)[1] for field in totals if field.startswith(('enter:', 'exit:'))}
+    all_steps = list(steps) + sorted(seen - set(steps))
+    pipeline = redis_client.pipeline()
+    for step in all_steps:
+        pipeline.pfcount(*[funnel_users_key(day, step) for day in days])
+    unique = dict(zip(all_steps, (int(n or 0) for n in pipeline.exec())))
+
+    step_stats = {}
+    for step in all_steps:
+        exits = totals.get(f"exit:{step}", 0)
+        step_stats[step] = {
+            'entries': totals.get(f"enter:{step}", 0),
+            'unique_senders': unique[step],
+            'exits': exits,
+            'avg_dwell_seconds': round(totals.get(f"dwell:{step}", 0) / exits, 1) if exits else None,
+        }
+
+    funnel = []
+    for i, step in enumerate(steps):
+        first, prev = unique[steps[0]], unique[steps[i - 1]] if i else unique[step]
+        funnel.append({
+            'step': step,
+            'unique_senders': unique[step],
+            'conversion': round(unique[step] / first, 4) if first else None,
+            'step_conversion': round(unique[step] / prev, 4) if prev else None,
+        })
+
+    options = {}
+    moves = {}
+    for field, count in totals.items():
+        if field.startswith('option:'):
+            _, menu, option = field.split(':', 2)
+            options.setdefault(menu, []).append({'option': option, 'count': count})
+        elif field.startswith('move:'):
+            moves[field[5:]] = count
+    for choices in options.values():
+        choices.sort(key=lambda c: c['count'], reverse=True)
+
+    return {
+        'from': start.isoformat(),
+        'to': end.isoformat(),
+        'funnel': funnel,
+        'steps': step_stats,
+        'options': options,
+        'moves': dict(sorted(moves.items(), key=lambda m: m[1], reverse=True)),
+    }
+
+# User state cache
+# Each worker keeps the states it last read or wrote in a bounded LRU. Every
+# write stores a fresh random version token next to the state, in the same
+# pipeline, and the cache holds the version it saw. Tokens never repeat, so a
+# version that expired with its state can't later match a new one. The first read of a phone in a turn
+# sends that version to READ_STATE_SCRIPT, which returns the state only if it
+# changed, so another worker's write is never missed; later reads in the same
+# turn (the freshest-state re-reads in the handlers, update_user_state's own
+# read) are served from the cache with no round trip.
+#
+# While Upstash is unavailable the cache is also the fallback: reads use an
+# entry checked within STATE_FALLBACK_TTL seconds, and writes are held in it,
+# marked unsaved along with the version they were derived from. Unsaved
+# states take precedence over Redis and are written back every
+# STATE_WRITE_BACK_INTERVAL seconds by a writer thread, at the end of each turn
+# (a serverless worker may not live long enough for the thread), and on
+# shutdown. A state is written back only if its version in Redis is still the
+# one it was derived from; if another worker has saved the phone since, that
+# save wins and the local copy is dropped. Only the state itself is written
+# back: funnel counters and state-change logs from the outage are lost.
+STATE_CACHE_MAX = int(os.environ.get("STATE_CACHE_MAX", "5000"))
+STATE_FALLBACK_TTL = int(os.environ.get("STATE_FALLBACK_TTL", "300"))
+STATE_WRITE_BACK_INTERVAL = 5
+STATE_TTL = 86400
+
+# KEYS: state, state version. ARGV: version the caller has cached
+# Returns {version} when the cached copy is current, else {version, state};
+# a state without a version (written before versions existed) is always sent
+READ_STATE_SCRIPT = """
+local version = redis.call('GET', KEYS[2])
+if version and version == ARGV[1] then
+    return {version}
+end
+return {version or '', redis.call('GET', KEYS[1]) or ''}
+"""
+
+# KEYS: state, state version. ARGV: version the state was derived from, new version, state, ttl
+# Saves the state only if nobody has saved it since; returns 1 if saved
+WRITE_BACK_STATE_SCRIPT = """
+if (redis.call('GET', KEYS[2]) or '') ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[3], 'EX', ARGV[4])
+redis.call('SET', KEYS[2], ARGV[2], 'EX', ARGV[4])
+return 1
+"""
+
+_state_cache = OrderedDict()  # phone -> (checked_at, version, state, unsaved)
+_state_cache_lock = threading.Lock()
+_state_cache_stats = {'hit': 0, 'miss': 0}
+# Phones whose cached state has been checked during the current turn
+_turn_checked_states = contextvars.ContextVar('turn_checked_states', default=None)
+
+def state_version_key(phone_number):
+    return f"user_state_version:{phone_number}"
+
+def new_state_version():
+    return ''.join(random.choices(string.ascii_letters + string.digits, k=16))
+
+@contextmanager
+def state_turn():
+    """Trust a phone's cached state for the rest of the turn once it has been checked"""
+    token = _turn_checked_states.set(set())
+    try:
+        yield
+    finally:
+        _turn_checked_states.reset(token)
+
+def remember_state(phone_number, state, version, unsaved=False):
+    with _state_cache_lock:
+        _state_cache[phone_number] = (time.time(), version, dict(state), unsaved)
+        _state_cache.move_to_end(phone_number)
+        while len(_state_cache) > STATE_CACHE_MAX:
+            _state_cache.popitem(last=False)
+    checked = _turn_checked_states.get()
+    if checked is not None:
+        checked.add(phone_number)
+
+def cached_state(phone_number):
+    with _state_cache_lock:
+        return _state_cache.get(phone_number)
+
+def count_state_read(result):
+    with _state_cache_lock:
+        _state_cache_stats[result] += 1
+    count_metric('state_reads_total', result=result)
+
+def state_cache_hit_ratio():
+    reads = _state_cache_stats['hit'] + _state_cache_stats['miss']
+    return round(_state_cache_stats['hit'] / reads, 4) if reads else 0
+
+def has_unsaved_states():
+    with _state_cache_lock:
+        return any(entry[3] for entry in _state_cache.values())
+
+def save_unsaved_states():
+    """Write back states held locally during a Redis outage"""
+    with _state_cache_lock:
+        pending = {phone: entry for phone, entry in _state_cache.items() if entry[3]}
+    saved = 0
+    for phone_number, entry in pending.items():
+        version = new_state_version()
+        try:
+            written = redis_client.eval(
+                WRITE_BACK_STATE_SCRIPT,
+                [f"user_state:{phone_number}", state_version_key(phone_number)],
+                [entry[1], version, json.dumps(entry[2]), STATE_TTL],
+            )
+        except Exception as e:
+            logging.error(f"Failed to write back {len(pending) - saved} unsaved states: {e}")
+            return
+        with _state_cache_lock:
+            # Unless it changed again meanwhile
+            if _state_cache.get(phone_number) is not entry:
+                continue
+            if written:
+                _state_cache[phone_number] = (time.time(), version, entry[2], False)
+            else:
+                del _state_cache[phone_number]
+        if written:
+            saved += 1
+        else:
+            logging.warning(f"State for {phone_number} was saved by another worker during the outage, dropping this worker's copy")
+            count_metric('state_write_back_conflicts_total')
+    if saved:
+        logging.info(f"Wrote back {saved} states saved locally during a Redis outage")
+
+_state_writer_started = False
+_state_writer_lock = threading.Lock()
+
+def state_writer_loop():
+    while True:
+        time.sleep(STATE_WRITE_BACK_INTERVAL)
+        if has_unsaved_states():
+            save_unsaved_states()
+
+def ensure_state_writer():
+    global _state_writer_started
+    if _state_writer_started:
+        return
+    with _state_writer_lock:
+        if not _state_writer_started:
+            threading.Thread(target=state_writer_loop, daemon=True).start()
+            _state_writer_started = True
+
+register_gauge('state_cache_hit_ratio', state_cache_hit_ratio)
+register_gauge('state_cache_entries', lambda: len(_state_cache))
+register_gauge('unsaved_states', lambda: sum(1 for entry in list(_state_cache.values()) if entry[3]))
+
 def get_user_state(phone_number):
-    state_json = redis_client.get(f"user_state:{phone_number}")
-    if state_json:
-        state = json.loads(state_json)
+    cached = cached_state(phone_number)
+    checked = _turn_checked_states.get()
+    if cached and (cached[3] or (checked is not None and phone_number in checked)):
+        count_state_read('hit')
+        return dict(cached[2])
+    try:
+        with timed_call('redis'):
+            reply = redis_client.eval(
+                READ_STATE_SCRIPT,
+                [f"user_state:{phone_number}", state_version_key(phone_number)],
+                [cached[1] if cached else ''],
+            )
+    except Exception as e:
+        if cached is None or time.time() - cached[0] > STATE_FALLBACK_TTL:
+            raise
+        logging.warning(f"Redis unavailable, using this worker's copy of the state for {phone_number}: {e}")
+        return dict(cached[2])
+    return state_from_reply(phone_number, cached, reply)
+
+def state_from_reply(phone_number, cached, reply):
+    """The state from a READ_STATE_SCRIPT reply, remembered for the turn"""
+    version = str(reply[0])
+    if len(reply) == 1:
+        count_state_read('hit')
+        remember_state(phone_number, cached[2], version)
+        return dict(cached[2])
+    count_state_read('miss')
+    if reply[1]:
+        state = json.loads(reply[1])
+        remember_state(phone_number, state, version)
         print(f"Retrieved state for {phone_number}: {state}")
         return state
     default_state = {'step': 'welcome', 'sender': phone_number}
+    remember_state(phone_number, default_state, version)
     print(f"No state found for {phone_number}, returning default: {default_state}")
     return default_state
 
@@ -238,26 +1276,625 @@ def update_user_state(phone_number, updates):
     print(f"Updates: {updates}")
     current = get_user_state(phone_number)
     print(f"Current state: {current}")
+    previous = dict(current)
     current.update(updates)
     current['phone_number'] = phone_number
     if 'sender' not in current:
         current['sender'] = phone_number
+    # Save the state, its funnel counters and order-funnel activity for the reaper in one round trip
+    version = new_state_version()
+    pipeline = redis_client.pipeline()
+    pipeline.setex(state_version_key(phone_number), STATE_TTL, version)
+    record_step_change(pipeline, phone_number, previous, current)
     print(f"Final state to save: {current}")
-    redis_client.setex(f"user_state:{phone_number}", 86400, json.dumps(current))
-    print(f"State saved for {phone_number}")
-    # Log state snapshot
+    pipeline.setex(f"user_state:{phone_number}", STATE_TTL, json.dumps(current))
+    if current.get('step') in ORDER_FUNNEL_STEPS:
+        pipeline.zadd(FUNNEL_ACTIVITY_KEY, {phone_number: time.time()})
+    else:
+        pipeline.zrem(FUNNEL_ACTIVITY_KEY, phone_number)
+    log_state_change(pipeline, phone_number, previous, current)
     try:
-        log_conversation(phone_number, 'state', 'state', current)
-    except Exception:
-        pass
+        pipeline.exec()
+    except Exception as e:
+        logging.error(f"Failed to save state for {phone_number}, holding it until Redis recovers: {e}")
+        cached = cached_state(phone_number)
+        remember_state(phone_number, current, cached[1] if cached else '', unsaved=True)
+        ensure_state_writer()
+        return
+    remember_state(phone_number, current, version)
+    print(f"State saved for {phone_number}")
 
-def send_message(text, recipient, phone_id):
-    url = f"https://graph.facebook.com/v19.0/{phone_id}/messages"
-    headers = {
+# Record ids
+# Order, callback and inquiry ids are the minute they were issued, in Crockford
+# base32, followed by a sequence number. Sequences come from a Redis INCRBY
+# per kind, handed out in blocks of ID_BLOCK_SIZE that each worker uses up
+# locally, so ids are unique across workers and most cost no round trip. Ids
+# sort by issue time, so a time range of ids is a range of their prefixes.
+CROCKFORD_ALPHABET = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+CROCKFORD_ALIASES = str.maketrans("OIL", "011")
+ID_EPOCH = 1704067200  # 2024-01-01 UTC
+ID_TIME_WIDTH = 5      # minutes since ID_EPOCH; 32^5 minutes is about 63 years
+ID_SEQUENCE_WIDTH = 3  # grows past 32768 ids of one kind
+ID_BLOCK_SIZE = int(os.environ.get("ID_BLOCK_SIZE", "20"))
+
+_id_blocks = {}  # kind -> [next sequence, last sequence in the leased block]
+_id_lock = threading.Lock()
+
+def crockford_encode(number, width):
+    digits = []
+    while number:
+        number, digit = divmod(number, 32)
+        digits.append(CROCKFORD_ALPHABET[digit])
+    return ''.join(reversed(digits)).rjust(width, '0')
+
+def crockford_decode(text):
+    number = 0
+    for char in text.upper().translate(CROCKFORD_ALIASES):
+        number = number * 32 + CROCKFORD_ALPHABET.index(char)
+    return number
+
+def next_sequence(kind):
+    with _id_lock:
+        block = _id_blocks.get(kind)
+        if not block or block[0] > block[1]:
+            last = int(redis_client.incrby(f"id_seq:{kind}", ID_BLOCK_SIZE))
+            block = _id_blocks[kind] = [last - ID_BLOCK_SIZE + 1, last]
+        sequence = block[0]
+        block[0] += 1
+        return sequence
+
+def id_prefix(timestamp):
+    """The time part of ids issued at `timestamp`, for range scans"""
+    return crockford_encode(max(0, int(timestamp - ID_EPOCH) // 60), ID_TIME_WIDTH)
+
+def new_id(kind):
+    return id_prefix(time.time()) + crockford_encode(next_sequence(kind), ID_SEQUENCE_WIDTH)
+
+def id_timestamp(record_id):
+    """Issue time (to the minute) of an id from new_id"""
+    return ID_EPOCH + crockford_decode(record_id[:ID_TIME_WIDTH]) * 60
+
+def normalize_id(text):
+    """A typed-in id in canonical form: upper case, with O/I/L read as 0/1/1"""
+    return text.strip().upper().translate(CROCKFORD_ALIASES)
+
+def order_number_candidates(text):
+    """Order numbers a typed-in one may mean. Older random numbers may contain
+    O/I/L, so the number as typed comes before its canonical form."""
+    return list(dict.fromkeys([text.strip().upper(), normalize_id(text)]))
+
+# Outbound rate limiting and retries
+# Meta enforces a per-number throughput limit and a per-recipient (pair) limit.
+# Both are modelled as token buckets in Redis so every worker shares them.
+#
+# A webhook turn may spend at most SEND_TURN_BUDGET seconds waiting on tokens
+# and backoff, counted from the start of the turn; a send that would wait past
+# that is handed to the send queue instead, so the turn still answers well
+# within Meta's and Vercel's timeouts. Only failures that show the POST never
+# reached Meta (no connection), 429s and throttle codes are retried. A 5xx or
+# a timeout after the request went out may still have been delivered, so it is
+# dead-lettered as ambiguous rather than risk sending the customer a duplicate.
+SEND_GLOBAL_RATE = float(os.environ.get("SEND_GLOBAL_RATE", "60"))          # messages/sec for our number
+SEND_GLOBAL_BURST = float(os.environ.get("SEND_GLOBAL_BURST", "80"))
+SEND_RECIPIENT_RATE = float(os.environ.get("SEND_RECIPIENT_RATE", "0.2"))   # messages/sec per recipient
+SEND_RECIPIENT_BURST = float(os.environ.get("SEND_RECIPIENT_BURST", "45"))
+SEND_MAX_WAIT = float(os.environ.get("SEND_MAX_WAIT", "15"))                # max seconds to wait for a token
+SEND_TURN_BUDGET = float(os.environ.get("SEND_TURN_BUDGET", "5"))          # max seconds a turn waits on sends
+SEND_MAX_RETRIES = int(os.environ.get("SEND_MAX_RETRIES", "4"))
+SEND_BACKOFF_BASE = float(os.environ.get("SEND_BACKOFF_BASE", "0.5"))
+SEND_BACKOFF_MAX = float(os.environ.get("SEND_BACKOFF_MAX", "30"))
+SEND_TIMEOUT = float(os.environ.get("SEND_TIMEOUT", "10"))
+SEND_DEAD_LETTER_KEY = "send_dead_letter"
+SEND_DEAD_LETTER_MAX = 10000
+
+# Graph error codes that mean "slow down" even when the HTTP status is 400
+GRAPH_THROTTLE_CODES = {4, 80007, 130429, 131048, 131056}
+
+# Consumes one token from both buckets, or neither. Returns the seconds to wait
+# (as a string, so fractional values survive the Lua -> Redis reply conversion).
+# KEYS: buckets, then optionally the queued-send counts. ARGV: now, (rate,
+# burst) per bucket, then the recipient if queued sends are checked. Returns -1,
+# taking no token, when the recipient already has sends waiting in the queue.
+TOKEN_BUCKET_SCRIPT = """
+local now = tonumber(ARGV[1])
+local count = math.floor((#ARGV - 1) / 2)
+if #KEYS > count and redis.call('HEXISTS', KEYS[count + 1], ARGV[#ARGV]) == 1 then
+    return '-1'
+end
+local wait = 0
+local buckets = {}
+for i = 1, count do
+    local rate = tonumber(ARGV[i * 2])
+    local burst = tonumber(ARGV[i * 2 + 1])
+    local state = redis.call('HMGET', KEYS[i], 'tokens', 'ts')
+    local tokens = tonumber(state[1]) or burst
+    local ts = tonumber(state[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+    if tokens < 1 then
+        wait = math.max(wait, (1 - tokens) / rate)
+    end
+    buckets[i] = {tokens, rate, burst}
+end
+for i = 1, count do
+    local tokens = buckets[i][1]
+    if wait == 0 then
+        tokens = tokens - 1
+    end
+    redis.call('HSET', KEYS[i], 'tokens', tokens, 'ts', now)
+    redis.call('EXPIRE', KEYS[i], math.ceil(buckets[i][3] / buckets[i][2]) + 1)
+end
+return tostring(wait)
+"""
+
+def graph_messages_url(phone_id):
+    return f"https://graph.facebook.com/v19.0/{phone_id}/messages"
+
+def graph_headers():
+    return {
         'Authorization': f'Bearer {wa_token}',
         'Content-Type': 'application/json'
     }
-    
+
+def send_slot_args(recipient, check_queue=True):
+    """Keys and args for TOKEN_BUCKET_SCRIPT, less the leading timestamp"""
+    keys = ["send_bucket:global"]
+    args = [SEND_GLOBAL_RATE, SEND_GLOBAL_BURST]
+    if recipient:
+        keys.append(f"send_bucket:{normalize_phone_number(recipient)}")
+        args += [SEND_RECIPIENT_RATE, SEND_RECIPIENT_BURST]
+        if check_queue:
+            keys.append(SEND_QUEUE_PENDING_KEY)
+            args.append(normalize_phone_number(recipient))
+    return keys, args
+
+# acquire_send_slot's answer when earlier sends to the recipient are still queued
+SEND_QUEUED_BEHIND = 'queued'
+
+def send_wait_limit(deadline):
+    """Longest a send may wait for a token, given the turn's deadline (None outside a turn)"""
+    if deadline is None:
+        return SEND_MAX_WAIT
+    return max(0.0, min(SEND_MAX_WAIT, deadline - time.time()))
+
+def acquire_send_slot(recipient, check_queue=True, max_wait=SEND_MAX_WAIT):
+    """Block until both the global and the recipient bucket allow a send.
+
+    Returns True, False on timeout, or SEND_QUEUED_BEHIND if this send must
+    join the recipient's queued sends to keep them in order.
+    """
+    keys, args = send_slot_args(recipient, check_queue)
+
+    waited = 0.0
+    while True:
+        try:
+            wait = float(redis_client.eval(TOKEN_BUCKET_SCRIPT, keys, [time.time()] + args))
+        except Exception as e:
+            # Never block sends because the limiter itself is unavailable
+            logging.error(f"Rate limiter unavailable, sending without a token: {e}")
+            return True
+        if wait < 0:
+            return SEND_QUEUED_BEHIND
+        if wait == 0:
+            return True
+        if waited + wait > max_wait:
+            return False
+        time.sleep(wait)
+        waited += wait
+
+def send_never_reached_meta(error):
+    """Whether a failed POST certainly never left this process, so sending it again can't duplicate it"""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = error.args[0] if error.args else None
+    return isinstance(getattr(reason, 'reason', reason), NewConnectionError)
+
+def is_retryable_send_error(response):
+    if response.status_code == 429 or response.status_code >= 500:
+        return True
+    try:
+        code = response.json().get('error', {}).get('code')
+    except ValueError:
+        return False
+    return code in GRAPH_THROTTLE_CODES
+
+def send_backoff_delay(attempt, response=None):
+    """Seconds to wait before the next attempt: Retry-After if given, else full-jitter exponential backoff."""
+    if response is not None:
+        retry_after = response.headers.get('Retry-After')
+        if retry_after:
+            try:
+                return min(float(retry_after), SEND_BACKOFF_MAX)
+            except ValueError:
+                pass
+    return random.uniform(0, min(SEND_BACKOFF_MAX, SEND_BACKOFF_BASE * (2 ** attempt)))
+
+def dead_letter_send(payload, reason, status_code=None):
+    """Keep permanently failed sends so they can be inspected or replayed."""
+    entry = {
+        'timestamp': datetime.now().isoformat(),
+        'recipient': payload.get('to'),
+        'type': payload.get('type'),
+        'reason': reason,
+        'status_code': status_code,
+        'payload': payload,
+    }
+    try:
+        redis_client.lpush(SEND_DEAD_LETTER_KEY, json.dumps(entry))
+        redis_client.ltrim(SEND_DEAD_LETTER_KEY, 0, SEND_DEAD_LETTER_MAX - 1)
+    except Exception as e:
+        logging.error(f"Failed to dead-letter send to {payload.get('to')}: {e}")
+
+# Sends made while the Graph breaker is open wait here, oldest first, and are
+# posted by the send queue flusher once a probe gets through. A job stays at
+# the head of the queue until it has been posted, and one flusher at a time
+# holds SEND_QUEUE_LOCK_KEY, so a crash means a resend rather than a lost
+# message. SEND_QUEUE_PENDING_KEY counts queued jobs per recipient; while a
+# recipient has any, new sends to them join the queue too (checked in the
+# token bucket script), so they arrive in order. Replies older than
+# SEND_QUEUE_MAX_AGE would arrive out of context and are dead-lettered.
+SEND_QUEUE_KEY = "graph_send_queue"
+SEND_QUEUE_PENDING_KEY = "graph_send_pending"
+SEND_QUEUE_LOCK_KEY = "graph_send_queue:lock"
+SEND_QUEUE_LOCK_SECONDS = 60
+SEND_QUEUE_MAX_AGE = int(os.environ.get("SEND_QUEUE_MAX_AGE", "900"))
+SEND_QUEUE_INTERVAL = 5
+
+# KEYS: queue, pending counts. ARGV: job, recipient
+# Removes a posted job from the head of the queue
+ACK_QUEUED_SEND_SCRIPT = """
+if redis.call('LINDEX', KEYS[1], 0) ~= ARGV[1] then
+    return 0
+end
+redis.call('LPOP', KEYS[1])
+if redis.call('HINCRBY', KEYS[2], ARGV[2], -1) <= 0 then
+    redis.call('HDEL', KEYS[2], ARGV[2])
+end
+return 1
+"""
+
+# KEYS: lock. ARGV: holder
+RELEASE_SEND_QUEUE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+_send_queue_flusher_started = False
+_send_queue_flusher_lock = threading.Lock()
+
+def queued_send_response():
+    """Stand-in response for a send that has been queued but not yet posted"""
+    response = requests.Response()
+    response.status_code = 202
+    response._content = b'{"messages": []}'
+    return response
+
+def queue_send(payload, phone_id, ledger_attempt=0, retry_of=None):
+    job = {
+        'payload': payload,
+        'phone_id': phone_id,
+        'attempt': ledger_attempt,
+        'retry_of': retry_of,
+        'queued_at': time.time(),
+    }
+    try:
+        pipeline = redis_client.multi()
+        pipeline.rpush(SEND_QUEUE_KEY, json.dumps(job))
+        pipeline.hincrby(SEND_QUEUE_PENDING_KEY, normalize_phone_number(payload.get('to')), 1)
+        pipeline.exec()
+    except Exception as e:
+        logging.error(f"Failed to queue send to {payload.get('to')}: {e}")
+        raise requests.exceptions.RequestException(f"Graph API unavailable and send to {payload.get('to')} could not be queued")
+    count_metric('sends_queued_total')
+    ensure_send_queue_flusher()
+    return queued_send_response()
+
+def flush_send_queue(budget=None):
+    """Post queued sends in order until the queue is empty or the breaker opens again"""
+    holder = ''.join(random.choices(string.ascii_lowercase + string.digits, k=12))
+    if not redis_client.set(SEND_QUEUE_LOCK_KEY, holder, nx=True, ex=SEND_QUEUE_LOCK_SECONDS):
+        return 0  # another flusher is working through the queue
+    deadline = time.time() + budget if budget else None
+    sent = 0
+    try:
+        while not deadline or time.time() < deadline:
+            raw = redis_client.lindex(SEND_QUEUE_KEY, 0)
+            if not raw:
+                break
+            job = json.loads(raw)
+            if time.time() - job['queued_at'] > SEND_QUEUE_MAX_AGE:
+                dead_letter_send(job['payload'], 'expired_in_queue')
+            else:
+                try:
+                    graph_post(job['payload'], job['phone_id'], job['attempt'], job['retry_of'], from_queue=True)
+                except CircuitOpenError:
+                    break
+                except requests.exceptions.RequestException as e:
+                    # graph_post has dead-lettered it
+                    logging.error(f"Queued send to {job['payload'].get('to')} failed: {e}")
+                sent += 1
+            redis_client.eval(ACK_QUEUED_SEND_SCRIPT, [SEND_QUEUE_KEY, SEND_QUEUE_PENDING_KEY],
+                              [raw, normalize_phone_number(job['payload'].get('to'))])
+            redis_client.set(SEND_QUEUE_LOCK_KEY, holder, xx=True, ex=SEND_QUEUE_LOCK_SECONDS)
+    finally:
+        redis_client.eval(RELEASE_SEND_QUEUE_LOCK_SCRIPT, [SEND_QUEUE_LOCK_KEY], [holder])
+    return sent
+
+def send_queue_flusher_loop():
+    while True:
+        time.sleep(SEND_QUEUE_INTERVAL)
+        try:
+            flush_send_queue()
+        except Exception as e:
+            logging.error(f"Send queue flush failed: {e}")
+
+def ensure_send_queue_flusher():
+    global _send_queue_flusher_started
+    if _send_queue_flusher_started:
+        return
+    with _send_queue_flusher_lock:
+        if not _send_queue_flusher_started:
+            threading.Thread(target=send_queue_flusher_loop, daemon=True).start()
+            _send_queue_flusher_started = True
+
+# Set by a server that sends on the caller's behalf (see asgi.py); graph_post
+# hands payloads to it instead of posting them from the calling thread
+send_dispatcher = contextvars.ContextVar('send_dispatcher', default=None)
+# When the current turn must stop waiting on sends (see SEND_TURN_BUDGET)
+send_deadline = contextvars.ContextVar('send_deadline', default=None)
+
+# The decisions graph_post makes around each attempt, shared with the ASGI
+# server's send lanes (see asgi.py), which post the same way on the event loop
+def send_gate(slot, recipient, from_queue=False):
+    """What to do once the rate limiter has answered: 'send', 'queue', or 'skip' this attempt"""
+    if slot == SEND_QUEUED_BEHIND:
+        return 'queue'
+    if not slot:
+        logging.warning(f"Send to {recipient} timed out waiting for a rate limit token")
+        return 'skip'
+    if not graph_breaker.allow():
+        if from_queue:
+            raise CircuitOpenError("graph circuit is open")
+        return 'queue'
+    return 'send'
+
+def send_attempt_outcome(recipient, attempt, response, error, elapsed):
+    """Record an attempt against the Graph breaker: 'accepted', 'rejected', 'ambiguous' or 'retry'"""
+    if error is not None:
+        graph_breaker.record(False)
+        if not send_never_reached_meta(error):
+            logging.error(f"Send to {recipient} may have been delivered (attempt {attempt + 1}), not retrying: {error}")
+            return 'ambiguous'
+        logging.warning(f"Send to {recipient} failed (attempt {attempt + 1}): {error}")
+        return 'retry'
+    # Throttling is the rate limiter's concern; only outages count against the breaker
+    graph_breaker.record(response.status_code < 500, elapsed)
+    if response.status_code < 400:
+        return 'accepted'
+    if response.status_code >= 500:
+        logging.error(f"Send to {recipient} got {response.status_code} (attempt {attempt + 1}) and may have been delivered, not retrying")
+        return 'ambiguous'
+    if not is_retryable_send_error(response):
+        return 'rejected'
+    logging.warning(f"Send to {recipient} throttled/failed with {response.status_code} (attempt {attempt + 1})")
+    return 'retry'
+
+def send_retry_delay(attempt, response, deadline):
+    """Seconds to wait before the next attempt, or None if that would overrun the turn's deadline"""
+    delay = send_backoff_delay(attempt, response)
+    if deadline is not None and time.time() + delay > deadline:
+        return None
+    return delay
+
+def send_failed(payload, reason, response, error):
+    """Dead-letter a send that won't be tried again; returns its last response or raises"""
+    dead_letter_send(payload, reason, response.status_code if response is not None else None)
+    if response is None and error:
+        raise error
+    return response
+
+def send_exhausted(payload, response, error):
+    """Dead-letter a send that ran out of attempts; returns its last response or raises"""
+    if response is not None:
+        dead_letter_send(payload, 'retries_exhausted', response.status_code)
+        return response
+    dead_letter_send(payload, 'retries_exhausted' if error else 'rate_limited')
+    if error:
+        raise error
+    raise requests.exceptions.RequestException(f"Rate limit wait exceeded for {payload.get('to')}")
+
+def graph_post(payload, phone_id, ledger_attempt=0, retry_of=None, from_queue=False):
+    """POST a message payload to the Graph API with rate limiting and retries.
+
+    Returns the last response (callers still call raise_for_status) and re-raises
+    the last network error once retries are exhausted. Accepted sends are
+    recorded in the send ledger by their wamid. While the Graph breaker is open,
+    or earlier sends to the recipient are queued, the payload is queued and a
+    202 stand-in returned. The queue flusher passes from_queue, which raises
+    CircuitOpenError instead. Inside a turn, a send that would wait past the
+    turn's send deadline is queued too.
+    """
+    dispatcher = send_dispatcher.get()
+    if dispatcher is not None:
+        return dispatcher(payload, phone_id, ledger_attempt, retry_of)
+    url = graph_messages_url(phone_id)
+    recipient = payload.get('to')
+    deadline = None if from_queue else send_deadline.get()
+    response = None
+    error = None
+
+    for attempt in range(SEND_MAX_RETRIES + 1):
+        slot = acquire_send_slot(recipient, check_queue=not from_queue, max_wait=send_wait_limit(deadline))
+        gate = send_gate(slot, recipient, from_queue)
+        if gate == 'queue':
+            return queue_send(payload, phone_id, ledger_attempt, retry_of)
+        if gate == 'skip':
+            response = None
+            error = None
+            delay = send_retry_delay(attempt, None, deadline)
+            if delay is None:
+                return queue_send(payload, phone_id, ledger_attempt, retry_of)
+            if attempt < SEND_MAX_RETRIES:
+                time.sleep(delay)
+            continue
+
+        started = time.time()
+        try:
+            with timed_call('graph'):
+                response = requests.post(url, headers=graph_headers(), json=payload, timeout=SEND_TIMEOUT)
+            error = None
+        except requests.exceptions.RequestException as e:
+            response = None
+            error = e
+        outcome = send_attempt_outcome(recipient, attempt, response, error, time.time() - started)
+        if outcome == 'accepted':
+            record_send(response, payload, attempt=ledger_attempt, retry_of=retry_of)
+            return response
+        if outcome in ('rejected', 'ambiguous'):
+            return send_failed(payload, outcome, response, error)
+
+        if attempt < SEND_MAX_RETRIES:
+            delay = send_retry_delay(attempt, response, deadline)
+            if delay is None:
+                return queue_send(payload, phone_id, ledger_attempt, retry_of)
+            time.sleep(delay)
+
+    return send_exhausted(payload, response, error)
+
+# Send ledger and delivery statuses
+# Every accepted send is kept under send_ledger:{wamid} so the status callbacks
+# Meta posts to the webhook (sent/delivered/read/failed) can be matched in O(1).
+SEND_LEDGER_TTL = int(os.environ.get("SEND_LEDGER_TTL", "172800"))  # 2 days
+SEND_STATUS_MAX_RETRIES = int(os.environ.get("SEND_STATUS_MAX_RETRIES", "2"))
+DELIVERY_STATS_KEY = "delivery_stats"
+
+# Graph error codes in a failed status callback that are worth sending again
+GRAPH_RETRYABLE_STATUS_CODES = GRAPH_THROTTLE_CODES | {1, 2, 131000, 131016}
+
+# Applies one status callback to a ledger entry and folds its latency into the
+# per-type stats. Returns {status, type, attempt} or nil for unknown wamids.
+APPLY_SEND_STATUS_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return nil
+end
+local status = ARGV[1]
+local ts = tonumber(ARGV[2])
+local ranks = {sent = 1, delivered = 2, read = 3, failed = 4}
+local entry = redis.call('HMGET', KEYS[1], 'status', 'type', 'posted_at', 'delivered_at', status .. '_at', 'attempt')
+local mtype = entry[2] or 'unknown'
+if entry[5] then
+    return {entry[1] or '', mtype, entry[6] or '0'}
+end
+redis.call('HSET', KEYS[1], status .. '_at', ts)
+if (ranks[status] or 0) > (ranks[entry[1]] or 0) then
+    redis.call('HSET', KEYS[1], 'status', status)
+end
+local posted = tonumber(entry[3])
+if status == 'delivered' and posted then
+    redis.call('HINCRBY', KEYS[2], mtype .. ':delivered', 1)
+    redis.call('HINCRBYFLOAT', KEYS[2], mtype .. ':send_to_delivered_total', math.max(0, ts - posted))
+elseif status == 'read' then
+    redis.call('HINCRBY', KEYS[2], mtype .. ':read', 1)
+    local delivered = tonumber(entry[4])
+    if delivered then
+        redis.call('HINCRBY', KEYS[2], mtype .. ':delivered_to_read', 1)
+        redis.call('HINCRBYFLOAT', KEYS[2], mtype .. ':delivered_to_read_total', math.max(0, ts - delivered))
+    end
+elseif status == 'failed' then
+    redis.call('HINCRBY', KEYS[2], mtype .. ':failed', 1)
+end
+redis.call('SADD', KEYS[3], mtype)
+return {status, mtype, entry[6] or '0'}
+"""
+
+def ledger_message_type(payload):
+    """Stats bucket for a payload: text, image, template, or the interactive subtype"""
+    message_type = payload.get('type', 'unknown')
+    if message_type == 'interactive':
+        return payload.get('interactive', {}).get('type', 'interactive')
+    return message_type
+
+def ledger_entry(response, payload, attempt=0, retry_of=None):
+    """(wamid, ledger hash) for an accepted send; wamid is None if the response has none"""
+    wamid = (response.json().get('messages') or [{}])[0].get('id')
+    entry = {
+        'to': payload.get('to'),
+        'type': ledger_message_type(payload),
+        'status': 'accepted',
+        'posted_at': time.time(),
+        'attempt': attempt,
+        'payload': json.dumps(payload),
+    }
+    if retry_of:
+        entry['retry_of'] = retry_of
+    return wamid, entry
+
+def record_send(response, payload, attempt=0, retry_of=None):
+    try:
+        wamid, entry = ledger_entry(response, payload, attempt, retry_of)
+        if not wamid:
+            return
+        pipeline = redis_client.pipeline()
+        pipeline.hset(f"send_ledger:{wamid}", values=entry)
+        pipeline.expire(f"send_ledger:{wamid}", SEND_LEDGER_TTL)
+        pipeline.exec()
+    except Exception as e:
+        logging.error(f"Failed to record send in ledger: {e}")
+
+def ingest_status_events(statuses):
+    """Fast path for status callbacks: touches only the ledger, never user state"""
+    for event in statuses:
+        wamid = event.get('id')
+        status = event.get('status')
+        if not wamid or not status:
+            continue
+        try:
+            applied = redis_client.eval(
+                APPLY_SEND_STATUS_SCRIPT,
+                [f"send_ledger:{wamid}", DELIVERY_STATS_KEY, f"{DELIVERY_STATS_KEY}:types"],
+                [status, event.get('timestamp') or int(time.time())]
+            )
+        except Exception as e:
+            logging.error(f"Failed to apply status {status} for {wamid}: {e}")
+            continue
+
+        if applied and status == 'failed' and applied[0] == 'failed':
+            error_codes = {error.get('code') for error in event.get('errors', [])}
+            run_in_background(retry_failed_send, wamid, int(applied[2]), error_codes)
+
+def retry_failed_send(wamid, attempt, error_codes):
+    """Re-send a payload that Meta reported as failed, or dead-letter it"""
+    try:
+        payload_json = redis_client.hget(f"send_ledger:{wamid}", 'payload')
+        if not payload_json:
+            return
+        payload = json.loads(payload_json)
+        if attempt >= SEND_STATUS_MAX_RETRIES or not (error_codes & GRAPH_RETRYABLE_STATUS_CODES):
+            dead_letter_send(payload, f"failed_status:{','.join(str(code) for code in error_codes)}")
+            return
+        time.sleep(send_backoff_delay(attempt))
+        graph_post(payload, phone_id, ledger_attempt=attempt + 1, retry_of=wamid)
+    except Exception as e:
+        logging.error(f"Failed to retry send {wamid}: {e}")
+
+def get_delivery_stats():
+    """Average latencies (seconds) and counts per message type"""
+    raw = redis_client.hgetall(DELIVERY_STATS_KEY) or {}
+    stats = {}
+    for message_type in redis_client.smembers(f"{DELIVERY_STATS_KEY}:types") or []:
+        delivered = int(raw.get(f"{message_type}:delivered", 0))
+        delivered_to_read = int(raw.get(f"{message_type}:delivered_to_read", 0))
+        stats[message_type] = {
+            'delivered': delivered,
+            'read': int(raw.get(f"{message_type}:read", 0)),
+            'failed': int(raw.get(f"{message_type}:failed", 0)),
+            'avg_send_to_delivered': round(float(raw.get(f"{message_type}:send_to_delivered_total", 0)) / delivered, 3) if delivered else None,
+            'avg_delivered_to_read': round(float(raw.get(f"{message_type}:delivered_to_read_total", 0)) / delivered_to_read, 3) if delivered_to_read else None,
+        }
+    return stats
+
+def send_message(text, recipient, phone_id):
     if len(text) > 3000:
         parts = [text[i:i+3000] for i in range(0, len(text), 3000)]
         for part in parts:
@@ -268,7 +1905,7 @@ def send_message(text, recipient, phone_id):
                 "text": {"body": part}
             }
             try:
-                requests.post(url, headers=headers, json=data)
+                graph_post(data, phone_id)
             except requests.exceptions.RequestException as e:
                 logging.error(f"Failed to send message: {e}")
         return
@@ -280,7 +1917,7 @@ def send_message(text, recipient, phone_id):
         "text": {"body": text}
     }
     try:
-        response = requests.post(url, headers=headers, json=data)
+        response = graph_post(data, phone_id)
         response.raise_for_status()
         # Log outgoing text
         try:
@@ -291,12 +1928,6 @@ def send_message(text, recipient, phone_id):
         logging.error(f"Failed to send message: {e}")
 
 def send_button_message(text, buttons, recipient, phone_id):
-    url = f"https://graph.facebook.com/v19.0/{phone_id}/messages"
-    headers = {
-        'Authorization': f'Bearer {wa_token}',
-        'Content-Type': 'application/json'
-    }
-    
     # Validate recipient phone number
     if not recipient or not recipient.strip():
         print(f"Invalid recipient: {recipient}")
@@ -389,7 +2020,7 @@ def send_button_message(text, buttons, recipient, phone_id):
     
     try:
         print(f"Sending button message to {recipient}: {data}")
-        response = requests.post(url, headers=headers, json=data)
+        response = graph_post(data, phone_id)
         response.raise_for_status()
         print(f"Button message sent successfully to {recipient}")
         try:
@@ -415,18 +2046,16 @@ def send_button_message(text, buttons, recipient, phone_id):
             except:
                 print("Could not parse error response as JSON")
         
+        # Only a rejected interactive message is worth resending as text; after
+        # a network error or an outage the text would fail the same way
+        if getattr(e, 'response', None) is None or is_retryable_send_error(e.response):
+            return False
         # Fallback to simple text message
         fallback_text = f"{text}\n\n" + "\n".join(f"- {btn.get('title', 'Option')}" for btn in buttons[:3])
         send_message(fallback_text, recipient, phone_id)
         return False
 
 def send_list_message(text, options, recipient, phone_id):
-    url = f"https://graph.facebook.com/v19.0/{phone_id}/messages"
-    headers = {
-        'Authorization': f'Bearer {wa_token}',
-        'Content-Type': 'application/json'
-    }
-    
     # Validate and prepare the list items
     formatted_rows = []
     for i, option in enumerate(options[:10]):  # WhatsApp allows max 10 items
@@ -466,7 +2095,7 @@ def send_list_message(text, options, recipient, phone_id):
     }
     
     try:
-        response = requests.post(url, headers=headers, json=payload)
+        response = graph_post(payload, phone_id)
         response.raise_for_status()
         logging.info(f"List message sent successfully to {recipient}")
         try:
@@ -477,6 +2106,8 @@ def send_list_message(text, options, recipient, phone_id):
     except requests.exceptions.HTTPError as e:
         error_detail = f"Status: {e.response.status_code}, Response: {e.response.text}"
         logging.error(f"Failed to send list message: {error_detail}")
+        if is_retryable_send_error(e.response):
+            return False
         # Fallback to simple message if list fails
         fallback_msg = f"{text}\n\n" + "\n".join(f"{i+1}. {opt}" for i, opt in enumerate(options[:10]))
         send_message(fallback_msg, recipient, phone_id)
@@ -485,6 +2116,1140 @@ def send_list_message(text, options, recipient, phone_id):
         logging.error(f"Unexpected error sending list message: {str(e)}")
         return False
 
+# Owner notifications
+# Notifications for the owner are queued in Redis instead of being sent inside
+# the customer's turn. Events with the same group (an order number) are
+# combined into one card: order, design and payment arrive together. Cards are
+# sent once the group has been quiet for OWNER_COALESCE_SECONDS, or collected
+# into a single digest every OWNER_DIGEST_INTERVAL seconds in digest mode.
+# Urgent event types skip the queue but are still sent off the customer path.
+OWNER_NOTIFY_MODE = os.environ.get("OWNER_NOTIFY_MODE", "coalesce")  # coalesce | digest | immediate
+OWNER_COALESCE_SECONDS = int(os.environ.get("OWNER_COALESCE_SECONDS", "60"))
+OWNER_DIGEST_INTERVAL = int(os.environ.get("OWNER_DIGEST_INTERVAL", "3600"))
+OWNER_FLUSH_INTERVAL = int(os.environ.get("OWNER_FLUSH_INTERVAL", "15"))
+OWNER_URGENT_EVENTS = set(filter(None, os.environ.get("OWNER_URGENT_EVENTS", "callback").split(",")))
+OWNER_PENDING_KEY = "owner_pending"
+OWNER_EVENT_TTL = 604800  # 7 days
+
+# KEYS: pending groups, group's events. ARGV: group
+# Takes the group and its events in one step, so nothing pushed meanwhile is lost;
+# returns nothing if another worker claimed it first
+CLAIM_OWNER_GROUP_SCRIPT = """
+if redis.call('ZREM', KEYS[1], ARGV[1]) == 0 then
+    return {}
+end
+local events = redis.call('LRANGE', KEYS[2], 0, -1)
+redis.call('DEL', KEYS[2])
+return events
+"""
+
+_owner_flusher_started = False
+_owner_flusher_lock = threading.Lock()
+
+def notify_owner(event, text, group=None, image_id=None, urgent=None):
+    """Queue a notification for the owner. Returns without waiting on the Graph API."""
+    if not owner_phone:
+        return
+    entry = {'event': event, 'text': text.strip(), 'image_id': image_id, 'timestamp': datetime.now().isoformat()}
+    if urgent is None:
+        urgent = event in OWNER_URGENT_EVENTS
+
+    if urgent or OWNER_NOTIFY_MODE == 'immediate':
+        run_in_background(send_owner_card, [entry])
+        return
+
+    group = group or f"{event}:{entry['timestamp']}"
+    try:
+        pipeline = redis_client.pipeline()
+        pipeline.rpush(f"owner_events:{group}", json.dumps(entry))
+        pipeline.expire(f"owner_events:{group}", OWNER_EVENT_TTL)
+        pipeline.zadd(OWNER_PENDING_KEY, {group: time.time()})
+        pipeline.exec()
+    except Exception as e:
+        # Don't lose the notification if the queue is unavailable
+        logging.error(f"Failed to queue owner notification, sending directly: {e}")
+        run_in_background(send_owner_card, [entry])
+        return
+    ensure_owner_flusher()
+
+def send_owner_card(entries):
+    """Send one combined message for a group of events, then its images in order"""
+    send_message("\n\n──────────\n\n".join(entry['text'] for entry in entries), owner_phone, phone_id)
+    for entry in entries:
+        if entry.get('image_id'):
+            # Caption each image with its event's heading so it can be told apart
+            caption = entry['text'].splitlines()[0] if entry['text'] else None
+            send_media_by_id('image', entry['image_id'], owner_phone, phone_id, caption=caption)
+
+def claim_owner_groups(cutoff):
+    """Take every group last touched before the cutoff, with its events, off the queue"""
+    groups = redis_client.zrange(OWNER_PENDING_KEY, '-inf', cutoff, sortby='BYSCORE')
+    claimed = []
+    for group in groups:
+        events = redis_client.eval(CLAIM_OWNER_GROUP_SCRIPT, [OWNER_PENDING_KEY, f"owner_events:{group}"], [group])
+        if events:
+            claimed.append((group, [json.loads(event) for event in events]))
+    return claimed
+
+def flush_owner_notifications(force=False):
+    """Send due owner cards (coalesce mode) or the digest when it is due. Returns cards sent."""
+    if not owner_phone:
+        return 0
+    now = time.time()
+
+    if OWNER_NOTIFY_MODE == 'digest':
+        if not force and not redis_client.set("owner_digest:lock", int(now), nx=True, ex=OWNER_DIGEST_INTERVAL):
+            return 0
+        claimed = claim_owner_groups(now)
+        if not claimed:
+            return 0
+        header = f"🗂️ *NOTIFICATION DIGEST* 🗂️\n\n{len(claimed)} update(s) since the last digest."
+        send_message(header, owner_phone, phone_id)
+    else:
+        claimed = claim_owner_groups(now if force else now - OWNER_COALESCE_SECONDS)
+
+    for group, entries in claimed:
+        send_owner_card(entries)
+    return len(claimed)
+
+def owner_flusher_loop():
+    while True:
+        time.sleep(OWNER_FLUSH_INTERVAL)
+        try:
+            flush_owner_notifications()
+        except Exception as e:
+            logging.error(f"Owner notification flush failed: {e}")
+
+def ensure_owner_flusher():
+    """Start the in-process flusher once; cron covers deployments without long-lived processes"""
+    global _owner_flusher_started
+    if _owner_flusher_started:
+        return
+    with _owner_flusher_lock:
+        if not _owner_flusher_started:
+            threading.Thread(target=owner_flusher_loop, daemon=True).start()
+            _owner_flusher_started = True
+
+
+# Production schedule
+# Due dates are parsed (day first) when the customer gives them, and confirmed
+# orders are indexed in one sorted set per collection point scored by their due
+# timestamp. The bake sheet for any window is a score range on each set plus
+# one MGET of the orders, without scanning order:* keys.
+BRANCHES = ('harare', 'bulawayo')
+BAKERY_TZ = timezone(timedelta(hours=float(os.environ.get("BAKERY_UTC_OFFSET", "2"))))
+DUE_INDEX_RETENTION = 30 * 86400   # drop index entries this long after they were due
+ORDER_TTL = 604800                 # orders are kept at least a week, and a week past their due date
+BAKE_SUMMARY_OFFSET_DAYS = int(os.environ.get("BAKE_SUMMARY_OFFSET_DAYS", "1"))
+
+MONTHS = {
+    name: number for number, names in enumerate([
+        ('jan', 'january'), ('feb', 'february'), ('mar', 'march'), ('apr', 'april'),
+        ('may',), ('jun', 'june'), ('jul', 'july'), ('aug', 'august'),
+        ('sep', 'sept', 'september'), ('oct', 'october'), ('nov', 'november'), ('dec', 'december'),
+    ], 1) for name in names
+}
+WEEKDAYS = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+
+def bakery_today():
+    return datetime.now(BAKERY_TZ).date()
+
+def parse_year(text, day, month, today):
+    """Explicit year (2 or 4 digits), or the next time this day and month come round"""
+    if text:
+        year = int(text)
+        return year + 2000 if year < 100 else year
+    year = today.year
+    try:
+        if date(year, month, day) < today:
+            year += 1
+    except ValueError:
+        pass
+    return year
+
+def parse_due_date(text, today=None):
+    """Read a due date, day first: "12/09/2025", "12 Sept", "Sept 12th", "tomorrow", "next friday".
+    Returns a date or None."""
+    today = today or bakery_today()
+    text = re.sub(r'(\d)(st|nd|rd|th)\b', r'\1', (text or '').strip().lower().replace(',', ' '))
+    text = re.sub(r'\s+', ' ', text).replace(' of ', ' ')
+    # A weekday in front of a full date adds nothing: "fri 12/09"
+    text = re.sub(r'^(mon|tue|wed|thu|fri|sat|sun)[a-z]* (?=\d)', '', text)
+
+    if text == 'today':
+        return today
+    if text in ('tomorrow', 'tmrw', 'tmr'):
+        return today + timedelta(days=1)
+    match = re.fullmatch(r'in (\d+) days?', text)
+    if match:
+        return today + timedelta(days=int(match.group(1)))
+    match = re.fullmatch(r'(?:(?:next|this|on) )?(mon|tue|wed|thu|fri|sat|sun)[a-z]*', text)
+    if match:
+        days_ahead = (WEEKDAYS.index(match.group(1)) - today.weekday()) % 7 or 7
+        return today + timedelta(days=days_ahead)
+
+    match = re.fullmatch(r'(\d{1,2})[/.\- ](\d{1,2})(?:[/.\- ](\d{2}|\d{4}))?', text)
+    if match:
+        day, month, year = int(match.group(1)), int(match.group(2)), match.group(3)
+    else:
+        match = (re.fullmatch(r'(?P<day>\d{1,2}) (?P<month>[a-z]+)\.?(?: (?P<year>\d{2}|\d{4}))?', text)
+                 or re.fullmatch(r'(?P<month>[a-z]+)\.? (?P<day>\d{1,2})(?: (?P<year>\d{2}|\d{4}))?', text))
+        if not match or match.group('month') not in MONTHS:
+            return None
+        day, month, year = int(match.group('day')), MONTHS[match.group('month')], match.group('year')
+    try:
+        return date(parse_year(year, day, month, today), month, day)
+    except ValueError:
+        return None
+
+def parse_due_time(text):
+    """Read a time of day: "2pm", "2:30 pm", "14:00", "1400hrs", "noon". Returns (hour, minute) or None."""
+    text = (text or '').strip().lower().replace('a.m.', 'am').replace('p.m.', 'pm').replace('.', ':')
+    if text in ('noon', 'midday', 'lunchtime'):
+        return 12, 0
+    match = (re.fullmatch(r'(\d{1,2})(?:[:h](\d{2}))? ?(am|pm)?(?: ?(?:hrs|hours|h))?', text)
+             or re.fullmatch(r'(\d{2})(\d{2}) ?(?:hrs|hours|h)()', text))
+    if not match:
+        return None
+    hour, minute, meridiem = int(match.group(1)), int(match.group(2) or 0), match.group(3)
+    if meridiem:
+        if not 1 <= hour <= 12:
+            return None
+        hour = hour % 12 + (12 if meridiem == 'pm' else 0)
+    if hour > 23 or minute > 59:
+        return None
+    return hour, minute
+
+def parse_branch(text):
+    """The collection point named in the text, or None"""
+    text = (text or '').lower()
+    for branch in BRANCHES:
+        if branch in text:
+            return branch
+    return None
+
+def due_timestamp(user):
+    """Due date and time of an order draft as a timestamp, or None if the date can't be read"""
+    try:
+        due_date = datetime.strptime(user.due_date or '', '%d/%m/%Y').date()
+    except ValueError:
+        # Drafts started before due dates were normalised
+        due_date = parse_due_date(user.due_date)
+    if not due_date:
+        return None
+    hour, minute = parse_due_time(user.due_time) or (0, 0)
+    return datetime(due_date.year, due_date.month, due_date.day, hour, minute, tzinfo=BAKERY_TZ).timestamp()
+
+def due_index_key(branch):
+    return f"due_orders:{branch}"
+
+def order_ttl(due_at):
+    if not due_at:
+        return ORDER_TTL
+    return max(ORDER_TTL, int(due_at - time.time()) + ORDER_TTL)
+
+def index_due_order(pipeline, order_number, due_at, branch):
+    """Queue the index write (and pruning of long-past entries) on a pipeline"""
+    if not (due_at and branch):
+        return
+    pipeline.zadd(due_index_key(branch), {order_number: due_at})
+    pipeline.zremrangebyscore(due_index_key(branch), 0, time.time() - DUE_INDEX_RETENTION)
+
+def get_bake_sheet(start, end, branches=None):
+    """Orders due in [start, end], earliest first, from the due index"""
+    indexed = []
+    for branch in branches or BRANCHES:
+        indexed += redis_client.zrange(due_index_key(branch), start, end, sortby='BYSCORE')
+    if not indexed:
+        return []
+
+    orders = []
+    for raw in redis_client.mget(*[f"order:{order_number}" for order_number in indexed]):
+        if not raw:
+            continue  # expired or removed since it was indexed
+        order = json.loads(raw)
+        if order.get('status') != 'cancelled':
+            orders.append(order)
+    return sorted(orders, key=lambda order: order.get('due_at') or 0)
+
+def day_window(day, days=1):
+    start = datetime(day.year, day.month, day.day, tzinfo=BAKERY_TZ).timestamp()
+    return start, start + days * 86400 - 1
+
+def format_bake_sheet(day, orders):
+    lines = [f"🧁 *Bake sheet for {day.strftime('%a %d %b')}* 🧁"]
+    for branch in BRANCHES:
+        branch_orders = [order for order in orders if order.get('branch') == branch]
+        lines += ["", f"*{branch.title()}* ({len(branch_orders)} order{'' if len(branch_orders) == 1 else 's'})"]
+        for order in branch_orders:
+            user = order.get('user', {})
+            if parse_due_time(user.get('due_time')):
+                due = datetime.fromtimestamp(order['due_at'], BAKERY_TZ).strftime('%H:%M')
+            else:
+                due = user.get('due_time') or 'Any time'
+            item = order.get('selected_item') or 'Custom Cake'
+            details = ", ".join(part for part in [user.get('flavor'), user.get('theme')] if part)
+            if details:
+                item = f"{item} ({details})"
+            lines.append(f"• {due} - {item} - #{order['order_number']}")
+    return "\n".join(lines)
+
+def send_bake_summary(day=None, force=False):
+    """Send the owner the bake sheet for `day` once. Returns the number of orders, or None if already sent."""
+    day = day or bakery_today() + timedelta(days=BAKE_SUMMARY_OFFSET_DAYS)
+    if not force and not redis_client.set(f"bake_summary_sent:{day.isoformat()}", 1, nx=True, ex=2 * 86400):
+        return None
+    orders = get_bake_sheet(*day_window(day))
+    if owner_phone:
+        send_message(format_bake_sheet(day, orders), owner_phone, phone_id)
+    return len(orders)
+
+
+# Production capacity
+# Each collection point has a number of production slots a day (from the
+# catalog) and an order takes its item's weight in slots. Used slots are one
+# counter per branch and day, so checking a date is a single GET and finding
+# the nearest open dates a single MGET. Confirming an order reserves its slots
+# in a Lua script, atomically across workers; cancelling gives them back.
+CAPACITY_SEARCH_DAYS = 14
+CAPACITY_SUGGESTIONS = 3
+
+# KEYS: counter, holds. ARGV: order number, weight, slots, ttl.
+# Returns the slots used after reserving, or -1 if the day is full.
+# Reserving twice for the same order is a no-op.
+RESERVE_CAPACITY_SCRIPT = """
+local used = tonumber(redis.call('GET', KEYS[1]) or '0')
+if redis.call('SISMEMBER', KEYS[2], ARGV[1]) == 1 then
+    return used
+end
+if used + tonumber(ARGV[2]) > tonumber(ARGV[3]) then
+    return -1
+end
+used = redis.call('INCRBY', KEYS[1], ARGV[2])
+redis.call('SADD', KEYS[2], ARGV[1])
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+redis.call('EXPIRE', KEYS[2], ARGV[4])
+return used
+"""
+
+# KEYS: counter, holds. ARGV: order number, weight. Returns 1 if slots were given back.
+RELEASE_CAPACITY_SCRIPT = """
+if redis.call('SREM', KEYS[2], ARGV[1]) == 0 then
+    return 0
+end
+redis.call('DECRBY', KEYS[1], ARGV[2])
+return 1
+"""
+
+def capacity_key(branch, day):
+    return f"capacity:{branch}:{day.isoformat()}"
+
+def branch_slots(branch):
+    return get_catalog().capacity['slots'].get(branch, 0)
+
+def earliest_due_at():
+    return datetime.now(BAKERY_TZ) + timedelta(hours=get_catalog().capacity['lead_hours'])
+
+def nearest_available_dates(branch, day, weight):
+    """Up to CAPACITY_SUGGESTIONS bookable dates closest to `day`"""
+    first = max(earliest_due_at().date(), day - timedelta(days=CAPACITY_SEARCH_DAYS // 2))
+    candidates = [first + timedelta(days=offset) for offset in range(CAPACITY_SEARCH_DAYS)]
+    used = redis_client.mget(*[capacity_key(branch, candidate) for candidate in candidates])
+    slots = branch_slots(branch)
+    open_days = [
+        candidate for candidate, count in zip(candidates, used)
+        if candidate != day and int(count or 0) + weight <= slots
+    ]
+    return sorted(open_days, key=lambda candidate: (abs((candidate - day).days), candidate))[:CAPACITY_SUGGESTIONS]
+
+def date_unavailable_message(branch, day, selected_item, cake_type=None):
+    """Why `day` can't be booked at `branch`, with the nearest open dates, or None if it can"""
+    catalog = get_catalog()
+    weight = catalog.order_weight(selected_item, cake_type)
+    if day < earliest_due_at().date():
+        reason = f"We need at least {catalog.capacity['lead_hours']} hours to make your cake, so we can't have it ready on {day:%d/%m/%Y}."
+    elif branch and int(redis_client.get(capacity_key(branch, day)) or 0) + weight > branch_slots(branch):
+        reason = f"Sorry, our {branch.title()} kitchen is fully booked on {day:%d/%m/%Y}."
+    else:
+        return None
+
+    suggestions = nearest_available_dates(branch, day, weight) if branch else []
+    if not suggestions:
+        return f"{reason} Please send another date, e.g 12/09/2025"
+    dates = "\n".join(f"• {suggestion:%a %d/%m/%Y}" for suggestion in suggestions)
+    return f"{reason}\n\nThe nearest available dates are:\n{dates}\n\nPlease send the date you'd like:"
+
+def reserve_order_capacity(order_number, branch, due_at, selected_item, cake_type=None):
+    """Reserve slots for an order. Returns the reservation, or None if the day is full."""
+    day = datetime.fromtimestamp(due_at, BAKERY_TZ).date()
+    weight = get_catalog().order_weight(selected_item, cake_type)
+    key = capacity_key(branch, day)
+    ttl = max(86400, int(due_at - time.time()) + 7 * 86400)
+    used = redis_client.eval(RESERVE_CAPACITY_SCRIPT, [key, f"{key}:holds"], [order_number, weight, branch_slots(branch), ttl])
+    if int(used) < 0:
+        return None
+    return {'branch': branch, 'day': day.isoformat(), 'weight': weight}
+
+def release_order_capacity(order_number, reservation):
+    """Give back an order's slots. Returns False if they were already released."""
+    key = capacity_key(reservation['branch'], date.fromisoformat(reservation['day']))
+    return bool(redis_client.eval(RELEASE_CAPACITY_SCRIPT, [key, f"{key}:holds"], [order_number, reservation['weight']]))
+
+def cancel_order(order_number):
+    """Mark an order cancelled, release its capacity and drop it from the bake sheet.
+    Returns the updated order, or None if it doesn't exist."""
+    return set_order_status(order_number, 'cancelled')
+
+
+# Order lifecycle
+# Staff move orders through ORDER_STATUSES. Every order sits in one sorted set
+# per status, and in the same set for its collection point, scored by due time
+# (creation time if it has none). A listing is one ZRANGE BYSCORE on one set
+# plus an MGET of the page, so staff never trigger a scan of order:* keys.
+ORDER_STATUSES = ('pending', 'confirmed', 'baking', 'ready', 'collected', 'cancelled')
+FINAL_ORDER_STATUSES = ('collected', 'cancelled')
+ORDER_PAGE_LIMIT = 100
+
+# Sent to the customer when staff ask for the update to be pushed
+ORDER_STATUS_MESSAGES = {
+    'confirmed': "✅ Your order {order_number} has been confirmed by our team.",
+    'baking': "👩‍🍳 Your cake for order {order_number} is in the oven!",
+    'ready': "🎂 Your order {order_number} is ready for collection at our {branch} shop.",
+    'collected': "Thank you for collecting order {order_number}! Enjoy your cake 🎉",
+    'cancelled': "Your order {order_number} has been cancelled. Please contact us if you have any questions.",
+}
+
+def order_status_keys(status, branch=None):
+    keys = [f"orders_by_status:{status}"]
+    if branch:
+        keys.append(f"orders_by_status:{status}:{branch}")
+    return keys
+
+def order_created_at(order):
+    try:
+        return datetime.fromisoformat(order['timestamp']).timestamp()
+    except (KeyError, TypeError, ValueError):
+        return 0
+
+def order_score(order):
+    return order.get('due_at') or order_created_at(order)
+
+def index_order_status(pipeline, order, previous_status=None):
+    """Queue the moves between status sets for an order on a pipeline"""
+    if previous_status:
+        for key in order_status_keys(previous_status, order.get('branch')):
+            pipeline.zrem(key, order['order_number'])
+    for key in order_status_keys(order.get('status', 'pending'), order.get('branch')):
+        pipeline.zadd(key, {order['order_number']: order_score(order)})
+
+# KEYS: order, then the sets to leave, then the sets to join.
+# ARGV: order as read, updated order, order number, score, number of sets to leave
+# Saves the update, moving the order between index sets, only if nobody has
+# changed the order since it was read; returns 1 if saved
+UPDATE_ORDER_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[2], 'KEEPTTL')
+local leave = tonumber(ARGV[5])
+for i = 2, leave + 1 do
+    redis.call('ZREM', KEYS[i], ARGV[3])
+end
+for i = leave + 2, #KEYS do
+    redis.call('ZADD', KEYS[i], ARGV[4], ARGV[3])
+end
+return 1
+"""
+ORDER_UPDATE_ATTEMPTS = 5
+
+def save_order_update(order_number, raw, order, leave=(), join=()):
+    """Save an order read as `raw`, unless it has changed since. Returns True if saved."""
+    return bool(redis_client.eval(
+        UPDATE_ORDER_SCRIPT,
+        [f"order:{order_number}", *leave, *join],
+        [raw, json.dumps(order), order_number, order_score(order), len(leave)],
+    ))
+
+def find_order_number(text):
+    """The stored order a staff member's typed-in number refers to, else its canonical form"""
+    candidates = order_number_candidates(text)
+    for candidate in candidates:
+        if redis_client.exists(f"order:{candidate}"):
+            return candidate
+    return candidates[-1]
+
+def order_customer(order):
+    """The WhatsApp number the order was placed from"""
+    return order.get('customer') or normalize_phone_number(order.get('user', {}).get('phone'))
+
+def set_order_status(order_number, status, note=None, author=None, notify=False):
+    """Move an order to `status`. Returns the updated order, or None if it doesn't exist.
+    Raises ValueError for an unknown status or a change to a finished order."""
+    if status not in ORDER_STATUSES:
+        raise ValueError(f"Unknown status '{status}'")
+    for _ in range(ORDER_UPDATE_ATTEMPTS):
+        raw = redis_client.get(f"order:{order_number}")
+        if not raw:
+            return None
+        order = json.loads(raw)
+        previous = order.get('status', 'pending')
+        if previous == status:
+            return order
+        if previous in FINAL_ORDER_STATUSES:
+            raise ValueError(f"Order is already {previous}")
+
+        now = datetime.now().isoformat()
+        order['status'] = status
+        order.setdefault('history', []).append({'status': status, 'at': now, 'by': author})
+        if note:
+            order.setdefault('notes', []).append({'text': note, 'at': now, 'by': author})
+        leave = order_status_keys(previous, order.get('branch'))
+        if status == 'cancelled' and order.get('branch'):
+            leave.append(due_index_key(order['branch']))
+        if save_order_update(order_number, raw, order, leave, order_status_keys(status, order.get('branch'))):
+            break
+    else:
+        raise ValueError("Order is being changed by someone else; please try again")
+
+    if status == 'cancelled' and order.get('capacity'):
+        release_order_capacity(order_number, order['capacity'])
+    pipeline = redis_client.pipeline()
+    queue_persist(pipeline, 'order', order)
+    pipeline.exec()
+
+    if notify and order_customer(order):
+        send_message(
+            ORDER_STATUS_MESSAGES[status].format(order_number=order_number, branch=(order.get('branch') or '').title()),
+            order_customer(order),
+            phone_id
+        )
+    return order
+
+def add_order_note(order_number, text, author=None):
+    """Raises ValueError if the order keeps changing under the note"""
+    for _ in range(ORDER_UPDATE_ATTEMPTS):
+        raw = redis_client.get(f"order:{order_number}")
+        if not raw:
+            return None
+        order = json.loads(raw)
+        order.setdefault('notes', []).append({'text': text, 'at': datetime.now().isoformat(), 'by': author})
+        if save_order_update(order_number, raw, order):
+            break
+    else:
+        raise ValueError("Order is being changed by someone else; please try again")
+    pipeline = redis_client.pipeline()
+    queue_persist(pipeline, 'order', order)
+    pipeline.exec()
+    return order
+
+def list_orders(status, branch=None, start=None, end=None, cursor=None, limit=20):
+    """One page of orders in a status, by due time. Returns (orders, next cursor or None)."""
+    return read_order_page(order_status_keys(status, branch)[-1], start, end, cursor, limit)
+
+def read_order_page(key, start=None, end=None, cursor=None, limit=20):
+    """One page of the orders in a sorted-set index, in score order, fetched with one MGET.
+    The cursor is "score:skip": resume at that score, past the first `skip` orders holding it."""
+    low, skip = (start or 0), 0
+    if cursor:
+        cursor_score, skip = cursor.split(':')
+        low, skip = float(cursor_score), int(skip)
+    high = end if end is not None else '+inf'
+
+    page = redis_client.zrange(key, low, high, sortby='BYSCORE', offset=skip, count=limit, withscores=True)
+    if not page:
+        return [], None
+
+    numbers = [number for number, _ in page]
+    found = {
+        number: json.loads(raw)
+        for number, raw in zip(numbers, redis_client.mget(*[f"order:{number}" for number in numbers])) if raw
+    }
+    missing = [number for number in numbers if number not in found]
+    if missing:
+        # Redis has let these orders go; SQL keeps them. Without SQL they are
+        # skipped here and pruned from the indexes by reindex_orders.
+        found.update(load_sql_orders(missing))
+    orders = [found[number] for number in numbers if number in found]
+
+    next_cursor = None
+    if len(page) == limit:
+        last_score = page[-1][1]
+        ties = sum(1 for _, score in page if score == last_score)
+        # A page that never left the cursor's score also skips what that cursor skipped
+        next_cursor = f"{last_score}:{ties + (skip if last_score == low else 0)}"
+    return orders, next_cursor
+
+def reindex_orders():
+    """Add orders saved before the status and time indexes existed. Scans order:* once.
+    Without SQL, also drops index entries whose order has expired from Redis."""
+    cursor, indexed = 0, 0
+    while True:
+        cursor, keys = redis_client.scan(cursor, match="order:*", count=100)
+        if keys:
+            pipeline = redis_client.pipeline()
+            for raw in redis_client.mget(*keys):
+                if raw:
+                    order = json.loads(raw)
+                    index_order_status(pipeline, order)
+                    index_order_time(pipeline, order)
+                    indexed += 1
+            pipeline.exec()
+        if cursor == 0:
+            break
+    if not sql_enabled():
+        for branch in (None,) + BRANCHES:
+            prune_order_index(order_time_key(branch))
+            for status in ORDER_STATUSES:
+                prune_order_index(order_status_keys(status, branch)[-1])
+    return indexed
+
+def prune_order_index(key):
+    """Drop the orders in an index that are no longer in Redis. Returns how many were dropped."""
+    pruned, offset = 0, 0
+    while True:
+        numbers = redis_client.zrange(key, offset, offset + EXPORT_BATCH_SIZE - 1)
+        if not numbers:
+            return pruned
+        pipeline = redis_client.pipeline()
+        for number in numbers:
+            pipeline.exists(f"order:{number}")
+        missing = [number for number, exists in zip(numbers, pipeline.exec()) if not exists]
+        if missing:
+            redis_client.zrem(key, *missing)
+            pruned += len(missing)
+        offset += len(numbers) - len(missing)
+
+
+# Order export
+# Orders are also indexed by when they were placed, overall and per branch.
+# An export walks that index a batch at a time: one ZRANGE, one MGET for the
+# orders and one pipeline checking which have stored images. Rows are written
+# to the response as they are produced, so memory stays flat however many
+# orders match.
+ORDERS_BY_TIME_KEY = "orders_by_time"
+EXPORT_BATCH_SIZE = 200
+# Setting IMAGE_LINK_SECRET locks /api/image down: it then needs an export's
+# signed link or the API token. Unset, image URLs stay public as they always were.
+IMAGE_LINK_SECRET = os.environ.get("IMAGE_LINK_SECRET")
+IMAGE_LINK_TTL = int(os.environ.get("IMAGE_LINK_TTL", str(7 * 86400)))
+STORED_IMAGE_TYPES = ('design', 'payment')
+EXPORT_COLUMNS = [
+    'order_number', 'placed_at', 'status', 'branch', 'due_date', 'due_time', 'item', 'total',
+    'customer', 'contact_name', 'contact_number', 'email', 'flavor', 'theme', 'colors', 'message',
+    'special_requests', 'payment_method', 'notes', 'design_image_url', 'payment_image_url',
+]
+
+def order_time_key(branch=None):
+    return f"{ORDERS_BY_TIME_KEY}:{branch}" if branch else ORDERS_BY_TIME_KEY
+
+def index_order_time(pipeline, order):
+    created_at = order_created_at(order)
+    pipeline.zadd(order_time_key(), {order['order_number']: created_at})
+    if order.get('branch'):
+        pipeline.zadd(order_time_key(order['branch']), {order['order_number']: created_at})
+
+def image_link_signature(order_number, image_type, expires):
+    message = f"{order_number}:{image_type}:{expires}".encode()
+    return hmac.new(IMAGE_LINK_SECRET.encode(), message, hashlib.sha256).hexdigest()
+
+def signed_image_link(base_url, order_number, image_type):
+    """A link to serve_stored_image that works without the API token until it expires"""
+    url = f"{base_url}/api/image/{order_number}/{image_type}"
+    if not IMAGE_LINK_SECRET:
+        return url
+    expires = int(time.time()) + IMAGE_LINK_TTL
+    return f"{url}?expires={expires}&sig={image_link_signature(order_number, image_type, expires)}"
+
+def image_link_valid(order_number, image_type, expires, signature):
+    if not IMAGE_LINK_SECRET:
+        return True
+    try:
+        if int(expires) < time.time():
+            return False
+    except (TypeError, ValueError):
+        return False
+    return hmac.compare_digest(signature or '', image_link_signature(order_number, image_type, expires))
+
+def iter_export_orders(start=None, end=None, branch=None, status=None, with_images=False):
+    """Yield (order, stored image types) for orders placed in [start, end], oldest first"""
+    cursor = None
+    while True:
+        orders, cursor = read_order_page(order_time_key(branch), start, end, cursor, EXPORT_BATCH_SIZE)
+        if status:
+            orders = [order for order in orders if order.get('status', 'pending') == status]
+        stored = [()] * len(orders)
+        if with_images and orders:
+            pipeline = redis_client.pipeline()
+            for order in orders:
+                for image_type in STORED_IMAGE_TYPES:
+                    pipeline.exists(f"{image_type}_data:{order['order_number']}")
+            found = pipeline.exec()
+            stored = [
+                tuple(t for j, t in enumerate(STORED_IMAGE_TYPES) if found[i * len(STORED_IMAGE_TYPES) + j])
+                for i in range(len(orders))
+            ]
+        yield from zip(orders, stored)
+        if not cursor:
+            return
+
+def export_row(order, images, base_url):
+    user = order.get('user', {})
+    row = {
+        'order_number': order.get('order_number'),
+        'placed_at': order.get('timestamp'),
+        'status': order.get('status', 'pending'),
+        'branch': order.get('branch') or user.get('collection'),
+        'due_date': user.get('due_date'),
+        'due_time': user.get('due_time'),
+        'item': order.get('selected_item'),
+        'total': order.get('total'),
+        'customer': order_customer(order),
+        'contact_name': user.get('name'),
+        'contact_number': user.get('phone'),
+        'email': user.get('email'),
+        'flavor': user.get('flavor'),
+        'theme': user.get('theme'),
+        'colors': user.get('colors'),
+        'message': user.get('message'),
+        'special_requests': user.get('special_requests'),
+        'payment_method': user.get('payment_method'),
+        'notes': " | ".join(note['text'] for note in order.get('notes', [])),
+    }
+    for image_type in STORED_IMAGE_TYPES:
+        row[f'{image_type}_image_url'] = (
+            signed_image_link(base_url, order['order_number'], image_type) if image_type in images else None
+        )
+    return row
+
+def stream_order_export(rows, export_format):
+    """Encode export rows as CSV (with a header) or NDJSON, one chunk per row"""
+    if export_format == 'ndjson':
+        for row in rows:
+            yield json.dumps(row) + "\n"
+        return
+    buffer = StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_COLUMNS)
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+# Durable storage
+# Redis is the hot store and expires records; SQL keeps them. Writes that
+# should outlive Redis (orders and their status changes, inquiries, callbacks,
+# image metadata) are pushed onto a Redis list in the same round trip as the
+# Redis write, and a background flusher (or the /tasks/persist cron) upserts
+# them into SQL in batches. The customer's turn never waits on the database.
+# SQL is off unless DATABASE_URL is set (e.g. sqlite:///cakefairy.db for local
+# runs); without it nothing is queued and lookups use Redis only.
+#
+# A flusher claims a batch by moving it into a processing list of its own,
+# recorded in PERSIST_CLAIMS_KEY with the claim time, and deletes that list
+# only after the SQL transaction commits. Claims older than
+# PERSIST_CLAIM_LEASE (a flusher that died mid-batch) are put back at the head
+# of the queue; upserts make the repeated write harmless. When a batch fails
+# its entries are retried one by one, so one bad row cannot hold up the rest,
+# and an entry that fails PERSIST_MAX_ATTEMPTS times while the database is
+# reachable goes to PERSIST_DEAD_LETTER_KEY.
+DATABASE_URL = os.environ.get("DATABASE_URL")
+PERSIST_QUEUE_KEY = "persist_queue"
+PERSIST_CLAIMS_KEY = "persist_claims"
+PERSIST_ATTEMPTS_KEY = "persist_attempts"
+PERSIST_DEAD_LETTER_KEY = "persist_dead_letter"
+PERSIST_BATCH_SIZE = 200
+PERSIST_MAX_BATCHES = 50
+PERSIST_MAX_ATTEMPTS = 5
+PERSIST_CLAIM_LEASE = 300
+PERSIST_FLUSH_INTERVAL = int(os.environ.get("PERSIST_FLUSH_INTERVAL", "10"))
+
+# KEYS: queue, claim's processing list, claims. ARGV: batch size, claim id, now
+# Moves up to a batch from the head of the queue into the processing list
+CLAIM_PERSIST_BATCH_SCRIPT = """
+local items = {}
+for i = 1, tonumber(ARGV[1]) do
+    local item = redis.call('LMOVE', KEYS[1], KEYS[2], 'LEFT', 'RIGHT')
+    if not item then
+        break
+    end
+    items[#items + 1] = item
+end
+if #items > 0 then
+    redis.call('ZADD', KEYS[3], ARGV[3], ARGV[2])
+end
+return items
+"""
+
+# KEYS: queue, claim's processing list, claims. ARGV: claim id
+# Puts an abandoned claim's entries back at the head of the queue, in order
+RELEASE_PERSIST_CLAIM_SCRIPT = """
+local items = redis.call('LRANGE', KEYS[2], 0, -1)
+for i = #items, 1, -1 do
+    redis.call('LPUSH', KEYS[1], items[i])
+end
+redis.call('DEL', KEYS[2])
+redis.call('ZREM', KEYS[3], ARGV[1])
+return #items
+"""
+
+_sql = None
+_sql_lock = threading.Lock()
+_persist_flusher_started = False
+_persist_flusher_lock = threading.Lock()
+
+def get_sql():
+    """The engine and tables, created on first use, or None without SQLAlchemy or DATABASE_URL"""
+    global _sql
+    if _sql is not None or sqlalchemy is None or not DATABASE_URL:
+        return _sql
+    with _sql_lock:
+        if _sql is None:
+            from sqlalchemy import Column, DateTime, Index, MetaData, Numeric, String, Table, Text
+            metadata = MetaData()
+            tables = {
+                'orders': Table(
+                    'orders', metadata,
+                    Column('order_number', String(16), primary_key=True),
+                    Column('placed_at', DateTime(timezone=True), index=True),
+                    Column('status', String(16), index=True),
+                    Column('branch', String(16)),
+                    Column('due_at', DateTime(timezone=True)),
+                    Column('customer', String(20), index=True),
+                    Column('item', String(120)),
+                    Column('total', Numeric(10, 2)),
+                    Column('data', Text),  # the order JSON as stored in Redis
+                    Index('ix_orders_branch_due_at', 'branch', 'due_at'),
+                ),
+                'inquiries': Table(
+                    'inquiries', metadata,
+                    Column('id', String(16), primary_key=True),
+                    Column('kind', String(16)),  # cupcake | callback
+                    Column('phone', String(20), index=True),
+                    Column('created_at', DateTime(timezone=True), index=True),
+                    Column('data', Text),
+                ),
+                'images': Table(
+                    'images', metadata,
+                    Column('order_number', String(16), primary_key=True),
+                    Column('image_type', String(16), primary_key=True),
+                    Column('image_id', String(64)),
+                    Column('mime_type', String(32)),
+                    Column('stored_at', DateTime(timezone=True)),
+                ),
+            }
+            engine = sqlalchemy.create_engine(DATABASE_URL.replace("postgres://", "postgresql://", 1), pool_pre_ping=True)
+            metadata.create_all(engine)
+            _sql = dict(tables, engine=engine)
+    return _sql
+
+def sql_datetime(value):
+    """An ISO string or epoch timestamp as an aware datetime"""
+    if not value:
+        return None
+    if isinstance(value, (int, float)):
+        return datetime.fromtimestamp(value, timezone.utc)
+    parsed = datetime.fromisoformat(value)
+    return parsed if parsed.tzinfo else parsed.astimezone()
+
+def order_row(order):
+    return {
+        'order_number': order['order_number'],
+        'placed_at': sql_datetime(order.get('timestamp')),
+        'status': order.get('status', 'pending'),
+        'branch': order.get('branch'),
+        'due_at': sql_datetime(order.get('due_at')),
+        'customer': order_customer(order),
+        'item': (order.get('selected_item') or '')[:120],
+        'total': order.get('total'),
+        'data': json.dumps(order),
+    }
+
+def inquiry_row(inquiry):
+    return {
+        'id': inquiry['id'],
+        'kind': inquiry['kind'],
+        'phone': inquiry.get('phone'),
+        'created_at': sql_datetime(inquiry.get('timestamp')),
+        'data': json.dumps(inquiry),
+    }
+
+def image_row(image):
+    return {
+        'order_number': image['order_number'],
+        'image_type': image['image_type'],
+        'image_id': image.get('image_id'),
+        'mime_type': image.get('mime_type'),
+        'stored_at': sql_datetime(image.get('timestamp')),
+    }
+
+# kind -> (table, row builder, primary key columns)
+PERSIST_KINDS = {
+    'order': ('orders', order_row, ('order_number',)),
+    'inquiry': ('inquiries', inquiry_row, ('id',)),
+    'image': ('images', image_row, ('order_number', 'image_type')),
+}
+
+def sql_enabled():
+    return sqlalchemy is not None and bool(DATABASE_URL)
+
+def queue_persist(pipeline, kind, record):
+    """Queue a record for SQL on a pipeline the caller is about to execute"""
+    if not sql_enabled():
+        return
+    pipeline.rpush(PERSIST_QUEUE_KEY, json.dumps({'kind': kind, 'record': record}))
+    ensure_persist_flusher()
+
+def sql_upsert(connection, table, rows, keys):
+    """Insert rows, replacing any with the same primary key"""
+    updated = [column.name for column in table.columns if column.name not in keys]
+    dialect = connection.dialect.name
+    if dialect in ('postgresql', 'sqlite'):
+        statement = (postgresql if dialect == 'postgresql' else sqlite).insert(table).values(rows)
+        statement = statement.on_conflict_do_update(
+            index_elements=list(keys),
+            set_={name: statement.excluded[name] for name in updated}
+        )
+        connection.execute(statement)
+    elif dialect == 'mysql':
+        statement = mysql.insert(table).values(rows)
+        connection.execute(statement.on_duplicate_key_update({name: statement.inserted[name] for name in updated}))
+    else:
+        for row in rows:
+            connection.execute(table.delete().where(*[table.c[key] == row[key] for key in keys]))
+        connection.execute(table.insert(), rows)
+
+def write_persist_batch(sql, items):
+    """Upsert a batch of queued records in one transaction. Later writes of a record win."""
+    rows = {kind: {} for kind in PERSIST_KINDS}
+    for item in items:
+        try:
+            entry = json.loads(item)
+            table_name, build_row, keys = PERSIST_KINDS[entry['kind']]
+            row = build_row(entry['record'])
+        except Exception as e:
+            logging.error(f"Dropping unreadable persistence entry {item[:200]}: {e}")
+            continue
+        rows[entry['kind']][tuple(row[key] for key in keys)] = row
+
+    with sql['engine'].begin() as connection:
+        for kind, keyed_rows in rows.items():
+            if keyed_rows:
+                table_name, _, keys = PERSIST_KINDS[kind]
+                sql_upsert(connection, sql[table_name], list(keyed_rows.values()), keys)
+
+def persist_claim_key(claim_id):
+    return f"persist_processing:{claim_id}"
+
+def release_persist_claim(claim_id):
+    redis_client.eval(
+        RELEASE_PERSIST_CLAIM_SCRIPT,
+        [PERSIST_QUEUE_KEY, persist_claim_key(claim_id), PERSIST_CLAIMS_KEY],
+        [claim_id],
+    )
+
+def settle_persist_claim(claim_id, retry=(), dead=()):
+    """Finish a claim: requeue entries to retry, dead-letter the rest, drop the processing list"""
+    pipeline = redis_client.multi()
+    if retry:
+        pipeline.lpush(PERSIST_QUEUE_KEY, *reversed(retry))
+    if dead:
+        pipeline.lpush(PERSIST_DEAD_LETTER_KEY, *[json.dumps(entry) for entry in dead])
+        pipeline.hdel(PERSIST_ATTEMPTS_KEY, *[persist_entry_id(entry['entry']) for entry in dead])
+    pipeline.delete(persist_claim_key(claim_id))
+    pipeline.zrem(PERSIST_CLAIMS_KEY, claim_id)
+    pipeline.exec()
+
+def persist_entry_id(item):
+    return hashlib.sha1(item.encode()).hexdigest()[:16]
+
+def sql_reachable(sql):
+    try:
+        with sql['engine'].connect() as connection:
+            connection.execute(sqlalchemy.text('SELECT 1'))
+        return True
+    except Exception:
+        return False
+
+def persist_one_by_one(sql, items):
+    """After a failed batch, write its entries singly. Returns (entries to retry, dead entries)."""
+    failed = []
+    for item in items:
+        try:
+            write_persist_batch(sql, [item])
+        except Exception as e:
+            failed.append((item, e))
+    if not failed:
+        return [], []
+    if len(failed) == len(items) and not sql_reachable(sql):
+        # The database is down, not the entries at fault; don't count it against them
+        return items, []
+    retry, dead = [], []
+    for item, error in failed:
+        if redis_client.hincrby(PERSIST_ATTEMPTS_KEY, persist_entry_id(item), 1) >= PERSIST_MAX_ATTEMPTS:
+            logging.error(f"Dead-lettering persistence entry after {PERSIST_MAX_ATTEMPTS} attempts: {item[:200]}: {error}")
+            dead.append({'entry': item, 'error': str(error)[:500], 'timestamp': datetime.now().isoformat()})
+        else:
+            retry.append(item)
+    return retry, dead
+
+def requeue_abandoned_persist_claims():
+    for claim_id in redis_client.zrange(PERSIST_CLAIMS_KEY, '-inf', time.time() - PERSIST_CLAIM_LEASE, sortby='BYSCORE') or []:
+        logging.warning(f"Requeueing abandoned persistence claim {claim_id}")
+        release_persist_claim(claim_id)
+
+def flush_persist_queue(max_batches=PERSIST_MAX_BATCHES):
+    """Move queued records into SQL. Returns how many queue entries were processed."""
+    sql = get_sql()
+    if not sql:
+        return 0
+    requeue_abandoned_persist_claims()
+    written = 0
+    for _ in range(max_batches):
+        claim_id = ''.join(random.choices(string.ascii_lowercase + string.digits, k=12))
+        items = redis_client.eval(
+            CLAIM_PERSIST_BATCH_SCRIPT,
+            [PERSIST_QUEUE_KEY, persist_claim_key(claim_id), PERSIST_CLAIMS_KEY],
+            [PERSIST_BATCH_SIZE, claim_id, time.time()],
+        )
+        if not items:
+            break
+        try:
+            write_persist_batch(sql, items)
+        except Exception as e:
+            logging.error(f"Persisting {len(items)} records failed, retrying them singly: {e}")
+            retry, dead = persist_one_by_one(sql, items)
+            settle_persist_claim(claim_id, retry, dead)
+            written += len(items) - len(retry)
+            if retry:
+                break
+            continue
+        settle_persist_claim(claim_id)
+        written += len(items)
+    return written
+
+def persist_flusher_loop():
+    while True:
+        time.sleep(PERSIST_FLUSH_INTERVAL)
+        try:
+            flush_persist_queue()
+        except Exception as e:
+            logging.error(f"Persistence flush failed: {e}")
+
+def ensure_persist_flusher():
+    """Start the in-process flusher once; cron covers deployments without long-lived processes"""
+    global _persist_flusher_started
+    if _persist_flusher_started or not sql_enabled():
+        return
+    with _persist_flusher_lock:
+        if not _persist_flusher_started:
+            threading.Thread(target=persist_flusher_loop, daemon=True).start()
+            _persist_flusher_started = True
+
+def load_order(order_number):
+    """An order from Redis, or from SQL once Redis has let it go"""
+    raw = redis_client.get(f"order:{order_number}")
+    if raw:
+        return json.loads(raw)
+    try:
+        sql = get_sql()
+        if not sql:
+            return None
+        orders = sql['orders']
+        with sql['engine'].connect() as connection:
+            data = connection.execute(
+                sqlalchemy.select(orders.c.data).where(orders.c.order_number == order_number)
+            ).scalar()
+    except Exception as e:
+        # An unavailable database must not break the customer's turn
+        logging.error(f"SQL lookup of order {order_number} failed: {e}")
+        return None
+    return json.loads(data) if data else None
+
+def load_sql_orders(order_numbers):
+    """Orders Redis has let go, from SQL, as {order number: order}"""
+    try:
+        sql = get_sql()
+        if not sql:
+            return {}
+        orders = sql['orders']
+        with sql['engine'].connect() as connection:
+            rows = connection.execute(
+                sqlalchemy.select(orders.c.order_number, orders.c.data).where(orders.c.order_number.in_(order_numbers))
+            ).all()
+    except Exception as e:
+        logging.error(f"SQL lookup of {len(order_numbers)} orders failed: {e}")
+        return {}
+    return {number: json.loads(data) for number, data in rows if data}
+
+def latest_sql_order(phones):
+    """The most recent stored order placed from any of these numbers"""
+    if not phones:
+        return None
+    try:
+        sql = get_sql()
+        if not sql:
+            return None
+        orders = sql['orders']
+        with sql['engine'].connect() as connection:
+            data = connection.execute(
+                sqlalchemy.select(orders.c.data)
+                .where(orders.c.customer.in_(phones))
+                .order_by(orders.c.placed_at.desc())
+                .limit(1)
+            ).scalar()
+    except Exception as e:
+        logging.error(f"SQL lookup of orders for {phones} failed: {e}")
+        return None
+    return json.loads(data) if data else None
+
+
+# Process lifecycle
+# Long-running servers (see serve.py) fork workers from a preloaded app, so
+# each worker opens its own connections after the fork rather than sharing the
+# parent's sockets. Sends handed to background threads are tracked so a
+# stopping worker can let them finish, and the in-process flushers get one
+# last run, instead of everything being cut off with the daemon threads.
+_background_threads = set()
+_background_lock = threading.Lock()
+
+def run_in_background(target, *args):
+    """Start target(*args) on a daemon thread that drain_background_work waits for"""
+    def run():
+        try:
+            target(*args)
+        finally:
+            with _background_lock:
+                _background_threads.discard(thread)
+    thread = threading.Thread(target=run, daemon=True)
+    with _background_lock:
+        _background_threads.add(thread)
+    thread.start()
+    return thread
+
+def reset_connections():
+    """Give this process its own Redis client and SQL pool; call after fork"""
+    global redis_client
+    redis_client = make_redis_client()
+    if _sql is not None:
+        _sql['engine'].dispose(close=False)
+
+def drain_background_work(timeout=30):
+    """Let background sends finish, then run the owner and persistence flushers once"""
+    deadline = time.time() + timeout
+    with _background_lock:
+        threads = list(_background_threads)
+    for thread in threads:
+        thread.join(max(0.0, deadline - time.time()))
+    for flush in (flush_owner_notifications, flush_persist_queue, save_unsaved_states):
+        try:
+            flush()
+        except Exception as e:
+            logging.error(f"{flush.__name__} failed during shutdown: {e}")
+
+
 # Handlers
 def handle_welcome(prompt, user_data, phone_id):
     welcome_msg = (
@@ -522,21 +3287,14 @@ def handle_choose_payment(prompt, user_data, phone_id):
         else:
             user.payment_method = prompt
     
-        # Compute price for Cake Fairy Cake with color surcharge
-        selected_item_text = (user_data.get('selected_item') or '').lower()
-        colors_text = (user.colors or '').lower()
-        price_line = ''
-        if 'cake fairy' in selected_item_text:
-            base_price = 20
-            surcharge = 5 if any(c in colors_text for c in ['black', 'gold']) else 0
-            total_price = base_price + surcharge
-            price_line = f"\n*Price:* ${total_price}"
+        price_line = get_catalog().prices.price_line(user_data.get('selected_item'), user, user_data.get('cake_type'))
     
         # Show final summary including payment
         order_summary = f"""
 🎂 *ORDER SUMMARY* 🎂
 
-*Selected Item:* {user_data.get('selected_item', 'Custom Cake')}{price_line}
+*Selected Item:* {user_data.get('selected_item', 'Custom Cake')}
+{price_line}
 *Name:* {user.name}
 *Flavor:* {user.flavor}
 *Theme:* {user.theme}
@@ -632,9 +3390,10 @@ def handle_main_menu(prompt, user_data, phone_id):
             return {'step': 'order_menu'}
             
         elif selected_option == MainMenuOptions.PRICING:
+            prices = get_catalog().prices
             pricing_msg = (
                 "💰 *Pricing Information* 💰\n\n"
-                "Our cakes range from $20 to $210 depending on size, type, and decorations.\n\n"
+                f"Our cakes range from {prices.money(prices.min_price)} to {prices.money(prices.max_price)} depending on size, type, and decorations.\n\n"
                 "Please select a cake type to see detailed pricing:"
             )
             cake_options = [option.value for option in CakeTypeOptions if option != CakeTypeOptions.BACK]
@@ -681,7 +3440,7 @@ def handle_cake_types_menu(prompt, user_data, phone_id):
             
         if selected_option == CakeTypeOptions.FRESH_CREAM:
             fresh_cream_msg = "Please select a Fresh Cream Cake option:"
-            fresh_cream_options = [option.value for option in FreshCreamOptions]
+            fresh_cream_options = get_catalog().menu_options['fresh_cream']
             send_list_message(
                 fresh_cream_msg,
                 fresh_cream_options,
@@ -693,7 +3452,7 @@ def handle_cake_types_menu(prompt, user_data, phone_id):
             
         elif selected_option == CakeTypeOptions.FRUIT:
             fruit_msg = "Please select a Fruit Cake option:"
-            fruit_options = [option.value for option in FruitCakeOptions]
+            fruit_options = get_catalog().menu_options['fruit']
             send_list_message(
                 fruit_msg,
                 fruit_options,
@@ -705,7 +3464,7 @@ def handle_cake_types_menu(prompt, user_data, phone_id):
             
         elif selected_option == CakeTypeOptions.PLASTIC_ICING:
             plastic_msg = "Please select a Plastic Icing Cake option:"
-            plastic_options = [option.value for option in PlasticIcingOptions]
+            plastic_options = get_catalog().menu_options['plastic_icing']
             send_list_message(
                 plastic_msg,
                 plastic_options,
@@ -770,17 +3529,13 @@ def handle_restart_confirmation(prompt, user_data, phone_id):
 
 def handle_fresh_cream_menu(prompt, user_data, phone_id):
     try:
-        selected_option = None
-        for option in FreshCreamOptions:
-            if prompt.lower() in option.value.lower():
-                selected_option = option
-                break
+        selected_option = get_catalog().match_option('fresh_cream', prompt)
                 
         if not selected_option:
             send_message("Invalid selection. Please choose an option from the list.", user_data['sender'], phone_id)
             return {'step': 'fresh_cream_menu'}
             
-        if selected_option == FreshCreamOptions.BACK:
+        if selected_option.name == 'BACK':
             return handle_main_menu(MainMenuOptions.CAKES.value, user_data, phone_id)
             
                   
@@ -851,7 +3606,7 @@ def handle_tier_cakes_menu(prompt, user_data, phone_id):
             
         if selected_option == TierCakesOptions.TWO_TIER:
             two_tier_msg = "Please select a 2-tier cake option:"
-            two_tier_options = [option.value for option in TwoTierOptions]
+            two_tier_options = get_catalog().menu_options['two_tier']
             send_list_message(
                 two_tier_msg,
                 two_tier_options,
@@ -863,7 +3618,7 @@ def handle_tier_cakes_menu(prompt, user_data, phone_id):
             
         elif selected_option == TierCakesOptions.THREE_TIER:
             three_tier_msg = "Please select a 3-tier cake option:"
-            three_tier_options = [option.value for option in ThreeTierOptions]
+            three_tier_options = get_catalog().menu_options['three_tier']
             send_list_message(
                 three_tier_msg,
                 three_tier_options,
@@ -880,17 +3635,13 @@ def handle_tier_cakes_menu(prompt, user_data, phone_id):
 
 def handle_two_tier_menu(prompt, user_data, phone_id):
     try:
-        selected_option = None
-        for option in TwoTierOptions:
-            if prompt.lower() in option.value.lower():
-                selected_option = option
-                break
+        selected_option = get_catalog().match_option('two_tier', prompt)
                 
         if not selected_option:
             send_message("Invalid selection. Please choose an option from the list.", user_data['sender'], phone_id)
             return {'step': 'two_tier_menu'}
             
-        if selected_option == TwoTierOptions.BACK:
+        if selected_option.name == 'BACK':
             return handle_tier_cakes_menu("", user_data, phone_id)
             
         send_message(
@@ -913,17 +3664,13 @@ def handle_two_tier_menu(prompt, user_data, phone_id):
 
 def handle_three_tier_menu(prompt, user_data, phone_id):
     try:
-        selected_option = None
-        for option in ThreeTierOptions:
-            if prompt.lower() in option.value.lower():
-                selected_option = option
-                break
+        selected_option = get_catalog().match_option('three_tier', prompt)
                 
         if not selected_option:
             send_message("Invalid selection. Please choose an option from the list.", user_data['sender'], phone_id)
             return {'step': 'three_tier_menu'}
             
-        if selected_option == ThreeTierOptions.BACK:
+        if selected_option.name == 'BACK':
             return handle_tier_cakes_menu("", user_data, phone_id)
             
         send_message(
@@ -946,17 +3693,13 @@ def handle_three_tier_menu(prompt, user_data, phone_id):
 
 def handle_fruit_cake_menu(prompt, user_data, phone_id):
     try:
-        selected_option = None
-        for option in FruitCakeOptions:
-            if prompt.lower() in option.value.lower():
-                selected_option = option
-                break
+        selected_option = get_catalog().match_option('fruit', prompt)
                 
         if not selected_option:
             send_message("Invalid selection. Please choose an option from the list.", user_data['sender'], phone_id)
             return {'step': 'fruit_cake_menu'}
             
-        if selected_option == FruitCakeOptions.BACK:
+        if selected_option.name == 'BACK':
             return handle_main_menu(MainMenuOptions.CAKES.value, user_data, phone_id)
             
         send_message(
@@ -979,17 +3722,13 @@ def handle_fruit_cake_menu(prompt, user_data, phone_id):
 
 def handle_plastic_icing_menu(prompt, user_data, phone_id):
     try:
-        selected_option = None
-        for option in PlasticIcingOptions:
-            if prompt.lower() in option.value.lower():
-                selected_option = option
-                break
+        selected_option = get_catalog().match_option('plastic_icing', prompt)
                 
         if not selected_option:
             send_message("Invalid selection. Please choose an option from the list.", user_data['sender'], phone_id)
             return {'step': 'plastic_icing_menu'}
             
-        if selected_option == PlasticIcingOptions.BACK:
+        if selected_option.name == 'BACK':
             return handle_main_menu(MainMenuOptions.CAKES.value, user_data, phone_id)
             
         send_message(
@@ -1108,6 +3847,12 @@ def handle_order_decision(prompt, user_data, phone_id):
         send_message("An error occurred. Please try again.", user_data['sender'], phone_id)
         return {'step': 'main_menu'}
 
+def resume_order_confirmation(user, user_data, phone_id):
+    """Back to the order summary after a detail was asked for again at confirmation"""
+    update_user_state(user_data['sender'], {'user': user.to_dict(), 'resume': None})
+    state = handle_choose_payment(user.payment_method or '', dict(user_data, user=user.to_dict()), phone_id)
+    return dict(state, resume=None)
+
 def handle_get_order_info(prompt, user_data, phone_id):
     try:
         user = User.from_dict(user_data['user'])
@@ -1125,11 +3870,11 @@ def handle_get_order_info(prompt, user_data, phone_id):
             cake_type = (user_data.get('cake_type') or "").lower()
             # If a Fruit Cake was selected, skip flavor selection entirely
             if "fruit" in cake_type:
-                send_message("When do you need the cake? e.g 12/09/2025", user_data['sender'], phone_id)
+                send_message("What is your collection point? Harare or Bulawayo.", user_data['sender'], phone_id)
                 return {
                     'step': 'get_order_info',
                     'user': user.to_dict(),
-                    'field': 'due_date'
+                    'field': 'collection'
                 }
             selected_item = (user_data.get('selected_item') or "").lower()
             if "cake fairy" in selected_item:
@@ -1200,15 +3945,28 @@ def handle_get_order_info(prompt, user_data, phone_id):
                 'field': 'flavor',
                 'selected_item': user_data.get('selected_item')
             })
-            send_message("When do you need the cake? e.g 12/09/2025", user_data['sender'], phone_id)
+            send_message("What is your collection point? Harare or Bulawayo.", user_data['sender'], phone_id)
             return {
                 'step': 'get_order_info',
                 'user': user.to_dict(),
-                'field': 'due_date'
+                'field': 'collection'
             }
 
         elif current_field == 'due_date':
-            user.due_date = prompt
+            due_date = parse_due_date(prompt)
+            if not due_date or due_date < bakery_today():
+                reason = "That date has already passed." if due_date else "Sorry, I couldn't read that date."
+                send_message(f"{reason} Please send the date as day/month/year, e.g 12/09/2025", user_data['sender'], phone_id)
+                return {'step': 'get_order_info', 'user': user.to_dict(), 'field': 'due_date'}
+            unavailable = date_unavailable_message(parse_branch(user.collection), due_date, user_data.get('selected_item'), user_data.get('cake_type'))
+            if unavailable:
+                send_message(unavailable, user_data['sender'], phone_id)
+                return {'step': 'get_order_info', 'user': user.to_dict(), 'field': 'due_date'}
+            user.due_date = due_date.strftime('%d/%m/%Y')
+            if user_data.get('resume') == 'confirm_order':
+                due_time = parse_due_time(user.due_time)
+                if not due_time or datetime(due_date.year, due_date.month, due_date.day, *due_time, tzinfo=BAKERY_TZ) >= earliest_due_at():
+                    return resume_order_confirmation(user, user_data, phone_id)
             update_user_state(user_data['sender'], {
                 'step': 'get_order_info',
                 'user': user.to_dict(),
@@ -1223,7 +3981,23 @@ def handle_get_order_info(prompt, user_data, phone_id):
             }
 
         elif current_field == 'due_time':
-            user.due_time = prompt
+            # Times we can read are stored as HH:MM; anything else ("morning") as given
+            due_time = parse_due_time(prompt)
+            if due_time:
+                earliest = earliest_due_at()
+                due_date = datetime.strptime(user.due_date, '%d/%m/%Y').date()
+                if datetime(due_date.year, due_date.month, due_date.day, *due_time, tzinfo=BAKERY_TZ) < earliest:
+                    send_message(
+                        f"We need at least {get_catalog().capacity['lead_hours']} hours to make your cake. "
+                        f"The earliest we can have it ready on {user.due_date} is {earliest.strftime('%H:%M')}. "
+                        "Please send a later time:",
+                        user_data['sender'],
+                        phone_id
+                    )
+                    return {'step': 'get_order_info', 'user': user.to_dict(), 'field': 'due_time'}
+            user.due_time = f"{due_time[0]:02d}:{due_time[1]:02d}" if due_time else prompt
+            if user_data.get('resume') == 'confirm_order':
+                return resume_order_confirmation(user, user_data, phone_id)
             update_user_state(user_data['sender'], {
                 'step': 'get_order_info',
                 'user': user.to_dict(),
@@ -1307,29 +4081,33 @@ def handle_get_order_info(prompt, user_data, phone_id):
             send_message(color_msg, user_data['sender'], phone_id)
             return {'step': 'get_order_info', 'user': user.to_dict(), 'field': 'colors'}
 
-        elif current_field == 'colors':
-            user.colors = prompt
+        elif current_field == 'collection':
+            branch = parse_branch(prompt)
+            if not branch:
+                send_message("Please reply Harare or Bulawayo for your collection point.", user_data['sender'], phone_id)
+                return {'step': 'get_order_info', 'user': user.to_dict(), 'field': 'collection'}
+            user.collection = branch.title()
             update_user_state(user_data['sender'], {
                 'step': 'get_order_info',
                 'user': user.to_dict(),
-                'field': 'collection',
+                'field': 'due_date',
                 'selected_item': user_data.get('selected_item')
             })
-            send_message("What is your collection point? Harare or Bulawayo.", user_data['sender'], phone_id)
+            send_message("When do you need the cake? e.g 12/09/2025", user_data['sender'], phone_id)
             return {
-                'step': 'get_order_info', 
-                'user': user.to_dict(), 
-                'field': 'collection'
+                'step': 'get_order_info',
+                'user': user.to_dict(),
+                'field': 'due_date'
             }
 
-        elif current_field == 'collection':
-            user.collection = prompt
+        elif current_field == 'colors':
+            user.colors = prompt
             
             # Update user data BEFORE moving to payment
             update_user_state(user_data['sender'], {
                 'step': 'get_order_info',
                 'user': user.to_dict(),
-                'field': 'collection',
+                'field': 'colors',
                 'selected_item': user_data.get('selected_item')
             })
             
@@ -1392,13 +4170,48 @@ def handle_confirm_order(prompt, user_data, phone_id):
             logging.info(f"✅ Finalizing order for {user.phone} with due_date={user.due_date}, due_time={user.due_time}")
 
             # Generate order number
-            order_number = ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
+            order_number = new_id('order')
+
+            prices = get_catalog().prices
+            quote = prices.quote(user_data.get('selected_item'), user, user_data.get('cake_type'))
+            price_line = prices.price_line(user_data.get('selected_item'), user, user_data.get('cake_type'))
 
             # ✅ Save the order with the updated user info
+            due_at = due_timestamp(user)
+            branch = parse_branch(user.collection)
+
+            # Hold the day's production slots; someone may have taken the last ones
+            reservation = None
+            if due_at and branch:
+                reservation = reserve_order_capacity(order_number, branch, due_at, user_data.get('selected_item'), user_data.get('cake_type'))
+                if not reservation:
+                    due_day = datetime.fromtimestamp(due_at, BAKERY_TZ).date()
+                    # The check can pass again if slots were freed since the reservation failed
+                    send_message(
+                        date_unavailable_message(branch, due_day, user_data.get('selected_item'), user_data.get('cake_type'))
+                        or f"Sorry, {due_day:%d/%m/%Y} has just been booked up. Please send another date, e.g 12/09/2025",
+                        user_data['sender'],
+                        phone_id
+                    )
+                    # Only the date is asked again; the rest of the order is kept
+                    update_user_state(user_data['sender'], {
+                        'step': 'get_order_info',
+                        'user': user.to_dict(),
+                        'field': 'due_date',
+                        'resume': 'confirm_order',
+                        'selected_item': user_data.get('selected_item')
+                    })
+                    return {'step': 'get_order_info', 'user': user.to_dict(), 'field': 'due_date', 'resume': 'confirm_order'}
+
             order_data = {
                 'order_number': order_number,
                 'user': user.to_dict(),
                 'selected_item': user_data.get('selected_item'),
+                'total': quote['total'] if quote else None,
+                'due_at': due_at,
+                'branch': branch,
+                'capacity': reservation,
+                'customer': user_data['sender'],
                 'timestamp': datetime.now().isoformat(),
                 'status': 'pending'
             }
@@ -1411,8 +4224,14 @@ def handle_confirm_order(prompt, user_data, phone_id):
             order_data['design_image'] = json.loads(design_data).get('image_id') if design_data else None
 
             
-            # Save to Redis for 7 days
-            redis_client.setex(f"order:{order_number}", 604800, json.dumps(order_data))
+            # Save to Redis until a week past the due date, indexed for the bake sheet
+            pipeline = redis_client.pipeline()
+            pipeline.setex(f"order:{order_number}", order_ttl(due_at), json.dumps(order_data))
+            index_due_order(pipeline, order_number, due_at, branch)
+            index_order_status(pipeline, order_data)
+            index_order_time(pipeline, order_data)
+            queue_persist(pipeline, 'order', order_data)
+            pipeline.exec()
 
 
             # Send confirmation to customer
@@ -1421,6 +4240,7 @@ def handle_confirm_order(prompt, user_data, phone_id):
 
 *Order Number:* {order_number}
 *Item:* {user_data.get('selected_item', 'Custom Cake')}
+{price_line}
 
 Thank you for your order, {user.contact_name or user.name}!
 Your order has been received and is being processed. We need at least 24hrs to process your order.
@@ -1444,6 +4264,7 @@ Please visit www.cakefairy1.com for terms and conditions.
 *Contact Number:* {user.contact_number or user.phone}
 *Email:* {user.email}
 *Item:* {user_data.get('selected_item', 'Custom Cake')}
+{price_line}
 *Theme:* {user.theme}
 *Flavor:* {user.flavor}
 *Due Date:* {user.due_date}
@@ -1454,7 +4275,7 @@ Please visit www.cakefairy1.com for terms and conditions.
 *Special Requests:* {user.special_requests}
 *Payment:* {user.payment_method}
                 """
-                send_message(agent_notification, owner_phone, phone_id)
+                notify_owner('order', agent_notification, group=order_number)
 
             # Payment check
             if user.payment_method and "collection" not in user.payment_method.lower():
@@ -1547,10 +4368,8 @@ def handle_design_request(prompt, user_data, phone_id):
 
 Here's the design image they sent:
                 """
-                send_message(design_msg, owner_phone, phone_id)
-                
-                # Then send the actual image immediately after the message
-                send_image_by_id(image_id, owner_phone, phone_id)
+                # The image follows the message in the same owner card
+                notify_owner('design', design_msg, group=user_data.get('order_number'), image_id=image_id)
 
             redis_client.setex(
                 f"design_image:{user_data['sender']}",
@@ -1655,10 +4474,8 @@ def handle_proof_of_payment(prompt, user_data, phone_id):
 
 Here's the proof of payment they sent:
                 """
-                send_message(payment_msg, owner_phone, phone_id)
-                
-                # Then send the actual image immediately after the message
-                send_image_by_id(image_id, owner_phone, phone_id)
+                # The image follows the message in the same owner card
+                notify_owner('payment', payment_msg, group=user_data.get('order_number'), image_id=image_id)
 
            
             redis_client.setex(
@@ -1711,64 +4528,194 @@ Here's the proof of payment they sent:
         return handle_restart_confirmation("", user_data, phone_id)
         
 
-def send_image_by_id(image_id, recipient, phone_id):
-    """Send image using WhatsApp media ID"""
-    url = f"https://graph.facebook.com/v19.0/{phone_id}/messages"
-    headers = {
-        'Authorization': f'Bearer {wa_token}',
-        'Content-Type': 'application/json'
-    }
-    
+# Media relay
+# Media received from WhatsApp can be re-sent by its id. Only when Graph refuses
+# the id do we fetch the file and upload it again, streaming it chunk by chunk
+# so no whole file is ever held in memory.
+RELAY_MEDIA_TYPES = ('image', 'document', 'audio', 'video', 'sticker')
+CAPTIONED_MEDIA_TYPES = ('image', 'document', 'video')
+MEDIA_STREAM_CHUNK = 64 * 1024
+MEDIA_RELAY_WAIT = float(os.environ.get("MEDIA_RELAY_WAIT", "20"))
+
+# Graph errors that mean a media ID can't be sent (expired, or never uploaded
+# to this number), so the file is worth re-uploading. Invalid-parameter errors
+# only count when they name the media ID.
+GRAPH_MEDIA_ID_ERROR_CODES = {131053}
+GRAPH_INVALID_PARAMETER_CODES = {100, 131009}
+
+def media_id_rejected(response, media_type):
+    """Whether a failed media send was refused because of its media ID"""
+    if response is None or not 400 <= response.status_code < 500 or response.status_code == 429:
+        return False
+    try:
+        error = response.json().get('error', {})
+    except ValueError:
+        return False
+    if error.get('code') in GRAPH_MEDIA_ID_ERROR_CODES:
+        return True
+    details = f"{(error.get('error_data') or {}).get('details') or ''} {error.get('message') or ''}".lower()
+    return error.get('code') in GRAPH_INVALID_PARAMETER_CODES and (f"{media_type}['id']" in details or 'media' in details)
+
+def send_media_by_id(media_type, media_id, recipient, phone_id, caption=None, filename=None, reupload=True):
+    """Send any media type using its WhatsApp media ID, re-uploading it if the ID can't be reused"""
+    media = {"id": media_id}
+    if caption and media_type in CAPTIONED_MEDIA_TYPES:
+        media["caption"] = caption[:1024]
+    if filename and media_type == 'document':
+        media["filename"] = filename
+
     payload = {
         "messaging_product": "whatsapp",
         "recipient_type": "individual",
         "to": recipient,
-        "type": "image",
-        "image": {
-            "id": image_id  # Use the image ID directly instead of downloading
-        }
+        "type": media_type,
+        media_type: media
     }
-    
+
     try:
-        response = requests.post(url, headers=headers, json=payload)
+        response = graph_post(payload, phone_id)
         response.raise_for_status()
-        logging.info(f"Image sent successfully to {recipient}")
+        logging.info(f"{media_type.capitalize()} sent successfully to {recipient}")
         return True
-    except Exception as e:
-        logging.error(f"Failed to send image by ID: {e}")
-        # Fallback: try to download and send via URL
-        return download_and_send_image(image_id, recipient, phone_id)
+    except requests.exceptions.RequestException as e:
+        logging.error(f"Failed to send {media_type} by ID: {e}")
+        # Anything but a refused media ID (an ambiguous failure may even have
+        # been delivered) fails like a text send would
+        if not reupload or not media_id_rejected(getattr(e, 'response', None), media_type):
+            return False
+        new_media_id = reupload_media(media_id, phone_id)
+        if not new_media_id:
+            return False
+        return send_media_by_id(media_type, new_media_id, recipient, phone_id, caption, filename, reupload=False)
 
-def download_and_send_image(image_id, recipient, phone_id):
-    """Download image from WhatsApp and send it to recipient (fallback method)"""
+def send_image_by_id(image_id, recipient, phone_id):
+    """Send image using WhatsApp media ID"""
+    return send_media_by_id('image', image_id, recipient, phone_id)
+
+def iter_multipart_upload(boundary, fields, filename, mime_type, chunks):
+    """Yield a multipart/form-data body whose file part comes straight from an iterator"""
+    for name, value in fields.items():
+        yield (
+            f"--{boundary}\r\n"
+            f"Content-Disposition: form-data; name=\"{name}\"\r\n\r\n"
+            f"{value}\r\n"
+        ).encode('utf-8')
+    yield (
+        f"--{boundary}\r\n"
+        f"Content-Disposition: form-data; name=\"file\"; filename=\"{filename}\"\r\n"
+        f"Content-Type: {mime_type}\r\n\r\n"
+    ).encode('utf-8')
+    for chunk in chunks:
+        if chunk:
+            yield chunk
+    yield f"\r\n--{boundary}--\r\n".encode('utf-8')
+
+def reupload_media(media_id, phone_id):
+    """Stream a media file from WhatsApp back into our media store. Returns the new media ID."""
+    headers = {'Authorization': f'Bearer {wa_token}'}
     try:
-        # Get image URL from WhatsApp API
-        url = f"https://graph.facebook.com/v19.0/{image_id}"
-        headers = {'Authorization': f'Bearer {wa_token}'}
-        
-        response = requests.get(url, headers=headers)
-        if response.status_code == 200:
-            image_data = response.json()
-            image_url = image_data.get('url')
-            
-            if image_url:
-                # Send image using URL
-                send_image_message(image_url, recipient, phone_id)
-                return True
-                    
+        response = requests.get(f"https://graph.facebook.com/v19.0/{media_id}", headers=headers, timeout=SEND_TIMEOUT)
+        response.raise_for_status()
+        media_info = response.json()
+        media_url = media_info.get('url')
+        if not media_url:
+            return None
+        mime_type = media_info.get('mime_type', 'application/octet-stream')
+
+        with requests.get(media_url, headers=headers, stream=True, timeout=SEND_TIMEOUT) as download:
+            download.raise_for_status()
+            boundary = ''.join(random.choices(string.ascii_letters + string.digits, k=24))
+            body = iter_multipart_upload(
+                boundary,
+                {'messaging_product': 'whatsapp', 'type': mime_type},
+                f"{media_id}.{mime_type.split('/')[-1].split(';')[0]}",
+                mime_type,
+                download.iter_content(chunk_size=MEDIA_STREAM_CHUNK)
+            )
+            upload = requests.post(
+                f"https://graph.facebook.com/v19.0/{phone_id}/media",
+                headers={**headers, 'Content-Type': f'multipart/form-data; boundary={boundary}'},
+                data=body,
+                timeout=SEND_TIMEOUT
+            )
+        upload.raise_for_status()
+        return upload.json().get('id')
     except Exception as e:
-        logging.error(f"Error downloading image: {e}")
-    
-    return False
+        logging.error(f"Failed to re-upload media {media_id}: {e}")
+        return None
+
+def parse_media_prompt(prompt):
+    """Split an IMAGE:/MEDIA: prompt from the webhook into (type, id, filename, caption)"""
+    if prompt.startswith('IMAGE:'):
+        return 'image', prompt[6:], None, None
+    if prompt.startswith('MEDIA:'):
+        parts = prompt.split(':', 4)
+        if len(parts) >= 3:
+            parts += [''] * (5 - len(parts))
+            return parts[1], parts[2], parts[3] or None, parts[4] or None
+    return None
+
+def media_prompt(message):
+    """Encode a non-image media message as MEDIA:type:id:filename:caption"""
+    media_type = message.get('type')
+    media = message.get(media_type, {})
+    if not media.get('id'):
+        return None
+    filename = (media.get('filename') or '').replace(':', '_')
+    return f"MEDIA:{media_type}:{media['id']}:{filename}:{media.get('caption') or ''}"
+
+# Each relayed media item in a conversation takes a ticket on arrival and waits
+# for the previous ticket to finish, so items are delivered in arrival order.
+# The wait ends at the turn's send deadline; past it the item goes out anyway.
+RELAY_POLL_INITIAL = 0.05
+RELAY_POLL_MAX = 1.0
+
+# Takes the next ticket and reads how far the conversation has got.
+# KEYS: sequence, done. ARGV: ttl. Returns {ticket, done}.
+TAKE_RELAY_TICKET_SCRIPT = """
+local ticket = redis.call('INCR', KEYS[1])
+redis.call('EXPIRE', KEYS[1], tonumber(ARGV[1]))
+return {ticket, tonumber(redis.call('GET', KEYS[2]) or '0')}
+"""
+
+RELEASE_RELAY_TICKET_SCRIPT = """
+local done = tonumber(redis.call('GET', KEYS[1]) or '0')
+if done < tonumber(ARGV[1]) then
+    redis.call('SET', KEYS[1], ARGV[1], 'EX', 3600)
+end
+return 1
+"""
+
+@contextmanager
+def ordered_relay(conversation):
+    done_key = f"relay_done:{conversation}"
+    ticket, done = redis_client.eval(TAKE_RELAY_TICKET_SCRIPT, [f"relay_seq:{conversation}", done_key], [3600])
+    deadline = time.time() + MEDIA_RELAY_WAIT
+    if send_deadline.get() is not None:
+        deadline = min(deadline, send_deadline.get())
+    poll = RELAY_POLL_INITIAL
+    while int(done) < int(ticket) - 1:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            logging.warning(f"Relaying media for {conversation} without waiting for ticket {int(ticket) - 1}")
+            break
+        time.sleep(min(poll, remaining))
+        poll = min(poll * 2, RELAY_POLL_MAX)
+        done = redis_client.get(done_key) or 0
+    try:
+        yield
+    finally:
+        redis_client.eval(RELEASE_RELAY_TICKET_SCRIPT, [done_key], [ticket])
+
+def relay_media(media, conversation, recipient, phone_id, caption_prefix=None):
+    media_type, media_id, filename, caption = media
+    if caption_prefix and caption:
+        caption = f"{caption_prefix}: {caption}"
+    with ordered_relay(conversation):
+        return send_media_by_id(media_type, media_id, recipient, phone_id, caption, filename)
 
 def send_image_message(image_url, recipient, phone_id):
     """Send image message using WhatsApp media URL"""
-    url = f"https://graph.facebook.com/v19.0/{phone_id}/messages"
-    headers = {
-        'Authorization': f'Bearer {wa_token}',
-        'Content-Type': 'application/json'
-    }
-    
     payload = {
         "messaging_product": "whatsapp",
         "recipient_type": "individual",
@@ -1780,7 +4727,7 @@ def send_image_message(image_url, recipient, phone_id):
     }
     
     try:
-        response = requests.post(url, headers=headers, json=payload)
+        response = graph_post(payload, phone_id)
         response.raise_for_status()
         logging.info(f"Image sent successfully to {recipient}")
         return True
@@ -1798,8 +4745,11 @@ def handle_cupcake_inquiry(prompt, user_data, phone_id):
             'phone': user_data['sender']
         }
         
-        inquiry_id = ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
-        redis_client.setex(f"cupcake_inquiry:{inquiry_id}", 604800, json.dumps(inquiry_data))
+        inquiry_id = new_id('inquiry')
+        pipeline = redis_client.pipeline()
+        pipeline.setex(f"cupcake_inquiry:{inquiry_id}", 604800, json.dumps(inquiry_data))
+        queue_persist(pipeline, 'inquiry', dict(inquiry_data, id=inquiry_id, kind='cupcake'))
+        pipeline.exec()
         
         # Send confirmation
         send_message(
@@ -1819,7 +4769,7 @@ def handle_cupcake_inquiry(prompt, user_data, phone_id):
 
 Please contact the customer for more details.
             """
-            send_message(agent_msg, owner_phone, phone_id)
+            notify_owner('cupcake_inquiry', agent_msg, group=f"cupcake:{inquiry_id}")
         
         # Ask if they need anything else (Yes/No)
         return handle_restart_confirmation("", user_data, phone_id)
@@ -1841,49 +4791,7 @@ def handle_pricing_menu(prompt, user_data, phone_id):
             send_message("Invalid selection. Please choose an option from the list.", user_data['sender'], phone_id)
             return {'step': 'pricing_menu'}
             
-        if selected_option == CakeTypeOptions.FRESH_CREAM:
-            pricing_msg = """
-💰 *Fresh Cream Cakes Pricing* 💰
-
-• Cake Fairy Cake - $20
-• Double Delite - $25
-• Triple Delite - $30
-• Small 6 inches - $30
-• Medium 8 inches- $40
-• Large 10 inches- $60
-• Extra Large 12 inches- $80
-• Extra Tall Cake - $65
-
-*2-Tier Cakes:*
-• 4 inch + 6 inch - $60
-• 5 inch + 7 inch - $80
-• 6 inch + 8 inch - $110
-• 7 inch + 9 inch - $140
-• 8 inch + 10 inch - $170
-
-*3-Tier Cakes:*
-• 4 inch + 6 inch + 8 inch - $140
-• 5 inch + 7 inch + 9 inch - $170
-• 6 inch + 8 inch + 10 inch - $210
-            """
-            
-        elif selected_option == CakeTypeOptions.FRUIT:
-            pricing_msg = """
-💰 *Fruit Cakes Pricing* 💰
-
-• 6 inch - $40
-• 8 inch - $70
-            """
-            
-        elif selected_option == CakeTypeOptions.PLASTIC_ICING:
-            pricing_msg = """
-💰 *Plastic Icing Cakes Pricing* 💰
-
-• Small 6 inches - $40
-• Medium 8 inches - $50
-• Large 10 inches - $70
-• Extra Large 12 inches - $100
-            """
+        pricing_msg = get_catalog().prices.pricing_messages[selected_option.value]
             
         send_message(pricing_msg, user_data['sender'], phone_id)
         
@@ -1952,24 +4860,7 @@ def handle_contact_menu(prompt, user_data, phone_id):
             return {'step': 'callback_request'}
             
         elif selected_option == ContactOptions.DIRECT:
-            contact_info = """
-📞 *Contact Information* 📞
-
-You can reach us at:
-• Email: sales@cakefairy1.com 
-• Website: www.cakefairy1.com
-
-Business Hours:
-• Monday-Friday: 8:00 AM - 5:00 PM
-• Saturday: 8:00 AM - 6:00 PM
-• Sunday: 8:00 AM - 3:00 PM
-
-We're located at:
-
-Bulawayo: 13 and 14th Avenue along R Mugabe Way Cake Fairy Shop | + ‪+263 77 321 8242‬ 
-
-Harare: 30 Rhodesville Avenue, Greendale | ‪+263 78 826 4258
-            """
+            contact_info = get_catalog().contact_info
             send_message(contact_info, user_data['sender'], phone_id)
             return handle_restart_confirmation("", user_data, phone_id)
             
@@ -1990,8 +4881,11 @@ def handle_callback_request(prompt, user_data, phone_id):
             'phone': user_data['sender']
         }
         
-        callback_id = ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
-        redis_client.setex(f"callback:{callback_id}", 604800, json.dumps(callback_data))
+        callback_id = new_id('callback')
+        pipeline = redis_client.pipeline()
+        pipeline.setex(f"callback:{callback_id}", 604800, json.dumps(callback_data))
+        queue_persist(pipeline, 'inquiry', dict(callback_data, id=callback_id, kind='callback'))
+        pipeline.exec()
         
         # Send confirmation
         send_message(
@@ -2011,7 +4905,7 @@ def handle_callback_request(prompt, user_data, phone_id):
 
 Please contact the customer as soon as possible.
             """
-            send_message(agent_msg, owner_phone, phone_id)
+            notify_owner('callback', agent_msg, group=f"callback:{callback_id}")
         
         # Ask if they need anything else (Yes/No)
         return handle_restart_confirmation("", user_data, phone_id)
@@ -2064,14 +4958,14 @@ def download_and_store_image(image_id, image_type, order_number, phone_number):
         url = f"https://graph.facebook.com/v19.0/{image_id}"
         headers = {'Authorization': f'Bearer {wa_token}'}
         
-        response = requests.get(url, headers=headers)
+        response = requests.get(url, headers=headers, timeout=SEND_TIMEOUT)
         if response.status_code == 200:
             image_data = response.json()
             image_url = image_data.get('url')
             
             if image_url:
                 # Download the actual image data
-                img_response = requests.get(image_url, headers=headers)
+                img_response = requests.get(image_url, headers=headers, timeout=SEND_TIMEOUT)
                 if img_response.status_code == 200:
                     # Store the actual image data in Redis
                     image_key = f"{image_type}_data:{order_number}"
@@ -2087,8 +4981,17 @@ def download_and_store_image(image_id, image_type, order_number, phone_number):
                         "original_image_id": image_id
                     }
                     
-                    # Store permanently (or for a longer period)
-                    redis_client.setex(image_key, 2592000, json.dumps(storage_data))  # 30 days
+                    # Store for 30 days; the metadata (not the bytes) is kept in SQL
+                    pipeline = redis_client.pipeline()
+                    pipeline.setex(image_key, 2592000, json.dumps(storage_data))
+                    queue_persist(pipeline, 'image', {
+                        'order_number': order_number,
+                        'image_type': image_type,
+                        'image_id': image_id,
+                        'mime_type': storage_data['mime_type'],
+                        'timestamp': storage_data['timestamp'],
+                    })
+                    pipeline.exec()
                     print(f"✅ Successfully stored {image_type} image for order {order_number}")
                     
                     return True
@@ -2104,16 +5007,18 @@ def download_and_store_image(image_id, image_type, order_number, phone_number):
 def handle_check_existing_order(prompt, user_data, phone_id):
     try:
         # Search for order by order number or phone number
-        order_key = None
+        order_json = None
         
-        # Check if it's an order number (alphanumeric, typically 6-8 characters)
-        if len(prompt) >= 6 and len(prompt) <= 8 and prompt.isalnum():
-            order_data = redis_client.get(f"order:{prompt.upper()}")
-            if order_data:
-                order_key = f"order:{prompt.upper()}"
+        # Check if it's an order number (alphanumeric: 8 random characters for
+        # older orders, 8-10 for ids from new_id)
+        if 6 <= len(prompt.strip()) <= 10 and prompt.strip().isalnum():
+            for candidate in order_number_candidates(prompt):
+                order_json = load_order(candidate)
+                if order_json:
+                    break
         
         # If not found by order number, search by phone number
-        if not order_key:
+        if not order_json:
             # Normalize phone number for search
             search_phone = normalize_phone_number(prompt)
             if not search_phone:
@@ -2141,8 +5046,8 @@ def handle_check_existing_order(prompt, user_data, phone_id):
                     for key in keys:
                         order_data = redis_client.get(key)
                         if order_data:
-                            order_json = json.loads(order_data)
-                            user_info = order_json.get('user', {})
+                            candidate_order = json.loads(order_data)
+                            user_info = candidate_order.get('user', {})
                             order_phone = user_info.get('phone', '')
                             
                             # Check if phone matches any variation
@@ -2157,17 +5062,20 @@ def handle_check_existing_order(prompt, user_data, phone_id):
                                 ]
                                 if norm_phone
                             ):
-                                order_key = key
+                                order_json = candidate_order
                                 found = True
                                 break
                     
                     if found or cursor == 0:
                         break
+                if found:
+                    break
+
+            # Orders Redis has already expired are still in SQL
+            if not order_json:
+                order_json = latest_sql_order([phone_var for phone_var in phone_variations if phone_var])
         
-        if order_key:
-            order_data = redis_client.get(order_key)
-            order_json = json.loads(order_data)
-            
+        if order_json:
             order_info = f"""
 📋 *ORDER STATUS* 📋
 
@@ -2205,20 +5113,50 @@ def handle_agent_location(prompt, user_data, phone_id):
 
         # Accept both button IDs and plain text
         if choice in ["harare_agent", "harare"]:
-            agent = random.choice(HARARE)
+            city = 'harare'
         elif choice in ["bulawayo_agent", "bulawayo"]:
-            agent = random.choice(BULAWAYO)
+            city = 'bulawayo'
         else:
             send_message("⚠️ Please choose either *Harare* or *Bulawayo*.", user_data['sender'], phone_id)
             return {'step': 'agent_location'}
 
-        # Update both parties' states for direct chat
+        outcome, detail = assign_agent(user_data['sender'], city)
+
+        if outcome in ('queued', 'unstaffed'):
+            reason = "are busy" if outcome == 'queued' else "are offline"
+            send_message(
+                f"⏳ All our {city.capitalize()} agents {reason} right now. "
+                f"You are number *{detail}* in the queue and we'll connect you as soon as an agent is free.\n\n"
+                "Send 'cancel' to leave the queue.",
+                user_data['sender'],
+                phone_id
+            )
+            if outcome == 'unstaffed' and owner_phone:
+                # Nobody will pick the queue up on their own; let the owner know
+                send_message(
+                    f"📟 Customer {user_data['sender']} is waiting for a {city.capitalize()} agent and every agent is offline. "
+                    "Agents can send /online to take waiting chats.",
+                    owner_phone,
+                    phone_id
+                )
+            update_user_state(user_data['sender'], {'step': 'agent_queue', 'agent_city': city})
+            return {'step': 'agent_queue', 'agent_city': city}
+
+        # Move the customer into direct chat (the session is already registered)
+        agent = detail
+        touch_agent_session(user_data['sender'])
         update_user_state(user_data['sender'], {'step': 'agent_chat', 'agent': agent})
-        update_user_state(agent, {'step': 'agent_chat', 'customer': user_data['sender']})
 
         # Send connection messages to both sides
-        send_message("✅ You are now connected to a human agent.", user_data['sender'], phone_id)
-        send_message(f"✅ You are now connected with customer {user_data['sender']}. Send 'exit' to end the chat.", agent, phone_id)
+        if outcome in ('assigned', 'paged'):
+            start_agent_session(user_data['sender'], agent)
+        if outcome == 'paged':
+            send_message(
+                f"📟 No {city.capitalize()} agent was online, so this chat was paged to you. "
+                "Send /online when you're available for chats and /offline when you're not.",
+                agent,
+                phone_id
+            )
 
         # Return the new state for the customer
         return {'step': 'agent_chat', 'agent': agent}
@@ -2227,6 +5165,33 @@ def handle_agent_location(prompt, user_data, phone_id):
         logging.error(f"Error in handle_agent_location: {e}")
         send_message("An error occurred. Please try again.", user_data['sender'], phone_id)
         return {'step': 'main_menu'}
+
+
+def handle_agent_queue(prompt, user_data, phone_id):
+    try:
+        city = user_data.get('agent_city')
+        if prompt.lower().strip() in ["cancel", "exit", "leave"]:
+            leave_agent_queue(user_data['sender'], city)
+            send_message("You have left the queue.", user_data['sender'], phone_id)
+            return handle_restart_confirmation("", user_data, phone_id)
+
+        position = agent_queue_position(user_data['sender'], city)
+        if position is None:
+            # Dropped out of the queue (e.g. expired); offer the agent menu again
+            return human_agent("", user_data, phone_id)
+
+        send_message(
+            f"⏳ You are number *{position}* in the queue. An agent will be with you shortly. "
+            "Send 'cancel' to leave the queue.",
+            user_data['sender'],
+            phone_id
+        )
+        return user_data
+
+    except Exception as e:
+        logging.error(f"Error in handle_agent_queue: {e}")
+        send_message("An error occurred. Please try again.", user_data['sender'], phone_id)
+        return {'step': 'main_menu'}
         
 
 def human_agent(prompt, user_data, phone_id):
@@ -2254,9 +5219,13 @@ def handle_waiting_for_agent(prompt, user_data, phone_id):
     try:
         # Customer waiting for agent
         if owner_phone:
-            send_message(f"📩 *Message from customer {user_data['sender']}:*\n\n{prompt}", owner_phone, phone_id)
-            # Start agent session
-            start_agent_session(user_data['sender'], owner_phone)
+            # The owner takes these chats whatever their load; the session still
+            # counts towards it so release and the reaper see it like any other
+            agent = open_agent_session(user_data['sender'], owner_phone)
+            send_message(f"📩 *Message from customer {user_data['sender']}:*\n\n{prompt}", agent, phone_id)
+            if agent == owner_phone:
+                start_agent_session(user_data['sender'], owner_phone)
+            return {'step': 'agent_chat', 'agent': agent}
         return {'step': 'agent_chat'}
     except Exception as e:
         logging.error(f"Error in handle_waiting_for_agent: {e}")
@@ -2266,16 +5235,414 @@ def handle_waiting_for_agent(prompt, user_data, phone_id):
 
 
 def start_agent_session(customer, agent):
-    # Remove the update_user_state calls from here
+    # Session registration and state updates happen in the caller
     # Just send the messages
     send_message("✅ You are now connected to a human agent.", customer, phone_id)
     send_message(f"✅ You are now connected with customer {customer}. Send 'exit' to end the chat.", agent, phone_id)
+    try:
+        summary = conversation_summary(customer)
+    except Exception as e:
+        logging.error(f"Failed to load conversation summary for {customer}: {e}")
+        summary = ''
+    if summary:
+        send_message(f"🕘 Recent messages from {customer}:\n{summary}", agent, phone_id)
 
 def end_agent_session(customer, agent):
+    focus = release_agent(customer, agent)
     update_user_state(customer, {"step": "main_menu"})
-    update_user_state(agent, {"step": "main_menu"})
     send_message("👋 The agent has left the chat. You're now back with the bot.", customer, phone_id)
     send_message(f"👋 Chat with {customer} ended. Handover back to bot.", agent, phone_id)
+    if focus:
+        send_message(f"💬 You are now replying to customer {focus}.", agent, phone_id)
+    # The freed slot goes to whoever has waited longest
+    dispatch_waiting_customers(agent)
+
+
+# Agent relay
+# Active sessions live in one hash keyed by phone in both directions
+# (customer -> agent and agent -> customer), so relaying a message in either
+# direction costs a single HGET. Agents are recognised by set membership and
+# never need their user state loaded.
+AGENT_SESSIONS_KEY = "agent_sessions"
+AGENT_SESSION_ACTIVITY_KEY = "agent_session_activity"
+
+def is_agent(phone_number):
+    return phone_number in get_catalog().all_agents
+
+def get_session_peer(phone_number):
+    return redis_client.hget(AGENT_SESSIONS_KEY, phone_number)
+
+def touch_agent_session(customer):
+    """Record activity in a session, keyed by its customer, for the idle reaper"""
+    redis_client.zadd(AGENT_SESSION_ACTIVITY_KEY, {customer: time.time()})
+
+def relay_agent_message(agent, prompt, phone_id):
+    """Forward an agent's message to their customer, or end the session on 'exit'"""
+    touch_agent_presence(agent)
+    if prompt.startswith('/'):
+        handle_agent_command(agent, prompt, phone_id)
+        return
+
+    customer = get_session_peer(agent)
+    if not customer:
+        send_message("⚠️ No active customer session. Please wait for a request.", agent, phone_id)
+        return
+    touch_agent_session(customer)
+
+    if prompt.lower().strip() == "exit":
+        end_agent_session(customer, agent)
+        return
+
+    media = parse_media_prompt(prompt)
+    if media:
+        relay_media(media, customer, customer, phone_id, caption_prefix="👨‍💼 Agent")
+        return
+
+    send_message(f"👨‍💼 Agent: {prompt}", customer, phone_id)
+
+def relay_customer_message(customer, prompt, phone_id):
+    """Forward a customer's message to their agent. Returns False if the session is gone."""
+    agent = get_session_peer(customer)
+    if not agent:
+        return False
+    touch_agent_session(customer)
+
+    media = parse_media_prompt(prompt)
+    if media:
+        # Forward the media itself to the agent
+        relay_media(media, customer, agent, phone_id)
+        # Also send a text notification
+        article = 'an' if media[0][0] in 'aeiou' else 'a'
+        send_message(f"🧑 Customer {customer} sent {article} {media[0]}", agent, phone_id)
+    else:
+        # Forward regular text message to agent
+        send_message(f"🧑 Customer {customer}: {prompt}", agent, phone_id)
+    return True
+
+
+# Agent dispatcher
+# Each agent's concurrent session count is kept in one sorted set, so the
+# least-loaded online agent for a city is the first eligible member in score
+# order. Assignment, release and queue hand-off are Lua scripts, which makes
+# them atomic across workers. Customers who find every agent busy wait in a
+# FIFO list per city.
+#
+# An agent is online for AGENT_PRESENCE_TTL seconds after their last message
+# (any message, /online included); /offline takes them out until they send
+# /online again. The presence hash holds their last-seen time, or 'offline'.
+# While none of a city's agents is online (a fresh deploy, a quiet evening) new
+# customers are paged to one who hasn't gone /offline, as before presence
+# existed; with every agent offline they queue and the owner is told.
+AGENT_LOAD_KEY = "agent_load"
+AGENT_PRESENCE_KEY = "agent_presence"
+AGENT_PRESENCE_TTL = int(os.environ.get("AGENT_PRESENCE_TTL", "14400"))
+AGENT_MAX_SESSIONS = int(os.environ.get("AGENT_MAX_SESSIONS", "1"))
+AGENT_QUEUE_NOTIFY_LIMIT = 20
+
+# KEYS: load, presence, queue, sessions, then each city agent's customer set.
+# ARGV: customer, capacity, now, presence ttl, city agents...
+# Returns {'existing'|'assigned', agent} or {'queued', position}. When none of
+# the city's agents is online, the least-loaded one who hasn't gone /offline
+# is paged instead ({'paged', agent}); if there is none, {'unstaffed', position}.
+ASSIGN_AGENT_SCRIPT = """
+local customer = ARGV[1]
+local existing = redis.call('HGET', KEYS[4], customer)
+if existing then
+    return {'existing', existing}
+end
+local now = tonumber(ARGV[3])
+local customer_sets = {}
+local staffed = false
+for i = 5, #ARGV do
+    redis.call('ZADD', KEYS[1], 'NX', 0, ARGV[i])
+    customer_sets[ARGV[i]] = KEYS[i]
+    local seen = tonumber(redis.call('HGET', KEYS[2], ARGV[i]) or '')
+    if seen and now - seen <= tonumber(ARGV[4]) then
+        staffed = true
+    end
+end
+local function assign(agent)
+    redis.call('ZINCRBY', KEYS[1], 1, agent)
+    redis.call('HSET', KEYS[4], customer, agent)
+    redis.call('SADD', customer_sets[agent], customer)
+    if not redis.call('HGET', KEYS[4], agent) then
+        redis.call('HSET', KEYS[4], agent, customer)
+    end
+end
+local candidates = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', '(' .. ARGV[2])
+for _, agent in ipairs(candidates) do
+    if customer_sets[agent] then
+        local presence = redis.call('HGET', KEYS[2], agent)
+        local seen = tonumber(presence or '')
+        if seen and now - seen <= tonumber(ARGV[4]) then
+            assign(agent)
+            return {'assigned', agent}
+        end
+        if not staffed and presence ~= 'offline' then
+            assign(agent)
+            return {'paged', agent}
+        end
+    end
+end
+local position = redis.call('LPOS', KEYS[3], customer)
+if not position then
+    position = redis.call('RPUSH', KEYS[3], customer) - 1
+end
+return {staffed and 'queued' or 'unstaffed', tostring(position + 1)}
+"""
+
+# KEYS: load, sessions, the agent's customer set. ARGV: customer, agent.
+# Opens a session with a given agent whatever their load, counted like any other.
+# Returns the customer's current agent if they already had one, else nil.
+OPEN_AGENT_SESSION_SCRIPT = """
+local existing = redis.call('HGET', KEYS[2], ARGV[1])
+if existing then
+    return existing
+end
+redis.call('ZINCRBY', KEYS[1], 1, ARGV[2])
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+redis.call('SADD', KEYS[3], ARGV[1])
+if not redis.call('HGET', KEYS[2], ARGV[2]) then
+    redis.call('HSET', KEYS[2], ARGV[2], ARGV[1])
+end
+return nil
+"""
+
+# KEYS: load, sessions, the agent's customer set. ARGV: customer, agent.
+# Returns the agent's next focused customer ('' if none) or nil if no such session
+RELEASE_AGENT_SCRIPT = """
+if redis.call('HGET', KEYS[2], ARGV[1]) ~= ARGV[2] then
+    return nil
+end
+redis.call('HDEL', KEYS[2], ARGV[1])
+local customers = KEYS[3]
+redis.call('SREM', customers, ARGV[1])
+local focus = redis.call('HGET', KEYS[2], ARGV[2])
+if focus == ARGV[1] then
+    focus = redis.call('SRANDMEMBER', customers)
+    if focus then
+        redis.call('HSET', KEYS[2], ARGV[2], focus)
+    else
+        redis.call('HDEL', KEYS[2], ARGV[2])
+    end
+end
+if tonumber(redis.call('ZINCRBY', KEYS[1], -1, ARGV[2])) < 0 then
+    redis.call('ZADD', KEYS[1], 0, ARGV[2])
+end
+return focus or ''
+"""
+
+# KEYS: load, presence, sessions, the agent's customer set, queues...
+# ARGV: agent, capacity, now, presence ttl.
+# Hands the agent the longest-waiting customer if they are online with a free slot.
+CLAIM_WAITING_SCRIPT = """
+local agent = ARGV[1]
+local seen = tonumber(redis.call('HGET', KEYS[2], agent) or '')
+if not seen or tonumber(ARGV[3]) - seen > tonumber(ARGV[4]) then
+    return nil
+end
+if tonumber(redis.call('ZSCORE', KEYS[1], agent) or '0') >= tonumber(ARGV[2]) then
+    return nil
+end
+for i = 5, #KEYS do
+    local customer = redis.call('LPOP', KEYS[i])
+    if customer then
+        redis.call('ZINCRBY', KEYS[1], 1, agent)
+        redis.call('HSET', KEYS[3], customer, agent)
+        redis.call('SADD', KEYS[4], customer)
+        if not redis.call('HGET', KEYS[3], agent) then
+            redis.call('HSET', KEYS[3], agent, customer)
+        end
+        return {customer, KEYS[i]}
+    end
+end
+return nil
+"""
+
+# KEYS: presence. ARGV: agent, now, presence ttl.
+# Records a message from the agent unless they are offline; returns 1 if that brought them back online
+TOUCH_AGENT_PRESENCE_SCRIPT = """
+local current = redis.call('HGET', KEYS[1], ARGV[1])
+if current == 'offline' then
+    return 0
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+local seen = tonumber(current or '')
+if seen and tonumber(ARGV[2]) - seen <= tonumber(ARGV[3]) then
+    return 0
+end
+return 1
+"""
+
+def agent_queue_key(city):
+    return f"agent_queue:{city}"
+
+def agent_customers_key(agent):
+    return f"agent_customers:{agent}"
+
+def assign_agent(customer, city):
+    agents = get_catalog().agent_cities.get(city, [])
+    outcome, detail = redis_client.eval(
+        ASSIGN_AGENT_SCRIPT,
+        [AGENT_LOAD_KEY, AGENT_PRESENCE_KEY, agent_queue_key(city), AGENT_SESSIONS_KEY]
+        + [agent_customers_key(agent) for agent in agents],
+        [customer, AGENT_MAX_SESSIONS, int(time.time()), AGENT_PRESENCE_TTL] + agents
+    )
+    return outcome, detail
+
+def open_agent_session(customer, agent):
+    """Connect a customer to a chosen agent (the owner) outside the city rosters, counted
+    towards the agent's load. Returns the agent the customer ends up with."""
+    existing = redis_client.eval(
+        OPEN_AGENT_SESSION_SCRIPT,
+        [AGENT_LOAD_KEY, AGENT_SESSIONS_KEY, agent_customers_key(agent)],
+        [customer, agent]
+    )
+    touch_agent_session(customer)
+    return existing or agent
+
+def release_agent(customer, agent):
+    """Free the agent's slot for this customer. Returns the agent's next focused customer, if any."""
+    focus = redis_client.eval(
+        RELEASE_AGENT_SCRIPT,
+        [AGENT_LOAD_KEY, AGENT_SESSIONS_KEY, agent_customers_key(agent)],
+        [customer, agent]
+    )
+    redis_client.zrem(AGENT_SESSION_ACTIVITY_KEY, customer)
+    return focus or None
+
+def agent_queue_position(customer, city):
+    if not city:
+        return None
+    position = redis_client.lpos(agent_queue_key(city), customer)
+    return None if position is None else position + 1
+
+def leave_agent_queue(customer, city):
+    if city:
+        redis_client.lrem(agent_queue_key(city), 0, customer)
+
+def notify_queue_positions(queue_key):
+    for index, customer in enumerate(redis_client.lrange(queue_key, 0, AGENT_QUEUE_NOTIFY_LIMIT - 1)):
+        send_message(f"⏳ You are now number *{index + 1}* in the queue.", customer, phone_id)
+
+def dispatch_waiting_customers(agent):
+    """Fill the agent's free slots from the queues of the cities they serve"""
+    queues = [agent_queue_key(city) for city, agents in get_catalog().agent_cities.items() if agent in agents]
+    if not queues:
+        return
+    while True:
+        claimed = redis_client.eval(
+            CLAIM_WAITING_SCRIPT,
+            [AGENT_LOAD_KEY, AGENT_PRESENCE_KEY, AGENT_SESSIONS_KEY, agent_customers_key(agent)] + queues,
+            [agent, AGENT_MAX_SESSIONS, int(time.time()), AGENT_PRESENCE_TTL]
+        )
+        if not claimed:
+            return
+        customer, queue_key = claimed
+        if get_user_state(customer).get('step') != 'agent_queue':
+            # Customer wandered off while waiting; give the slot back
+            release_agent(customer, agent)
+            continue
+        touch_agent_session(customer)
+        update_user_state(customer, {'step': 'agent_chat', 'agent': agent})
+        start_agent_session(customer, agent)
+        notify_queue_positions(queue_key)
+
+def set_agent_presence(agent, online):
+    redis_client.hset(AGENT_PRESENCE_KEY, agent, int(time.time()) if online else 'offline')
+    if online:
+        dispatch_waiting_customers(agent)
+
+def touch_agent_presence(agent):
+    """Keep an agent who is messaging online, and give them waiting customers if they had gone stale"""
+    if redis_client.eval(TOUCH_AGENT_PRESENCE_SCRIPT, [AGENT_PRESENCE_KEY], [agent, int(time.time()), AGENT_PRESENCE_TTL]):
+        dispatch_waiting_customers(agent)
+
+def handle_agent_command(agent, prompt, phone_id):
+    """Agent commands: /online, /offline, /sessions and /switch <customer>"""
+    command, _, argument = prompt[1:].strip().partition(' ')
+    command = command.lower()
+
+    if command in ['online', 'offline']:
+        set_agent_presence(agent, command == 'online')
+        send_message(f"✅ You are now *{command}*.", agent, phone_id)
+        return
+
+    customers = sorted(redis_client.smembers(agent_customers_key(agent)) or [])
+    if command == 'sessions':
+        focus = get_session_peer(agent)
+        if not customers:
+            send_message("You have no active customer sessions.", agent, phone_id)
+            return
+        lines = [f"{index + 1}. {customer}{' (replying)' if customer == focus else ''}" for index, customer in enumerate(customers)]
+        send_message("💬 *Active sessions*\n\n" + "\n".join(lines) + "\n\nSend /switch <number> to reply to another customer.", agent, phone_id)
+        return
+
+    if command == 'switch':
+        argument = argument.strip()
+        target = None
+        if argument.isdigit() and 0 < int(argument) <= len(customers):
+            target = customers[int(argument) - 1]
+        elif normalize_phone_number(argument) in customers:
+            target = normalize_phone_number(argument)
+        if not target:
+            send_message("⚠️ No such session. Send /sessions to see your customers.", agent, phone_id)
+            return
+        redis_client.hset(AGENT_SESSIONS_KEY, agent, target)
+        send_message(f"💬 You are now replying to customer {target}.", agent, phone_id)
+        return
+
+    send_message("Commands: /online, /offline, /sessions, /switch <number>", agent, phone_id)
+
+
+# Idle reaper
+# Runs from a cron. Both passes read only the entries whose last activity is
+# older than the cutoff (ZRANGEBYSCORE ... LIMIT), so a run costs O(expired).
+# Abandoned-order reminders go only to customers who asked for them: "remind
+# me" sets funnel_reminders on their state and "stop reminders" clears it.
+AGENT_SESSION_IDLE_SECONDS = int(os.environ.get("AGENT_SESSION_IDLE_SECONDS", "1800"))
+FUNNEL_IDLE_SECONDS = int(os.environ.get("FUNNEL_IDLE_SECONDS", "3600"))
+FUNNEL_REMINDER_COMMANDS = {"remind me": True, "reminders on": True, "stop reminders": False, "reminders off": False}
+REAPER_BATCH_SIZE = int(os.environ.get("REAPER_BATCH_SIZE", "100"))
+
+def claim_idle(activity_key, cutoff):
+    """Yield members idle since before the cutoff; ZREM decides which worker owns each one"""
+    while True:
+        members = redis_client.zrange(activity_key, '-inf', cutoff, sortby='BYSCORE', offset=0, count=REAPER_BATCH_SIZE)
+        if not members:
+            return
+        for member in members:
+            if redis_client.zrem(activity_key, member):
+                yield member
+
+def reap_idle_agent_sessions():
+    closed = 0
+    for customer in claim_idle(AGENT_SESSION_ACTIVITY_KEY, time.time() - AGENT_SESSION_IDLE_SECONDS):
+        agent = get_session_peer(customer)
+        if not agent:
+            continue
+        release_agent(customer, agent)
+        update_user_state(customer, {"step": "main_menu"})
+        send_message("⌛ This chat was closed because it has been quiet for a while. You're now back with the bot.", customer, phone_id)
+        send_message(f"⌛ Chat with {customer} closed after inactivity.", agent, phone_id)
+        dispatch_waiting_customers(agent)
+        closed += 1
+    return closed
+
+def reap_abandoned_funnels():
+    reminded = 0
+    for customer in claim_idle(FUNNEL_ACTIVITY_KEY, time.time() - FUNNEL_IDLE_SECONDS):
+        if not get_user_state(customer).get('funnel_reminders'):
+            continue
+        send_message(
+            "🎂 You have an unfinished cake order with us! "
+            "Just reply to pick up where you left off, or say 'menu' to start again. "
+            "Reply 'stop reminders' if you'd rather not get these.",
+            customer,
+            phone_id
+        )
+        reminded += 1
+    return reminded
 
 
 # Main message handler
@@ -2284,90 +5651,18 @@ def handle_message(prompt, user_data, phone_id):
 
    
     # ===== AGENT HANDLING =====
-    if sender in AGENT_NUMBERS:
-        if user_data.get("step") == "agent_chat" and "customer" in user_data:
-            customer = user_data["customer"]
-            if prompt.lower().strip() == "exit":
-                # End agent session - update BOTH agent and customer states
-                update_user_state(customer, {"step": "main_menu"})
-                update_user_state(sender, {"step": "main_menu"})
-                send_message("👋 The agent has left the chat. You're now back with the bot.", customer, phone_id)
-                send_message(f"👋 Chat with {customer} ended. Handover back to bot.", sender, phone_id)
-                return {"step": "main_menu"}
-            else:
-                # Check if agent is sending an image (you'd need to handle this from webhook)
-                # For now, just forward text messages
-                send_message(f"👨‍💼 Agent: {prompt}", customer, phone_id)
-                return user_data
-        else:
-            send_message("⚠️ No active customer session. Please wait for a request.", sender, phone_id)
-            return user_data
-
-    
-    if sender in BULAWAYO:
-        if user_data.get("step") == "agent_chat" and "customer" in user_data:
-            customer = user_data["customer"]
-            if prompt.lower().strip() == "exit":
-                # End agent session - update BOTH agent and customer states
-                update_user_state(customer, {"step": "main_menu"})
-                update_user_state(sender, {"step": "main_menu"})
-                send_message("👋 The agent has left the chat. You're now back with the bot.", customer, phone_id)
-                send_message(f"👋 Chat with {customer} ended. Handover back to bot.", sender, phone_id)
-                return {"step": "main_menu"}
-            else:
-                # Check if agent is sending an image (you'd need to handle this from webhook)
-                # For now, just forward text messages
-                send_message(f"👨‍💼 Agent: {prompt}", customer, phone_id)
-                return user_data
-        else:
-            send_message("⚠️ No active customer session. Please wait for a request.", sender, phone_id)
-            return user_data
-
+    if is_agent(sender):
+        relay_agent_message(sender, prompt, phone_id)
+        return user_data
 
-    
-    if sender in HARARE:
-        if user_data.get("step") == "agent_chat" and "customer" in user_data:
-            customer = user_data["customer"]
-            if prompt.lower().strip() == "exit":
-                # End agent session - update BOTH agent and customer states
-                update_user_state(customer, {"step": "main_menu"})
-                update_user_state(sender, {"step": "main_menu"})
-                send_message("👋 The agent has left the chat. You're now back with the bot.", customer, phone_id)
-                send_message(f"👋 Chat with {customer} ended. Handover back to bot.", sender, phone_id)
-                return {"step": "main_menu"}
-            else:
-                # Check if agent is sending an image (you'd need to handle this from webhook)
-                # For now, just forward text messages
-                send_message(f"👨‍💼 Agent: {prompt}", customer, phone_id)
-                return user_data
-        else:
-            send_message("⚠️ No active customer session. Please wait for a request.", sender, phone_id)
-            return user_data
-        
-    
-    
     # ===== CUSTOMER HANDLING =====
-    if user_data.get("step") == "agent_chat" and "agent" in user_data:
-        agent = user_data["agent"]
-        # Check if agent ended the chat (customer might not have received the exit message yet)
-        agent_state = get_user_state(agent)
-        if agent_state.get("step") != "agent_chat":
-            # Agent has already ended the chat, return customer to main menu
-            update_user_state(sender, {"step": "main_menu"})
-            send_message("👋 The agent has ended the chat. You're now back with the bot.", sender, phone_id)
-            return {"step": "main_menu"}
-        
-        # Check if this is an image message and forward the actual image
-        if prompt.startswith('IMAGE:'):
-            image_id = prompt[6:]  # Extract the image ID
-            # Forward the image to the agent
-            send_image_by_id(image_id, agent, phone_id)
-            # Also send a text notification
-            send_message(f"🧑 Customer {sender} sent an image", agent, phone_id)
-        else:
-            # Forward regular text message to agent
-            send_message(f"🧑 Customer {sender}: {prompt}", agent, phone_id)
-        return user_data
+    if user_data.get("step") == "agent_chat":
+        if relay_customer_message(sender, prompt, phone_id):
+            return user_data
+        # Agent has already ended the chat, return customer to main menu
+        update_user_state(sender, {"step": "main_menu"})
+        send_message("👋 The agent has ended the chat. You're now back with the bot.", sender, phone_id)
+        return {"step": "main_menu"}
 
     try:
         print(f"Handling message: '{prompt}' for user: {user_data}")
@@ -2379,15 +5674,20 @@ def handle_message(prompt, user_data, phone_id):
         
         # Convert prompt to lowercase for easier matching
         prompt_lower = prompt.lower()
-        # Log inbound text
-        try:
-            log_conversation(user_data['sender'], 'in', 'text', {'text': prompt})
-        except Exception:
-            pass
         
         # Check for explicit restart commands (exact match only to avoid accidental triggers)
         if prompt_lower.strip() in {"restart", "start over", "main menu", "menu", "hie", "hey", "hi"}:
             return handle_welcome("", user_data, phone_id)
+
+        if prompt_lower.strip() in FUNNEL_REMINDER_COMMANDS:
+            opted_in = FUNNEL_REMINDER_COMMANDS[prompt_lower.strip()]
+            send_message(
+                "🔔 We'll remind you if you leave an order unfinished." if opted_in
+                else "🔕 You won't get reminders about unfinished orders.",
+                user_data['sender'],
+                phone_id
+            )
+            return dict(user_data, funnel_reminders=opted_in)
             
         # Determine current step early
         current_step = user_data.get('step', 'welcome')
@@ -2465,71 +5765,6 @@ def handle_message(prompt, user_data, phone_id):
         elif current_step == 'proof_of_payment':
             return handle_proof_of_payment(prompt, user_data, phone_id)
 
-        elif current_step == 'choose_payment':
-            # Parse payment option
-            selected_option = None
-            for option in PaymentOptions:
-                if prompt_lower in option.value.lower():
-                    selected_option = option
-                    break
-            
-            user = User.from_dict(user_data['user'])
-            if selected_option:
-                user.payment_method = selected_option.value
-            else:
-                user.payment_method = prompt
-        
-            # Compute price for Cake Fairy Cake with color surcharge
-            selected_item_text = (user_data.get('selected_item') or '').lower()
-            colors_text = (user.colors or '').lower()
-            price_line = ''
-            if 'cake fairy' in selected_item_text:
-                base_price = 20
-                surcharge = 5 if any(c in colors_text for c in ['black', 'gold']) else 0
-                total_price = base_price + surcharge
-                price_line = f"\n*Price:* ${total_price}"
-        
-            # Show final summary including payment
-            order_summary = f"""
-        🎂 *ORDER SUMMARY* 🎂
-        
-*Selected Item:* {user_data.get('selected_item', 'Custom Cake')}{price_line}
-*Name:* {user.name}
-*Flavor:* {user.flavor}
-*Theme:* {user.theme}
-*Due Date:* {user.due_date}
-*Due Time:* {user.due_time}
-*Colors:* {user.colors}
-*Message:* {user.message}
-*Special Requests:* {user.special_requests}
-*Payment:* {user.payment_method}
-        
-*Note:* Dark colors (red, pink, black) may have a bitter/metallic aftertaste.
-        
-Please confirm if this order is correct.
-            """
-            
-            send_button_message(
-                order_summary,
-                [
-                    {"id": "confirm_yes", "title": "✅ Yes, confirm order"},
-                    {"id": "confirm_no", "title": "❌ No, edit order"}
-                ],
-                user_data['sender'],
-                phone_id
-            )
-            update_user_state(user_data['sender'], {
-                'step': 'confirm_order',
-                'user': user.to_dict(),
-                'selected_item': user_data.get('selected_item')
-            })
-            return {
-                'step': 'confirm_order',
-                'user': user.to_dict(),
-                'selected_item': user_data.get('selected_item')
-            }
-
-    
         elif current_step == 'confirm_order':
             return handle_confirm_order(prompt, user_data, phone_id)
             
@@ -2554,6 +5789,9 @@ Please confirm if this order is correct.
         elif current_step == 'check_existing_order':
             return handle_check_existing_order(prompt, user_data, phone_id)
             
+        elif current_step == 'agent_queue':
+            return handle_agent_queue(prompt, user_data, phone_id)
+            
         elif current_step == 'waiting_for_agent':
             return handle_waiting_for_agent(prompt, user_data, phone_id)
             
@@ -2568,6 +5806,328 @@ Please confirm if this order is correct.
         send_message("An error occurred. Please try again.", user_data['sender'], phone_id)
         return {'step': 'welcome'}
 
+# API authentication
+API_TOKEN = os.environ.get("API_TOKEN")
+CRON_SECRET = os.environ.get("CRON_SECRET")  # sent by Vercel Cron as a Bearer token
+
+def has_api_token():
+    """Whether the request carries the API token (or cron secret) as a Bearer or X-API-Token header"""
+    auth = request.headers.get('Authorization', '')
+    token = auth[7:] if auth.startswith('Bearer ') else request.headers.get('X-API-Token')
+    accepted = [secret for secret in (API_TOKEN, CRON_SECRET) if secret]
+    return bool(token) and any(hmac.compare_digest(token, secret) for secret in accepted)
+
+def require_api_token(view):
+    """Reject requests that don't carry the API token (or cron secret) as a Bearer or X-API-Token header"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not has_api_token():
+            return jsonify({'status': 'error', 'message': 'Unauthorized'}), 401
+        return view(*args, **kwargs)
+    return wrapper
+
+# Admission control
+# A webhook turn is about ten Upstash round trips and a Graph call or two, so
+# in a burst every turn slows down together until Meta times out and
+# redelivers. When this process already has ADMISSION_MAX_INFLIGHT turns
+# running, or Upstash or Graph has recently been slower than
+# ADMISSION_MAX_LATENCY, a message is instead appended to a per-sender Redis
+# list in one pipelined round trip and acknowledged. Senders with a backlog
+# sit in a sorted set scored by when they become claimable; drainers lease the
+# oldest, work through its list in order and release it. A message stays at
+# the head of its list until its turn has finished, so a drainer that dies
+# mid-turn leaves it for the next lease; one that keeps failing is retried
+# with backoff and moved to INBOUND_DEAD_LETTER_KEY after
+# INBOUND_MAX_ATTEMPTS. A sender stays in the sorted set until its list is
+# empty and no deferred turn is running, and later messages from it join the
+# queue, so nothing overtakes it. Draining is left to the drainer thread and
+# the cron so that webhook acks never wait on other customers' turns. Each
+# deferred sender gets one short "busy" reply per BUSY_NOTICE_WINDOW. The
+# backlog check rides on the turn's state read (ADMIT_INBOUND_SCRIPT), so a
+# message handled inline pays no extra round trip for it.
+ADMISSION_MAX_INFLIGHT = int(os.environ.get("ADMISSION_MAX_INFLIGHT", "16"))
+ADMISSION_MAX_LATENCY = float(os.environ.get("ADMISSION_MAX_LATENCY", "2.0"))
+BUSY_NOTICE_WINDOW = int(os.environ.get("BUSY_NOTICE_WINDOW", "300"))
+BUSY_NOTICE_TEXT = "⏳ We're getting a lot of messages right now. Hang tight, we'll get back to you in a moment!"
+INBOUND_PENDING_KEY = "inbound_pending"
+INBOUND_ATTEMPTS_KEY = "inbound_attempts"
+INBOUND_DEAD_LETTER_KEY = "inbound_dead_letter"
+INBOUND_DEAD_LETTER_MAX = 10000
+INBOUND_MAX_ATTEMPTS = 3
+INBOUND_QUEUE_TTL = 86400
+INBOUND_LEASE_SECONDS = 60
+INBOUND_DRAIN_INTERVAL = 2
+INBOUND_BACKLOG_CHECK_INTERVAL = 1.0
+
+# KEYS: pending senders. ARGV: now, lease seconds
+# Returns the sender whose backlog has waited longest, leased to the caller
+CLAIM_INBOUND_SENDER_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, 1)
+if #due == 0 then
+    return nil
+end
+redis.call('ZADD', KEYS[1], tonumber(ARGV[1]) + tonumber(ARGV[2]), due[1])
+return due[1]
+"""
+
+# KEYS: pending senders, state, state version. ARGV: sender, version the caller
+# has cached, 1 to read the state. Returns {'queued'} if the sender has a
+# backlog, else {'inline'} followed by a READ_STATE_SCRIPT reply when asked.
+ADMIT_INBOUND_SCRIPT = """
+if redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+    return {'queued'}
+end
+if ARGV[3] ~= '1' then
+    return {'inline'}
+end
+local version = redis.call('GET', KEYS[3])
+if version and version == ARGV[2] then
+    return {'inline', version}
+end
+return {'inline', version or '', redis.call('GET', KEYS[2]) or ''}
+"""
+
+# KEYS: sender queue, pending senders. ARGV: sender
+# The next message, left at the head of the queue until it is acknowledged;
+# releases the sender once its queue is empty
+NEXT_INBOUND_MESSAGE_SCRIPT = """
+local message = redis.call('LINDEX', KEYS[1], 0)
+if not message then
+    redis.call('ZREM', KEYS[2], ARGV[1])
+end
+return message
+"""
+
+# KEYS: sender queue, attempts. ARGV: sender, message
+# Removes a handled message from the head of the queue
+ACK_INBOUND_MESSAGE_SCRIPT = """
+if redis.call('LINDEX', KEYS[1], 0) == ARGV[2] then
+    redis.call('LPOP', KEYS[1])
+end
+redis.call('HDEL', KEYS[2], ARGV[1])
+return 1
+"""
+
+_inflight_turns = 0
+_inflight_lock = threading.Lock()
+_inbound_backlog = {'senders': 0, 'checked_at': 0.0}
+_inbound_drainer_started = False
+_inbound_drainer_lock = threading.Lock()
+
+def inbound_queue_key(sender):
+    return f"inbound_queue:{sender}"
+
+@contextmanager
+def admitted_turn():
+    global _inflight_turns
+    with _inflight_lock:
+        _inflight_turns += 1
+    deadline = send_deadline.set(time.time() + SEND_TURN_BUDGET)
+    try:
+        with state_turn():
+            yield
+    finally:
+        send_deadline.reset(deadline)
+        with _inflight_lock:
+            _inflight_turns -= 1
+        if has_unsaved_states():
+            save_unsaved_states()
+
+def overloaded():
+    return _inflight_turns >= ADMISSION_MAX_INFLIGHT or upstream_latency() > ADMISSION_MAX_LATENCY
+
+def inbound_backlog_senders():
+    """How many senders have a backlog, re-read at most once per check interval"""
+    now = time.time()
+    if now - _inbound_backlog['checked_at'] >= INBOUND_BACKLOG_CHECK_INTERVAL:
+        _inbound_backlog['checked_at'] = now
+        try:
+            _inbound_backlog['senders'] = redis_client.zcard(INBOUND_PENDING_KEY)
+        except Exception as e:
+            logging.error(f"Failed to read the inbound backlog: {e}")
+    return _inbound_backlog['senders']
+
+def sender_has_backlog(sender):
+    """Whether the sender has queued messages or a deferred turn still running. Otherwise
+    the sender's state is read in the same round trip, so the turn starts with it checked."""
+    cached = cached_state(sender)
+    # Agents never load state, and unsaved states are used as they are
+    read_state = not is_agent(sender) and not (cached and cached[3])
+    try:
+        with timed_call('redis'):
+            reply = redis_client.eval(
+                ADMIT_INBOUND_SCRIPT,
+                [INBOUND_PENDING_KEY, f"user_state:{sender}", state_version_key(sender)],
+                [sender, cached[1] if cached else '', 1 if read_state else 0],
+            )
+    except Exception as e:
+        # Without Redis there is no queue to join; handle the message with the local state
+        logging.error(f"Failed to check the inbound backlog for {sender}: {e}")
+        return False
+    if reply[0] == 'queued':
+        return True
+    if len(reply) > 1:
+        state_from_reply(sender, cached, reply[1:])
+    return False
+
+def defer_inbound_message(sender, message, phone_id):
+    """Queue a message for a drainer in one round trip; sends the busy reply if due"""
+    key = inbound_queue_key(sender)
+    pipeline = redis_client.pipeline()
+    pipeline.rpush(key, json.dumps(message))
+    pipeline.expire(key, INBOUND_QUEUE_TTL)
+    pipeline.zadd(INBOUND_PENDING_KEY, {sender: time.time()}, nx=True)
+    pipeline.set(f"busy_notice:{sender}", 1, nx=True, ex=BUSY_NOTICE_WINDOW)
+    results = pipeline.exec()
+    _inbound_backlog['senders'] = max(_inbound_backlog['senders'], 1)
+    count_metric('webhook_messages_total', path='deferred')
+    if results[-1]:
+        count_metric('busy_notices_total')
+        run_in_background(send_message, BUSY_NOTICE_TEXT, sender, phone_id)
+    ensure_inbound_drainer()
+
+def admit_inbound_message(sender, message, phone_id):
+    """Handle a message now, or queue it when this process or its upstreams are overloaded"""
+    if overloaded():
+        defer_inbound_message(sender, message, phone_id)
+        return
+    with admitted_turn():
+        if sender_has_backlog(sender):
+            defer_inbound_message(sender, message, phone_id)
+            return
+        count_metric('webhook_messages_total', path='inline')
+        process_inbound_message(sender, message, phone_id)
+
+def ack_inbound_message(sender, raw):
+    redis_client.eval(ACK_INBOUND_MESSAGE_SCRIPT, [inbound_queue_key(sender), INBOUND_ATTEMPTS_KEY], [sender, raw])
+
+def inbound_message_failed(sender, raw, error):
+    """Dead-letter a message that keeps failing; otherwise back the sender off. Returns True if dead-lettered."""
+    attempts = redis_client.hincrby(INBOUND_ATTEMPTS_KEY, sender, 1)
+    if attempts >= INBOUND_MAX_ATTEMPTS:
+        logging.error(f"Dead-lettering message from {sender} after {attempts} attempts: {error}")
+        entry = {'sender': sender, 'message': raw, 'error': str(error)[:500], 'timestamp': datetime.now().isoformat()}
+        pipeline = redis_client.pipeline()
+        pipeline.lpush(INBOUND_DEAD_LETTER_KEY, json.dumps(entry))
+        pipeline.ltrim(INBOUND_DEAD_LETTER_KEY, 0, INBOUND_DEAD_LETTER_MAX - 1)
+        pipeline.exec()
+        ack_inbound_message(sender, raw)
+        count_metric('inbound_dead_lettered_total')
+        return True
+    logging.error(f"Failed to process deferred message from {sender} (attempt {attempts}), will retry: {error}")
+    redis_client.zadd(INBOUND_PENDING_KEY, {sender: time.time() + send_backoff_delay(attempts)}, xx=True)
+    return False
+
+def drain_inbound_queue(max_senders=None, budget=None):
+    """Work through deferred messages, oldest backlog first. Returns messages processed."""
+    deadline = time.time() + budget if budget else None
+    processed = 0
+    senders = 0
+    while max_senders is None or senders < max_senders:
+        if deadline and time.time() > deadline:
+            break
+        sender = redis_client.eval(CLAIM_INBOUND_SENDER_SCRIPT, [INBOUND_PENDING_KEY], [time.time(), INBOUND_LEASE_SECONDS])
+        if not sender:
+            break
+        senders += 1
+        while True:
+            if deadline and time.time() > deadline:
+                # Out of time; let the next drainer claim this sender straight away
+                redis_client.zadd(INBOUND_PENDING_KEY, {sender: time.time()}, xx=True)
+                break
+            raw = redis_client.eval(NEXT_INBOUND_MESSAGE_SCRIPT, [inbound_queue_key(sender), INBOUND_PENDING_KEY], [sender])
+            if not raw:
+                break
+            try:
+                with admitted_turn():
+                    process_inbound_message(sender, json.loads(raw), phone_id)
+            except Exception as e:
+                if inbound_message_failed(sender, raw, e):
+                    continue
+                # Later messages wait behind this one
+                break
+            ack_inbound_message(sender, raw)
+            processed += 1
+            count_metric('inbound_drained_total')
+            # Keep the lease while working through a long backlog
+            redis_client.zadd(INBOUND_PENDING_KEY, {sender: time.time() + INBOUND_LEASE_SECONDS}, xx=True)
+    return processed
+
+def inbound_drainer_loop():
+    while True:
+        time.sleep(INBOUND_DRAIN_INTERVAL)
+        try:
+            drain_inbound_queue()
+        except Exception as e:
+            logging.error(f"Inbound drain failed: {e}")
+
+def ensure_inbound_drainer():
+    """Start the in-process drainer once; cron covers deployments without long-lived processes"""
+    global _inbound_drainer_started
+    if _inbound_drainer_started:
+        return
+    with _inbound_drainer_lock:
+        if not _inbound_drainer_started:
+            threading.Thread(target=inbound_drainer_loop, daemon=True).start()
+            _inbound_drainer_started = True
+
+register_gauge('inflight_turns', lambda: _inflight_turns)
+register_gauge('inbound_backlog_senders', inbound_backlog_senders)
+
+def process_inbound_message(sender, message, phone_id):
+    """Run one inbound message through the bot: log it, relay it or handle it against the sender's state"""
+    incoming_text = None
+    relayed_media = None
+    # Interactive replies
+    if message.get('type') == 'interactive':
+        interactive = message.get('interactive', {})
+        if interactive.get('type') == 'list_reply':
+            selected = interactive.get('list_reply', {})
+            incoming_text = selected.get('title') or selected.get('id')
+        elif interactive.get('type') == 'button_reply':
+            selected = interactive.get('button_reply', {})
+            incoming_text = selected.get('id') or selected.get('title')
+        else: 
+            incoming_text = ''
+    elif message.get('type') == 'text':
+        incoming_text = message.get('text', {}).get('body', '')
+
+    elif message.get('type') == 'image':
+        # Handle image messages for design requests
+        image = message.get('image', {})
+        image_id = image.get('id')
+        if image_id:
+            incoming_text = f"IMAGE:{image_id}"
+    elif message.get('type') in RELAY_MEDIA_TYPES:
+        # Only a relay session passes documents, audio, video and stickers on;
+        # the step handlers see an empty message, so a MEDIA: prompt can never
+        # be stored as an answer
+        incoming_text = ''
+        relayed_media = media_prompt(message)
+    else:
+        incoming_text = ''
+
+    # Log the message, and the whole payload if raw archiving is on
+    log_conversation(sender, 'in', message.get('type', 'unknown'), message)
+    archive_raw_payload(sender, message)
+
+    # Agents only ever relay; skip the state round trip for them
+    if incoming_text is not None and is_agent(sender):
+        relay_agent_message(sender, relayed_media or incoming_text, phone_id)
+        return
+
+    if incoming_text is not None:
+        user_data_obj = get_user_state(sender)
+        if relayed_media and user_data_obj.get('step') == 'agent_chat':
+            incoming_text = relayed_media
+        print(f"Processing message from {sender}: {incoming_text}")
+        print(f"User state: {user_data_obj}")
+        new_state = handle_message(incoming_text, user_data_obj, phone_id)
+        print(f"New state: {new_state}")
+        if new_state != user_data_obj:
+            update_user_state(sender, new_state)
+
+
 @app.route('/webhook', methods=['GET', 'POST'])
 def webhook():
     if request.method == 'GET':
@@ -2594,47 +6154,14 @@ def webhook():
                         if change.get('field') == 'messages':
                             value = change.get('value')
                             if value:
+                                # Delivery statuses outnumber messages; handle them without loading state
+                                if value.get('statuses'):
+                                    ingest_status_events(value['statuses'])
+                                if not value.get('messages'):
+                                    continue
                                 message = value.get('messages', [{}])[0]
-                                sender = message.get('from')
-                                sender = normalize_phone_number(sender)
-                                incoming_text = None
-                                # Interactive replies
-                                if message.get('type') == 'interactive':
-                                    interactive = message.get('interactive', {})
-                                    if interactive.get('type') == 'list_reply':
-                                        selected = interactive.get('list_reply', {})
-                                        incoming_text = selected.get('title') or selected.get('id')
-                                    elif interactive.get('type') == 'button_reply':
-                                        selected = interactive.get('button_reply', {})
-                                        incoming_text = selected.get('id') or selected.get('title')
-                                    else: 
-                                        incoming_text = ''
-                                elif message.get('type') == 'text':
-                                    incoming_text = message.get('text', {}).get('body', '')
-
-                                elif message.get('type') == 'image':
-                                    # Handle image messages for design requests
-                                    image = message.get('image', {})
-                                    image_id = image.get('id')
-                                    if image_id:
-                                        incoming_text = f"IMAGE:{image_id}"
-                                else:
-                                    incoming_text = ''
-
-                                # Log raw inbound
-                                try:
-                                    log_conversation(sender, 'in', message.get('type', 'unknown'), message)
-                                except Exception:
-                                    pass
-
-                                if incoming_text is not None:
-                                    print(f"Processing message from {sender}: {incoming_text}")
-                                    user_data_obj = get_user_state(sender)
-                                    print(f"User state: {user_data_obj}")
-                                    new_state = handle_message(incoming_text, user_data_obj, phone_id)
-                                    print(f"New state: {new_state}")
-                                    if new_state != user_data_obj:
-                                        update_user_state(sender, new_state)
+                                sender = normalize_phone_number(message.get('from'))
+                                admit_inbound_message(sender, message, phone_id)
             
             return jsonify({'status': 'success'}), 200
             
@@ -2657,11 +6184,6 @@ def send_whatsapp():
         recipient = data.get("to")
         message = data.get("message")
 
-        url = f"https://graph.facebook.com/v19.0/{phone_id}/messages"
-        headers = {
-            "Authorization": f"Bearer {wa_token}",
-            "Content-Type": "application/json"
-        }
         payload = {
             "messaging_product": "whatsapp",
             "to": recipient,
@@ -2669,7 +6191,7 @@ def send_whatsapp():
             "text": {"body": message}
         }
 
-        r = requests.post(url, headers=headers, json=payload)
+        r = graph_post(payload, phone_id)
 
         # Print response for debugging
         print("WhatsApp API response:", r.status_code, r.text)
@@ -2685,6 +6207,606 @@ def send_whatsapp():
         return jsonify({"status": "error", "message": str(e)}), 500
 
 
+# Bulk broadcasts
+# A broadcast is a Redis hash (broadcast:{id}) plus a recipient list that is
+# consumed in batches by concurrent lanes. Each lane claims a batch through a
+# Lua script and moves the batch's position in the inflight hash past each
+# recipient before sending to them, so a crashed or stalled worker's batches
+# are picked up again after the last recipient it reached, and that recipient
+# is never sent to twice. A lane whose batch was taken over meanwhile finds
+# the position moved and stops.
+#
+# Lanes are daemon threads of the worker that started the broadcast. On
+# Vercel they only run while that function invocation does, so a broadcast
+# larger than one invocation can send stalls with its heartbeat going stale;
+# POST /sendWhatsApp/bulk/<id>/resume then starts new lanes where it stopped.
+BROADCAST_CONCURRENCY = int(os.environ.get("BROADCAST_CONCURRENCY", "4"))
+BROADCAST_BATCH_SIZE = int(os.environ.get("BROADCAST_BATCH_SIZE", "50"))
+BROADCAST_LEASE_SECONDS = int(os.environ.get("BROADCAST_LEASE_SECONDS", "120"))
+BROADCAST_LOAD_CHUNK = 500
+BROADCAST_TTL = 604800  # 7 days
+BROADCAST_SEGMENTS = {
+    # segment name -> key pattern whose suffix is the recipient phone
+    'recent_customers': 'user_state:*',
+}
+
+# KEYS: broadcast, inflight. ARGV: now, lease, batch size, ttl
+# Returns {start, next} for a stale inflight batch or a freshly claimed one, nil when exhausted
+CLAIM_BROADCAST_BATCH_SCRIPT = """
+local now = tonumber(ARGV[1])
+local inflight = redis.call('HGETALL', KEYS[2])
+for i = 1, #inflight, 2 do
+    local sep = string.find(inflight[i + 1], ':')
+    local nxt = string.sub(inflight[i + 1], 1, sep - 1)
+    local ts = tonumber(string.sub(inflight[i + 1], sep + 1))
+    if now - ts > tonumber(ARGV[2]) then
+        redis.call('HSET', KEYS[2], inflight[i], nxt .. ':' .. now)
+        return {inflight[i], nxt}
+    end
+end
+local total = tonumber(redis.call('HGET', KEYS[1], 'total') or '0')
+local size = tonumber(ARGV[3])
+local start = redis.call('HINCRBY', KEYS[1], 'cursor', size) - size
+if start >= total then
+    return nil
+end
+redis.call('HSET', KEYS[2], start, start .. ':' .. now)
+redis.call('EXPIRE', KEYS[2], ARGV[4])
+return {tostring(start), tostring(start)}
+"""
+
+# KEYS: inflight. ARGV: batch start, index about to be sent, now
+# Moves the batch past the index unless another lane has taken it over; returns 1 if moved
+ADVANCE_BROADCAST_BATCH_SCRIPT = """
+local position = redis.call('HGET', KEYS[1], ARGV[1])
+if not position or string.sub(position, 1, string.find(position, ':') - 1) ~= ARGV[2] then
+    return 0
+end
+redis.call('HSET', KEYS[1], ARGV[1], (tonumber(ARGV[2]) + 1) .. ':' .. ARGV[3])
+return 1
+"""
+
+def broadcast_key(job_id, suffix=None):
+    return f"broadcast:{job_id}:{suffix}" if suffix else f"broadcast:{job_id}"
+
+def build_broadcast_payload(content, recipient):
+    """Turn the stored broadcast content (text or template) into a Graph payload"""
+    payload = {
+        "messaging_product": "whatsapp",
+        "recipient_type": "individual",
+        "to": recipient,
+    }
+    if content.get('template'):
+        payload["type"] = "template"
+        payload["template"] = content['template']
+    else:
+        payload["type"] = "text"
+        payload["text"] = {"body": content.get('message', '')}
+    return payload
+
+def create_broadcast(content):
+    job_id = new_id('broadcast')
+    redis_client.hset(broadcast_key(job_id), values={
+        'status': 'loading',
+        'content': json.dumps(content),
+        'total': 0,
+        'cursor': 0,
+        'sent': 0,
+        'failed': 0,
+        'created_at': datetime.now().isoformat(),
+    })
+    redis_client.expire(broadcast_key(job_id), BROADCAST_TTL)
+    return job_id
+
+def append_broadcast_recipients(job_id, recipients):
+    """Push recipients from any iterable onto the job list in fixed-size chunks"""
+    list_key = broadcast_key(job_id, 'recipients')
+    count = 0
+    chunk = []
+    for recipient in recipients:
+        recipient = normalize_phone_number((recipient or '').strip())
+        if not recipient:
+            continue
+        chunk.append(recipient)
+        if len(chunk) >= BROADCAST_LOAD_CHUNK:
+            redis_client.rpush(list_key, *chunk)
+            count += len(chunk)
+            chunk = []
+    if chunk:
+        redis_client.rpush(list_key, *chunk)
+        count += len(chunk)
+    redis_client.expire(list_key, BROADCAST_TTL)
+    redis_client.hincrby(broadcast_key(job_id), 'total', count)
+    return count
+
+def iter_request_recipients(stream):
+    """Yield recipients line by line from a plain-text or CSV request body (first column)"""
+    for raw_line in stream:
+        line = raw_line.decode('utf-8', errors='ignore').strip()
+        if line:
+            yield line.split(',')[0].strip().strip('"')
+
+def iter_segment_recipients(segment):
+    pattern = BROADCAST_SEGMENTS[segment]
+    prefix = pattern.rstrip('*')
+    cursor = 0
+    while True:
+        cursor, keys = redis_client.scan(cursor, match=pattern, count=500)
+        for key in keys:
+            yield key[len(prefix):]
+        if int(cursor) == 0:
+            break
+
+def load_broadcast_segment(job_id, segment):
+    try:
+        append_broadcast_recipients(job_id, iter_segment_recipients(segment))
+        start_broadcast(job_id)
+    except Exception as e:
+        logging.error(f"Failed to load segment {segment} for broadcast {job_id}: {e}")
+        redis_client.hset(broadcast_key(job_id), 'status', 'failed')
+
+def start_broadcast(job_id):
+    redis_client.hset(broadcast_key(job_id), values={'status': 'running', 'heartbeat': int(time.time())})
+    content = json.loads(redis_client.hget(broadcast_key(job_id), 'content') or '{}')
+    for _ in range(BROADCAST_CONCURRENCY):
+        threading.Thread(target=broadcast_lane, args=(job_id, content), daemon=True).start()
+
+def claim_broadcast_batch(job_id):
+    claimed = redis_client.eval(
+        CLAIM_BROADCAST_BATCH_SCRIPT,
+        [broadcast_key(job_id), broadcast_key(job_id, 'inflight')],
+        [int(time.time()), BROADCAST_LEASE_SECONDS, BROADCAST_BATCH_SIZE, BROADCAST_TTL]
+    )
+    if not claimed:
+        return None
+    return int(claimed[0]), int(claimed[1])
+
+def advance_broadcast_batch(job_id, batch_start, index):
+    """Claim the recipient at index for this lane. False if another lane has taken the batch over."""
+    return bool(redis_client.eval(
+        ADVANCE_BROADCAST_BATCH_SCRIPT,
+        [broadcast_key(job_id, 'inflight')],
+        [batch_start, index, int(time.time())]
+    ))
+
+def send_broadcast_message(job_id, content, recipient, index):
+    result = {'index': index, 'to': recipient, 'timestamp': datetime.now().isoformat()}
+    try:
+        response = graph_post(build_broadcast_payload(content, recipient), phone_id)
+        if response.status_code < 400:
+            result['status'] = 'sent'
+            result['wamid'] = (response.json().get('messages') or [{}])[0].get('id')
+        else:
+            result['status'] = 'failed'
+            result['error'] = response.text[:300]
+    except requests.exceptions.RequestException as e:
+        result['status'] = 'failed'
+        result['error'] = str(e)[:300]
+
+    # Result, counters and heartbeat in a single round trip
+    pipeline = redis_client.pipeline()
+    pipeline.rpush(broadcast_key(job_id, 'results'), json.dumps(result))
+    pipeline.hincrby(broadcast_key(job_id), 'sent' if result['status'] == 'sent' else 'failed', 1)
+    pipeline.hset(broadcast_key(job_id), 'heartbeat', int(time.time()))
+    pipeline.exec()
+
+def broadcast_lane(job_id, content):
+    try:
+        while True:
+            claimed = claim_broadcast_batch(job_id)
+            if claimed is None:
+                break
+            batch_start, next_index = claimed
+            batch_end = batch_start + BROADCAST_BATCH_SIZE - 1
+            recipients = redis_client.lrange(broadcast_key(job_id, 'recipients'), next_index, batch_end)
+            for offset, recipient in enumerate(recipients):
+                if not advance_broadcast_batch(job_id, batch_start, next_index + offset):
+                    break  # taken over by another lane, which will finish it
+                send_broadcast_message(job_id, content, recipient, next_index + offset)
+            else:
+                redis_client.hdel(broadcast_key(job_id, 'inflight'), str(batch_start))
+
+        # The last lane out marks the job done once nothing is left in flight
+        if not redis_client.hlen(broadcast_key(job_id, 'inflight')):
+            redis_client.hset(broadcast_key(job_id), values={'status': 'done', 'finished_at': datetime.now().isoformat()})
+            redis_client.expire(broadcast_key(job_id, 'results'), BROADCAST_TTL)
+            redis_client.expire(broadcast_key(job_id, 'inflight'), BROADCAST_TTL)
+    except Exception as e:
+        logging.error(f"Broadcast lane for {job_id} stopped: {e}")
+        logging.error(traceback.format_exc())
+
+def get_broadcast(job_id):
+    job = redis_client.hgetall(broadcast_key(job_id))
+    if not job:
+        return None
+    job.pop('content', None)
+    job['id'] = job_id
+    job['in_flight_batches'] = redis_client.hlen(broadcast_key(job_id, 'inflight'))
+    return job
+
+
+@app.route('/sendWhatsApp/bulk', methods=['POST'])
+@require_api_token
+def send_whatsapp_bulk():
+    """Create a broadcast from a JSON body, or from a streamed text/CSV body of recipients.
+
+    JSON: {"recipients": [...] | "segment": "recent_customers", "message": "..." | "template": {...}}
+    Streamed: message/template/language in the query string, one recipient per line in the body.
+    """
+    try:
+        streamed = not request.is_json
+        if streamed:
+            params = request.args
+            data = {'message': params.get('message')}
+            if params.get('template'):
+                data['template'] = {
+                    'name': params.get('template'),
+                    'language': {'code': params.get('language', 'en_US')}
+                }
+        else:
+            data = request.get_json() or {}
+
+        content = {'message': data.get('message'), 'template': data.get('template')}
+        if not content['message'] and not content['template']:
+            return jsonify({"status": "error", "message": "message or template is required"}), 400
+
+        segment = data.get('segment')
+        if not streamed and segment and segment not in BROADCAST_SEGMENTS:
+            return jsonify({"status": "error", "message": f"Unknown segment: {segment}"}), 400
+        if not streamed and not segment and not data.get('recipients'):
+            return jsonify({"status": "error", "message": "recipients or segment is required"}), 400
+
+        job_id = create_broadcast(content)
+        if streamed:
+            total = append_broadcast_recipients(job_id, iter_request_recipients(request.stream))
+            start_broadcast(job_id)
+        elif segment:
+            total = None
+            threading.Thread(target=load_broadcast_segment, args=(job_id, segment), daemon=True).start()
+        else:
+            total = append_broadcast_recipients(job_id, data['recipients'])
+            start_broadcast(job_id)
+
+        return jsonify({"status": "queued", "id": job_id, "total": total}), 202
+    except Exception as e:
+        print("Error creating broadcast:", e)
+        print(traceback.format_exc())
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+
+@app.route('/sendWhatsApp/bulk/<job_id>', methods=['GET'])
+@require_api_token
+def get_whatsapp_bulk(job_id):
+    job = get_broadcast(job_id)
+    if not job:
+        return jsonify({"status": "error", "message": "Broadcast not found"}), 404
+    return jsonify(job), 200
+
+
+@app.route('/sendWhatsApp/bulk/<job_id>/results', methods=['GET'])
+@require_api_token
+def get_whatsapp_bulk_results(job_id):
+    """Page through per-recipient results; poll again from next_offset for new ones"""
+    try:
+        offset = max(int(request.args.get('offset', 0)), 0)
+        limit = min(max(int(request.args.get('limit', 100)), 1), 1000)
+    except ValueError:
+        return jsonify({"status": "error", "message": "offset and limit must be integers"}), 400
+    entries = redis_client.lrange(broadcast_key(job_id, 'results'), offset, offset + limit - 1)
+    return jsonify({
+        "id": job_id,
+        "results": [json.loads(entry) for entry in entries],
+        "next_offset": offset + len(entries)
+    }), 200
+
+
+@app.route('/sendWhatsApp/bulk/<job_id>/resume', methods=['POST'])
+@require_api_token
+def resume_whatsapp_bulk(job_id):
+    """Restart lanes for a broadcast whose workers died (no heartbeat within the lease)"""
+    job = redis_client.hgetall(broadcast_key(job_id))
+    if not job:
+        return jsonify({"status": "error", "message": "Broadcast not found"}), 404
+    if job.get('status') == 'done':
+        return jsonify({"status": "done", "id": job_id}), 200
+    if job.get('status') == 'running' and time.time() - int(job.get('heartbeat') or 0) < BROADCAST_LEASE_SECONDS:
+        return jsonify({"status": "running", "id": job_id}), 409
+    start_broadcast(job_id)
+    return jsonify({"status": "resumed", "id": job_id}), 202
+
+
+@app.route('/tasks/reap', methods=['GET', 'POST'])
+@require_api_token
+def reap_idle():
+    try:
+        return jsonify({
+            'status': 'success',
+            'agent_sessions_closed': reap_idle_agent_sessions(),
+            'funnel_reminders_sent': reap_abandoned_funnels()
+        }), 200
+    except Exception as e:
+        logging.error(f"Error running idle reaper: {e}")
+        logging.error(traceback.format_exc())
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+
+@app.route('/tasks/persist', methods=['GET', 'POST'])
+@require_api_token
+def persist_task():
+    try:
+        return jsonify({'status': 'success', 'processed': flush_persist_queue()}), 200
+    except Exception as e:
+        logging.error(f"Error flushing persistence queue: {e}")
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+
+@app.route('/tasks/flush-sends', methods=['GET', 'POST'])
+@require_api_token
+def flush_sends_task():
+    try:
+        return jsonify({'status': 'success', 'sent': flush_send_queue(budget=50)}), 200
+    except Exception as e:
+        logging.error(f"Error flushing send queue: {e}")
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+
+@app.route('/tasks/drain-inbound', methods=['GET', 'POST'])
+@require_api_token
+def drain_inbound_task():
+    try:
+        return jsonify({'status': 'success', 'processed': drain_inbound_queue(budget=50)}), 200
+    except Exception as e:
+        logging.error(f"Error draining inbound queue: {e}")
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+
+@app.route('/metrics', methods=['GET'])
+@require_api_token
+def metrics():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/tasks/owner-digest', methods=['GET', 'POST'])
+@require_api_token
+def owner_digest():
+    try:
+        force = request.args.get('force') == '1'
+        return jsonify({'status': 'success', 'cards_sent': flush_owner_notifications(force=force)}), 200
+    except Exception as e:
+        logging.error(f"Error flushing owner notifications: {e}")
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+
+@app.route('/tasks/bake-summary', methods=['GET', 'POST'])
+@require_api_token
+def bake_summary():
+    try:
+        orders = send_bake_summary(force=request.args.get('force') == '1')
+        if orders is None:
+            return jsonify({'status': 'skipped', 'message': 'Summary already sent'}), 200
+        return jsonify({'status': 'success', 'orders': orders}), 200
+    except Exception as e:
+        logging.error(f"Error sending bake summary: {e}")
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+
+def parse_day_arg(text):
+    """A date query parameter: YYYY-MM-DD, or anything parse_due_date reads"""
+    try:
+        return date.fromisoformat(text)
+    except ValueError:
+        return parse_due_date(text)
+
+
+def date_range_args():
+    """The from/to query parameters as a (start, end) timestamp window; open ends are None"""
+    window = []
+    for name in ('from', 'to'):
+        day = parse_day_arg(request.args[name]) if request.args.get(name) else None
+        if request.args.get(name) and not day:
+            raise ValueError(f"Unrecognised '{name}' date; use YYYY-MM-DD")
+        window.append(day)
+    start = day_window(window[0])[0] if window[0] else None
+    end = day_window(window[1])[1] if window[1] else None
+    return start, end
+
+
+@app.route('/api/orders', methods=['GET'])
+@require_api_token
+def list_orders_api():
+    status = request.args.get('status', 'pending')
+    branch = (request.args.get('branch') or '').lower() or None
+    if status not in ORDER_STATUSES:
+        return jsonify({'error': f'Unknown status; expected one of {", ".join(ORDER_STATUSES)}'}), 400
+    if branch and branch not in BRANCHES:
+        return jsonify({'error': f'Unknown branch; expected one of {", ".join(BRANCHES)}'}), 400
+
+    try:
+        start, end = date_range_args()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    limit = min(max(request.args.get('limit', 20, type=int), 1), ORDER_PAGE_LIMIT)
+    try:
+        orders, next_cursor = list_orders(status, branch, start, end, request.args.get('cursor'), limit)
+    except ValueError:
+        return jsonify({'error': 'Invalid cursor'}), 400
+    return jsonify({'orders': orders, 'next_cursor': next_cursor}), 200
+
+
+@app.route('/api/orders/<order_number>', methods=['GET'])
+@require_api_token
+def get_order_api(order_number):
+    for candidate in order_number_candidates(order_number):
+        order = load_order(candidate)
+        if order:
+            break
+    if not order:
+        return jsonify({'error': 'Order not found'}), 404
+    return jsonify(order), 200
+
+
+@app.route('/api/orders/<order_number>/status', methods=['POST'])
+@require_api_token
+def update_order_status_api(order_number):
+    data = request.get_json(silent=True) or {}
+    if data.get('status') not in ORDER_STATUSES:
+        return jsonify({'error': f'Unknown status; expected one of {", ".join(ORDER_STATUSES)}'}), 400
+    try:
+        order = set_order_status(
+            find_order_number(order_number),
+            data.get('status'),
+            note=data.get('note'),
+            author=data.get('author'),
+            notify=bool(data.get('notify'))
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 409
+    if not order:
+        return jsonify({'error': 'Order not found'}), 404
+    return jsonify({'status': 'success', 'order': order}), 200
+
+
+@app.route('/api/orders/<order_number>/notes', methods=['POST'])
+@require_api_token
+def add_order_note_api(order_number):
+    data = request.get_json(silent=True) or {}
+    if not data.get('text'):
+        return jsonify({'error': 'Note text is required'}), 400
+    try:
+        order = add_order_note(find_order_number(order_number), data['text'], data.get('author'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 409
+    if not order:
+        return jsonify({'error': 'Order not found'}), 404
+    return jsonify({'status': 'success', 'order': order}), 200
+
+
+@app.route('/api/orders/<order_number>/cancel', methods=['POST'])
+@require_api_token
+def cancel_order_api(order_number):
+    try:
+        order = cancel_order(find_order_number(order_number))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 409
+    if not order:
+        return jsonify({'error': 'Order not found'}), 404
+    return jsonify({'status': 'success', 'order': order}), 200
+
+
+@app.route('/tasks/reindex-orders', methods=['POST'])
+@require_api_token
+def reindex_orders_task():
+    try:
+        return jsonify({'status': 'success', 'indexed': reindex_orders()}), 200
+    except Exception as e:
+        logging.error(f"Error reindexing orders: {e}")
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+
+@app.route('/api/orders/export', methods=['GET'])
+@require_api_token
+def export_orders():
+    export_format = request.args.get('format', 'csv').lower()
+    if export_format not in ('csv', 'ndjson'):
+        return jsonify({'error': "Unknown format; expected 'csv' or 'ndjson'"}), 400
+    branch = (request.args.get('branch') or '').lower() or None
+    if branch and branch not in BRANCHES:
+        return jsonify({'error': f'Unknown branch; expected one of {", ".join(BRANCHES)}'}), 400
+    status = request.args.get('status')
+    if status and status not in ORDER_STATUSES:
+        return jsonify({'error': f'Unknown status; expected one of {", ".join(ORDER_STATUSES)}'}), 400
+
+    try:
+        start, end = date_range_args()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    with_images = request.args.get('images') == '1'
+    base_url = request.host_url.rstrip('/')
+    rows = (
+        export_row(order, images, base_url)
+        for order, images in iter_export_orders(start, end, branch, status, with_images)
+    )
+    filename = f"orders-{datetime.now():%Y%m%d-%H%M%S}.{export_format}"
+    return Response(
+        stream_with_context(stream_order_export(rows, export_format)),
+        mimetype='text/csv' if export_format == 'csv' else 'application/x-ndjson',
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'}
+    )
+
+
+@app.route('/api/bake-sheet', methods=['GET'])
+@require_api_token
+def bake_sheet():
+    day_text = request.args.get('date')
+    if day_text:
+        day = parse_day_arg(day_text)
+        if not day:
+            return jsonify({'error': 'Unrecognised date; use YYYY-MM-DD'}), 400
+    else:
+        day = bakery_today() + timedelta(days=1)
+    days = min(max(request.args.get('days', 1, type=int), 1), 31)
+    branch = request.args.get('branch')
+    if branch and branch.lower() not in BRANCHES:
+        return jsonify({'error': f'Unknown branch; expected one of {", ".join(BRANCHES)}'}), 400
+
+    orders = get_bake_sheet(*day_window(day, days), branches=[branch.lower()] if branch else None)
+    return jsonify({'date': day.isoformat(), 'days': days, 'branch': branch, 'orders': orders}), 200
+
+
+@app.route('/api/delivery-stats', methods=['GET'])
+@require_api_token
+def delivery_stats():
+    return jsonify(get_delivery_stats()), 200
+
+
+@app.route('/api/analytics/funnel', methods=['GET'])
+@require_api_token
+def funnel_api():
+    end = parse_day_arg(request.args['to']) if request.args.get('to') else bakery_today()
+    start = parse_day_arg(request.args['from']) if request.args.get('from') else end and end - timedelta(days=29)
+    if not start or not end:
+        return jsonify({'error': "Unrecognised 'from' or 'to' date; use YYYY-MM-DD"}), 400
+    if start > end or (end - start).days >= FUNNEL_REPORT_MAX_DAYS:
+        return jsonify({'error': f'Date range must run forwards and cover at most {FUNNEL_REPORT_MAX_DAYS} days'}), 400
+    steps = [s for s in (request.args.get('steps') or '').split(',') if s.strip()]
+    return jsonify(funnel_report(start, end, [s.strip() for s in steps] or FUNNEL_STEPS)), 200
+
+
+@app.route('/api/conversations/<phone>', methods=['GET'])
+@require_api_token
+def conversation_api(phone):
+    phone = normalize_phone_number(phone)
+    before = request.args.get('before') or None
+    if before and not re.fullmatch(r'\d+-\d+', before):
+        return jsonify({'error': 'Invalid before cursor'}), 400
+    limit = min(max(request.args.get('limit', 20, type=int), 1), CONVERSATION_PAGE_LIMIT)
+    include_state = request.args.get('state') in ('1', 'true')
+    entries, next_before = read_conversation(phone, before, limit, include_state)
+    return jsonify({'phone': phone, 'entries': entries, 'next_before': next_before}), 200
+
+
+@app.route('/api/catalog', methods=['GET', 'PUT'])
+@require_api_token
+def catalog_api():
+    if request.method == 'GET':
+        catalog = get_catalog()
+        return jsonify({'version': catalog.version, 'document': catalog.document}), 200
+
+    if CATALOG_FILE:
+        return jsonify({'error': 'Catalog is loaded from CATALOG_FILE; edit the file instead'}), 409
+    document = request.get_json(silent=True)
+    if not isinstance(document, dict):
+        return jsonify({'error': 'Expected a JSON catalog document'}), 400
+    try:
+        version = publish_catalog(document)
+    except Exception as e:
+        logging.error(f"Rejected catalog document: {e}")
+        return jsonify({'error': f'Invalid catalog: {e}'}), 400
+    return jsonify({'version': version}), 200
+
+
 @app.route('/api/image/<order_number>/<image_type>')
 def serve_stored_image(order_number, image_type):
     try:
@@ -2693,6 +6815,12 @@ def serve_stored_image(order_number, image_type):
         # Validate image type
         if image_type not in ['design', 'payment']:
             return "Invalid image type", 400
+
+        # Links handed out by the export carry an expiring signature; staff
+        # tools can use the API token instead
+        signed = image_link_valid(order_number, image_type, request.args.get('expires'), request.args.get('sig'))
+        if not signed and not has_api_token():
+            return "Link invalid or expired", 403
         
         image_key = f"{image_type}_data:{order_number}"
         stored_data = redis_client.get(image_key)
@@ -2739,14 +6867,14 @@ def proxy_image():
         url = f"https://graph.facebook.com/v19.0/{image_id}"
         headers = {'Authorization': f'Bearer {wa_token}'}
         
-        response = requests.get(url, headers=headers)
+        response = requests.get(url, headers=headers, timeout=SEND_TIMEOUT)
         if response.status_code == 200:
             image_data = response.json()
             image_url = image_data.get('url')
             
             if image_url:
                 # Download and serve the image
-                img_response = requests.get(image_url, headers=headers, stream=True)
+                img_response = requests.get(image_url, headers=headers, stream=True, timeout=SEND_TIMEOUT)
                 if img_response.status_code == 200:
                     return send_file(
                         img_response.raw,
@@ -2762,4 +6890,5 @@ def proxy_image():
         
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    # Development only; run serve.py in production
+    app.run(host='0.0.0.0', port=5000, debug=os.environ.get('FLASK_DEBUG', '1') == '1')
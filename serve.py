@@ -0,0 +1,26 @@
+"""Production server for the bot outside Vercel.
+
+    python serve.py [--app MODULE:APP] [gunicorn options]
+
+Runs the app under gunicorn with gunicorn.conf.py (worker and thread counts,
+preloading, timeouts and the graceful-shutdown drain). Any other gunicorn
+option given here overrides the file, e.g. `python serve.py --workers 4`.
+"""
+import os
+import sys
+import argparse
+
+CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gunicorn.conf.py')
+
+
+def serve(argv=None):
+    from gunicorn.app.wsgiapp import run
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--app', default='main:app')
+    args, gunicorn_args = parser.parse_known_args(argv)
+    sys.argv = [sys.argv[0], '--config', CONFIG, *gunicorn_args, args.app]
+    run()
+
+
+if __name__ == '__main__':
+    serve()
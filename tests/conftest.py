@@ -0,0 +1,10 @@
+import importlib
+import os
+from unittest import mock
+
+os.environ.setdefault('API_TOKEN', 'test-token')
+
+# main checks its Upstash connection on import. The tests cover logic that
+# never reaches Redis, so the client is a stand-in for the import.
+with mock.patch('upstash_redis.Redis'):
+    importlib.import_module('main')
@@ -0,0 +1,50 @@
+from datetime import date
+
+import pytest
+
+import main
+
+TODAY = date(2026, 3, 10)  # a Tuesday
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('12/09/2026', date(2026, 9, 12)),
+    ('12-9-26', date(2026, 9, 12)),
+    ('12.09', date(2026, 9, 12)),
+    ('12 Sept', date(2026, 9, 12)),
+    ('12th of September 2026', date(2026, 9, 12)),
+    ('Sept 12th', date(2026, 9, 12)),
+    ('fri 13/03', date(2026, 3, 13)),
+    ('today', TODAY),
+    ('tomorrow', date(2026, 3, 11)),
+    ('in 3 days', date(2026, 3, 13)),
+    ('friday', date(2026, 3, 13)),
+    ('next tuesday', date(2026, 3, 17)),
+])
+def test_parse_due_date(text, expected):
+    assert main.parse_due_date(text, TODAY) == expected
+
+
+def test_a_passed_day_without_a_year_is_next_year():
+    assert main.parse_due_date('01/02', TODAY) == date(2027, 2, 1)
+
+
+@pytest.mark.parametrize('text', ['', 'soon', '31/02/2026', '12 smarch', '32/01'])
+def test_unreadable_dates(text):
+    assert main.parse_due_date(text, TODAY) is None
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('2pm', (14, 0)),
+    ('2:30 pm', (14, 30)),
+    ('12am', (0, 0)),
+    ('14:00', (14, 0)),
+    ('1400hrs', (14, 0)),
+    ('10 a.m.', (10, 0)),
+    ('noon', (12, 0)),
+    ('13pm', None),
+    ('25:00', None),
+    ('whenever', None),
+])
+def test_parse_due_time(text, expected):
+    assert main.parse_due_time(text) == expected
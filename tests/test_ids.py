@@ -0,0 +1,69 @@
+from unittest import mock
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def sequences():
+    """A stand-in for the id_seq:* counters; yields the INCRBY calls made"""
+    totals = {}
+
+    def incrby(key, amount):
+        totals[key] = totals.get(key, 0) + amount
+        return totals[key]
+
+    with mock.patch.object(main, 'redis_client') as client, mock.patch.dict(main._id_blocks, clear=True):
+        client.incrby.side_effect = incrby
+        yield client.incrby
+
+
+@pytest.mark.parametrize('number', [0, 1, 31, 32, 1023, 32 ** 5 - 1])
+def test_crockford_round_trip(number):
+    encoded = main.crockford_encode(number, main.ID_TIME_WIDTH)
+    assert len(encoded) == main.ID_TIME_WIDTH
+    assert main.crockford_decode(encoded) == number
+
+
+def test_crockford_reads_look_alike_letters():
+    assert main.crockford_decode('0IL') == main.crockford_decode('011')
+    assert main.normalize_id(' 0aoil ') == '0A011'
+
+
+def test_ids_sort_by_issue_time():
+    earlier = main.id_prefix(main.ID_EPOCH + 3600)
+    later = main.id_prefix(main.ID_EPOCH + 86400 * 400)
+    assert earlier < later
+    assert main.id_prefix(main.ID_EPOCH - 60) == '0' * main.ID_TIME_WIDTH
+
+
+def test_id_timestamp_is_the_issue_minute(sequences):
+    with mock.patch.object(main.time, 'time', return_value=main.ID_EPOCH + 90061):
+        record_id = main.new_id('order')
+    assert len(record_id) == main.ID_TIME_WIDTH + main.ID_SEQUENCE_WIDTH
+    assert main.id_timestamp(record_id) == main.ID_EPOCH + 90060
+
+
+def test_sequences_are_leased_in_blocks(sequences):
+    numbers = [main.next_sequence('order') for _ in range(main.ID_BLOCK_SIZE + 1)]
+    assert numbers == list(range(1, main.ID_BLOCK_SIZE + 2))
+    assert sequences.call_count == 2
+    assert main.next_sequence('callback') == 1
+
+
+def test_ids_are_unique_within_a_minute(sequences):
+    with mock.patch.object(main.time, 'time', return_value=main.ID_EPOCH + 600):
+        ids = [main.new_id('order') for _ in range(3 * main.ID_BLOCK_SIZE)]
+    assert len(set(ids)) == len(ids)
+    assert ids == sorted(ids)
+
+
+def test_sequence_widens_past_its_width(sequences):
+    main._id_blocks['order'] = [32 ** main.ID_SEQUENCE_WIDTH, 32 ** main.ID_SEQUENCE_WIDTH]
+    assert len(main.crockford_encode(main.next_sequence('order'), main.ID_SEQUENCE_WIDTH)) == main.ID_SEQUENCE_WIDTH + 1
+
+
+def test_order_number_candidates_try_the_number_as_typed_first():
+    assert main.order_number_candidates(' ab1o ') == ['AB1O', 'AB10']
+    assert main.order_number_candidates('ab10') == ['AB10']
@@ -0,0 +1,43 @@
+import time
+from unittest import mock
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def secret():
+    with mock.patch.object(main, 'IMAGE_LINK_SECRET', 'link-secret'):
+        yield
+
+
+def link_args(url):
+    query = parse_qs(urlsplit(url).query)
+    return query['expires'][0], query['sig'][0]
+
+
+def test_links_are_unsigned_without_a_secret():
+    with mock.patch.object(main, 'IMAGE_LINK_SECRET', None):
+        assert main.signed_image_link('https://bot', 'A1', 'design') == 'https://bot/api/image/A1/design'
+        assert main.image_link_valid('A1', 'design', None, None)
+
+
+def test_signed_link_is_valid(secret):
+    expires, signature = link_args(main.signed_image_link('https://bot', 'A1', 'design'))
+    assert main.image_link_valid('A1', 'design', expires, signature)
+
+
+def test_signature_covers_the_order_and_image_type(secret):
+    expires, signature = link_args(main.signed_image_link('https://bot', 'A1', 'design'))
+    assert not main.image_link_valid('A2', 'design', expires, signature)
+    assert not main.image_link_valid('A1', 'payment', expires, signature)
+    assert not main.image_link_valid('A1', 'design', str(int(expires) + 60), signature)
+
+
+def test_expired_or_malformed_links_are_refused(secret):
+    expires = int(time.time()) - 1
+    assert not main.image_link_valid('A1', 'design', expires, main.image_link_signature('A1', 'design', expires))
+    assert not main.image_link_valid('A1', 'design', 'never', 'x')
+    assert not main.image_link_valid('A1', 'design', None, None)
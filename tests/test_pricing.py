@@ -0,0 +1,74 @@
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+FRESH_CREAM = main.CakeTypeOptions.FRESH_CREAM.value
+PLASTIC_ICING = main.CakeTypeOptions.PLASTIC_ICING.value
+
+
+@pytest.fixture(scope='module')
+def prices():
+    return main.PriceCatalog(main.CATALOG_SPEC)
+
+
+def draft(flavor='vanilla', colors=''):
+    return SimpleNamespace(flavor=flavor, colors=colors)
+
+
+def test_pricing_messages_list_each_menus_own_prices(prices):
+    plastic = prices.pricing_messages[PLASTIC_ICING]
+    assert '• Small 6 inches - $40' in plastic
+    assert '• Extra Large 12 inches - $100' in plastic
+    assert '$30' not in plastic
+    fresh_cream = prices.pricing_messages[FRESH_CREAM]
+    assert '• Small 6 inches - $30' in fresh_cream
+    assert '*2-Tier Cakes:*' in fresh_cream
+    assert 'Fondant' not in fresh_cream
+
+
+def test_menu_options_leave_out_listed_only_items(prices):
+    options = [option.value for option in prices.enums['fresh_cream']]
+    assert 'Cake Fairy Cake - $20' in options
+    assert 'Small 6 inches - $30' not in options
+    assert options[-1] == 'Back to cake types'
+
+
+def test_quote_looks_up_the_drafts_own_menu(prices):
+    assert prices.quote('Small 6 inches - $40', draft(), PLASTIC_ICING)['total'] == 40
+    assert prices.quote('Small 6 inches - $30', draft(), FRESH_CREAM)['total'] == 30
+    # A label from before a price change falls back to the name within the menu
+    assert prices.quote('Small 6 inches - $45', draft(), PLASTIC_ICING)['total'] == 40
+
+
+def test_quote_resolves_old_labels(prices):
+    assert prices.quote('Medium 8 inches- $50', draft(), PLASTIC_ICING)['total'] == 50
+
+
+def test_extra_flavours_and_colour_surcharge(prices):
+    quote = prices.quote('Cake Fairy Cake - $20', draft('vanilla and chocolate', 'Black and white'), FRESH_CREAM)
+    assert quote['total'] == 30
+    assert quote['lines'] == ['Cake Fairy Cake: $20', 'Extra flavor: $5', 'Color surcharge: $5']
+    assert prices.quote('Double Delite (2 flavours) - $25', draft('vanilla & lemon'), FRESH_CREAM)['total'] == 25
+
+
+def test_fruit_cakes_have_no_colour_surcharge(prices):
+    assert prices.quote('6 inch - $60', draft(colors='gold'), main.CakeTypeOptions.FRUIT.value)['total'] == 60
+
+
+def test_agent_priced_items_have_no_quote(prices):
+    assert prices.quote('Themed Cakes', draft(), FRESH_CREAM) is None
+    assert prices.price_line('Themed Cakes', draft(), FRESH_CREAM) == "*Price:* To be confirmed by our team"
+    assert prices.quote('Something else', draft()) is None
+
+
+@pytest.mark.parametrize('text, count', [
+    ('vanilla', 1),
+    ('Vanilla and chocolate', 2),
+    ('vanilla, lemon & orange', 3),
+    ('vanilla/vanilla', 1),
+    ('', 0),
+])
+def test_count_flavors(text, count):
+    assert main.count_flavors(text) == count
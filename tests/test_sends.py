@@ -0,0 +1,71 @@
+import time
+from unittest import mock
+
+import pytest
+import requests
+from urllib3.exceptions import NewConnectionError
+
+import main
+
+
+class Response:
+    def __init__(self, status_code, body=None, headers=None):
+        self.status_code = status_code
+        self._body = body or {}
+        self.headers = headers or {}
+
+    def json(self):
+        return self._body
+
+
+@pytest.fixture(autouse=True)
+def graph_breaker():
+    with mock.patch.object(main, 'graph_breaker') as breaker:
+        yield breaker
+
+
+def outcome(response=None, error=None):
+    return main.send_attempt_outcome('263771000000', 0, response, error, 0.1)
+
+
+def test_accepted():
+    assert outcome(Response(200)) == 'accepted'
+
+
+def test_rejected_by_meta():
+    assert outcome(Response(400, {'error': {'code': 131026}})) == 'rejected'
+
+
+def test_throttled_is_retried():
+    assert outcome(Response(429)) == 'retry'
+    assert outcome(Response(400, {'error': {'code': 131056}})) == 'retry'
+
+
+def test_server_error_may_have_been_delivered():
+    assert outcome(Response(502)) == 'ambiguous'
+
+
+def test_only_failures_before_meta_are_retried():
+    assert outcome(error=requests.exceptions.ConnectTimeout()) == 'retry'
+    refused = requests.exceptions.ConnectionError(NewConnectionError(None, 'refused'))
+    assert outcome(error=refused) == 'retry'
+    assert outcome(error=requests.exceptions.ReadTimeout()) == 'ambiguous'
+
+
+def test_outages_count_against_the_breaker(graph_breaker):
+    outcome(Response(503))
+    graph_breaker.record.assert_called_with(False, 0.1)
+    outcome(Response(429))
+    graph_breaker.record.assert_called_with(True, 0.1)
+
+
+def test_retry_delay_respects_the_turn_deadline():
+    with mock.patch.object(main, 'send_backoff_delay', return_value=2.0):
+        assert main.send_retry_delay(0, None, None) == 2.0
+        assert main.send_retry_delay(0, None, time.time() + 10) == 2.0
+        assert main.send_retry_delay(0, None, time.time() + 1) is None
+
+
+def test_wait_limit_shrinks_with_the_deadline():
+    assert main.send_wait_limit(None) == main.SEND_MAX_WAIT
+    assert main.send_wait_limit(time.time() - 1) == 0.0
@@ -0,0 +1,478 @@
+"""Export production conversations as traces and replay them against the bot.
+
+    python traces.py export --hours 24 > traces.ndjson
+    python traces.py record traces.ndjson -o golden.ndjson
+    python traces.py replay golden.ndjson
+
+`export` reads the raw webhook archive (raw_log:* buckets, written when
+RAW_LOG_SAMPLE > 0) from the configured Upstash Redis, groups inbound
+messages by phone and anonymizes them: phones become stable pseudonyms and
+any other long digit runs are masked. Free text is kept as typed, so review
+an export before sharing it.
+
+`record` replays each trace and stores the step reached and the Graph
+payloads sent after every turn. `replay` runs them again and reports the
+first turn where either differs, with per-turn latency and Redis and HTTP
+call counts, so a change to handle_message can be measured on real traffic
+without breaking a funnel.
+
+Replays run against an in-memory Redis (fakeredis, with lupa for Lua:
+pip install 'fakeredis[lua]') and a mock Graph API. The clock is frozen at
+each message's original time and only moves when the app sleeps, background
+threads run inline and randomness is seeded, so two runs of the same code
+produce the same payloads.
+"""
+import os
+import re
+import sys
+import json
+import time
+import copy
+import types
+import random
+import importlib.util
+import argparse
+import contextlib
+import io
+import threading
+import warnings
+import statistics
+from datetime import datetime
+
+PHONE_PATTERN = re.compile(r'\+?\d{7,}')
+PSEUDONYM_PREFIX = '+26370'
+REPLAY_ENV = {
+    'WA_TOKEN': 'replay',
+    'PHONE_ID': 'replay',
+    'UPSTASH_REDIS_URL': 'https://replay.invalid',
+    'UPSTASH_REDIS_TOKEN': 'replay',
+    'DATABASE_URL': 'sqlite://',
+    'RAW_LOG_SAMPLE': '0',
+    'OWNER_PHONE': '+263700000000',
+    'TZ': 'UTC',
+}
+
+
+# Export
+
+def raw_archive_entries(hours):
+    """Raw webhook entries from the last `hours` hourly buckets, oldest bucket first"""
+    from upstash_redis import Redis
+    client = Redis(url=os.environ.get('UPSTASH_REDIS_URL'), token=os.environ.get('UPSTASH_REDIS_TOKEN'))
+    now = time.time()
+    pipeline = client.pipeline()
+    for hour in range(hours, -1, -1):
+        bucket = time.strftime('%Y%m%d%H', time.gmtime(now - hour * 3600))
+        pipeline.lrange(f"raw_log:{bucket}", 0, -1)
+    for bucket in pipeline.exec():
+        for raw in bucket or []:
+            try:
+                yield json.loads(raw)
+            except ValueError:
+                continue
+
+def mask_digits(value, pseudonyms):
+    """Replace phone numbers and other long digit runs inside a payload"""
+    if isinstance(value, dict):
+        return {k: mask_digits(v, pseudonyms) for k, v in value.items()}
+    if isinstance(value, list):
+        return [mask_digits(v, pseudonyms) for v in value]
+    if isinstance(value, str):
+        def replace(match):
+            digits = match.group(0)
+            known = pseudonyms.get(digits) or pseudonyms.get('+' + digits.lstrip('+'))
+            return known or '0' * len(digits)
+        return PHONE_PATTERN.sub(replace, value)
+    return value
+
+def export_traces(entries):
+    """Group raw entries into anonymized per-phone traces"""
+    by_phone = {}
+    for entry in entries:
+        if entry.get('phone') and entry.get('payload'):
+            by_phone.setdefault(entry['phone'], []).append(entry)
+
+    pseudonyms = {}
+    for i, phone in enumerate(sorted(by_phone), start=1):
+        pseudonyms[phone] = f"{PSEUDONYM_PREFIX}{i:07d}"
+
+    for phone, phone_entries in sorted(by_phone.items()):
+        phone_entries.sort(key=lambda e: e.get('t', 0))
+        start = phone_entries[0].get('t', 0)
+        turns = []
+        for n, entry in enumerate(phone_entries, start=1):
+            message = mask_digits(copy.deepcopy(entry['payload']), pseudonyms)
+            message.pop('context', None)
+            message['from'] = pseudonyms[phone]
+            message['id'] = f"trace.{n}"
+            message['timestamp'] = str(entry.get('t', start))
+            turns.append({'at': entry.get('t', start) - start, 'message': message})
+        yield {'phone': pseudonyms[phone], 'start': start, 'turns': turns}
+
+
+# In-memory Redis
+# A stand-in for upstash_redis.Redis over fakeredis. Upstash's Python client
+# mostly mirrors redis-py; the few commands whose signatures differ are
+# translated here. Every command is counted, and a pipeline counts as one
+# round trip, which is what each costs against the REST API.
+
+class CallCounter:
+    def __init__(self):
+        self.commands = 0
+        self.round_trips = 0
+
+def adapt_command(client, name):
+    if name == 'eval':
+        return lambda script, keys=None, args=None: client.eval(script, len(keys or []), *(keys or []), *(args or []))
+    if name == 'hset':
+        return lambda key, field=None, value=None, values=None: client.hset(key, field, value, mapping=values)
+    if name == 'zrange':
+        def zrange(key, start, stop, sortby=None, rev=False, offset=None, count=None, withscores=False):
+            return client.zrange(key, start, stop, desc=rev, withscores=withscores,
+                                 byscore=sortby == 'BYSCORE', bylex=sortby == 'BYLEX', offset=offset, num=count)
+        return zrange
+    if name == 'xadd':
+        def xadd(key, id, data, maxlen=None, approximate_trim=True, **kwargs):
+            return client.xadd(key, data, id=id, maxlen=maxlen, approximate=approximate_trim)
+        return xadd
+    if name == 'scan':
+        return lambda cursor, match=None, count=None, type=None: list(client.scan(cursor, match=match, count=count, _type=type))
+    return getattr(client, name)
+
+class MemoryPipeline:
+    def __init__(self, client, counter, latency=0.0):
+        self._pipeline = client.pipeline(transaction=False)
+        self._counter = counter
+        self._latency = latency
+
+    def __getattr__(self, name):
+        command = adapt_command(self._pipeline, name)
+
+        def queue(*args, **kwargs):
+            self._counter.commands += 1
+            command(*args, **kwargs)
+            return self
+        return queue
+
+    def exec(self):
+        self._counter.round_trips += 1
+        if self._latency:
+            time.sleep(self._latency)
+        return self._pipeline.execute(raise_on_error=False)
+
+class MemoryRedis:
+    counter = CallCounter()
+    server = None
+    # Seconds added to every round trip, to stand in for the network (see bench.py)
+    latency = 0.0
+
+    def __init__(self, url=None, token=None, **kwargs):
+        import fakeredis
+        if MemoryRedis.server is None:
+            MemoryRedis.server = fakeredis.FakeServer()
+        self._client = fakeredis.FakeRedis(server=MemoryRedis.server, decode_responses=True)
+
+    def pipeline(self):
+        return MemoryPipeline(self._client, self.counter, self.latency)
+
+    multi = pipeline
+
+    def __getattr__(self, name):
+        command = adapt_command(self._client, name)
+
+        def call(*args, **kwargs):
+            self.counter.commands += 1
+            self.counter.round_trips += 1
+            if self.latency:
+                time.sleep(self.latency)
+            return command(*args, **kwargs)
+        return call
+
+
+# Mock Graph API
+
+class MockResponse:
+    def __init__(self, status_code=200, body=None, content=b''):
+        self.status_code = status_code
+        self.headers = {'Content-Type': 'application/json' if body is not None else 'image/jpeg'}
+        self._body = body
+        self.content = content if body is None else json.dumps(body).encode()
+        self.text = self.content.decode('utf-8', 'replace')
+
+    def json(self):
+        return self._body
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            import requests
+            raise requests.exceptions.HTTPError(f"{self.status_code} from mock Graph API", response=self)
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+class MockGraph:
+    """Answers Graph API calls and records message sends"""
+    media_host = 'https://replay.invalid/media/'
+
+    def __init__(self, latency=0.0):
+        self.calls = 0
+        self.sent = []
+        self.latency = latency
+        self._ids = 0
+        self._lock = threading.Lock()
+
+    def next_id(self, prefix):
+        with self._lock:
+            self._ids += 1
+            return f"{prefix}.replay.{self._ids}"
+
+    def post(self, url, headers=None, json=None, data=None, timeout=None, **kwargs):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if url.endswith('/messages'):
+            self.sent.append(json)
+            return MockResponse(200, {'messages': [{'id': self.next_id('wamid')}]})
+        if url.endswith('/media'):
+            for _ in data or ():
+                pass
+            return MockResponse(200, {'id': self.next_id('media')})
+        return MockResponse(200, {})
+
+    def get(self, url, headers=None, timeout=None, stream=False, **kwargs):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if url.startswith(self.media_host):
+            return MockResponse(200, content=b'\xff\xd8\xff\xe0replay\xff\xd9')
+        media_id = url.rstrip('/').rsplit('/', 1)[-1]
+        return MockResponse(200, {'url': self.media_host + media_id, 'mime_type': 'image/jpeg'})
+
+
+# Replay
+
+class ReplayClock:
+    """Stands in for the time module inside the app: frozen, advanced by sleep()"""
+    def __init__(self):
+        self.now = time.time()
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += max(seconds, 0)
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+class InlineThread(threading.Thread):
+    """Runs its target on start() so background sends happen in a fixed order"""
+    def start(self):
+        self.run()
+
+def load_offline_app(redis_latency=0.0, graph_latency=0.0):
+    """Import the app against the in-memory Redis and a mock Graph API"""
+    for key, value in REPLAY_ENV.items():
+        os.environ.setdefault(key, value)
+    if hasattr(time, 'tzset'):
+        time.tzset()
+    if importlib.util.find_spec('fakeredis') is None:
+        sys.exit("Running offline needs fakeredis: pip install 'fakeredis[lua]'")
+    MemoryRedis.latency = redis_latency
+    import redis.exceptions
+    sys.modules['upstash_redis'] = types.SimpleNamespace(Redis=MemoryRedis)
+    # Command errors (Upstash's UpstashError) come from fakeredis as ResponseError
+    sys.modules['upstash_redis.errors'] = types.SimpleNamespace(UpstashError=redis.exceptions.ResponseError)
+    # redis-py deprecates SETEX, which the Upstash client still offers
+    warnings.filterwarnings('ignore', category=DeprecationWarning)
+
+    import requests
+    import main
+    graph = MockGraph(graph_latency)
+    requests.get = graph.get
+    requests.post = graph.post
+    return main, graph
+
+def load_app():
+    """Import the app offline, on the replay clock"""
+    main, graph = load_offline_app()
+    clock = ReplayClock()
+
+    class ReplayDatetime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return cls.fromtimestamp(clock.now, tz)
+
+    main.time = clock
+    main.datetime = ReplayDatetime
+    main.threading = types.SimpleNamespace(Thread=InlineThread, Lock=threading.Lock)
+    # Flushers are driven by the app's crons in production; never start them here
+    main._owner_flusher_started = True
+    main._persist_flusher_started = True
+    return main, graph, clock
+
+def reset_app(main, graph):
+    main.redis_client.flushall()
+    main._catalog = None
+    main._catalog_checked_at = 0.0
+    main._id_blocks.clear()
+    main._state_cache.clear()
+    main._upstream_latency.clear()
+    for breaker in main.circuit_breakers.values():
+        breaker.state, breaker.failures, breaker.probing = 'closed', 0, False
+    graph.sent.clear()
+    graph._ids = 0
+    random.seed(0)
+
+def webhook_body(message):
+    return {
+        'object': 'whatsapp_business_account',
+        'entry': [{'changes': [{'field': 'messages', 'value': {'messages': [message]}}]}],
+    }
+
+def run_trace(app, trace):
+    """Replay one trace; returns a result per turn"""
+    main, graph, clock = app
+    reset_app(main, graph)
+    client = main.app.test_client()
+    counter = MemoryRedis.counter
+    results = []
+    for turn in trace['turns']:
+        clock.now = trace.get('start', 0) + turn['at']
+        sent_before = len(graph.sent)
+        commands, round_trips, http_calls = counter.commands, counter.round_trips, graph.calls
+        started = time.perf_counter()
+        client.post('/webhook', json=webhook_body(turn['message']))
+        latency = time.perf_counter() - started
+        result = {
+            'latency_ms': round(latency * 1000, 2),
+            'redis_commands': counter.commands - commands,
+            'redis_round_trips': counter.round_trips - round_trips,
+            'http_calls': graph.calls - http_calls,
+            'outbound': copy.deepcopy(graph.sent[sent_before:]),
+        }
+        result['step'] = main.get_user_state(trace['phone']).get('step')
+        results.append(result)
+    return results
+
+def compare(trace, results):
+    """The first difference from a trace's recorded expectations, or None"""
+    expected = trace.get('expected')
+    if not expected:
+        return 'no recorded expectations; run record first'
+    for n, (want, got) in enumerate(zip(expected, results), start=1):
+        if want['step'] != got['step']:
+            return f"turn {n}: step {got['step']!r}, expected {want['step']!r}"
+        if want['outbound'] != got['outbound']:
+            return f"turn {n}: outbound payloads differ ({len(got['outbound'])} sent, {len(want['outbound'])} expected)"
+    if len(expected) != len(results):
+        return f"{len(results)} turns replayed, {len(expected)} recorded"
+    return None
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+def summarize(all_results):
+    turns = [r for results in all_results for r in results]
+    if not turns:
+        return {'turns': 0}
+    latencies = [r['latency_ms'] for r in turns]
+    return {
+        'turns': len(turns),
+        'latency_ms': {
+            'p50': percentile(latencies, 0.5),
+            'p95': percentile(latencies, 0.95),
+            'max': max(latencies),
+        },
+        'redis_commands_per_turn': round(statistics.mean(r['redis_commands'] for r in turns), 2),
+        'redis_round_trips_per_turn': round(statistics.mean(r['redis_round_trips'] for r in turns), 2),
+        'http_calls_per_turn': round(statistics.mean(r['http_calls'] for r in turns), 2),
+    }
+
+def read_traces(path):
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+    export = commands.add_parser('export', help='Export anonymized traces from the raw archive')
+    export.add_argument('--hours', type=int, default=24)
+    export.add_argument('-o', '--output')
+    record = commands.add_parser('record', help='Replay traces and store their results as expectations')
+    record.add_argument('traces')
+    record.add_argument('-o', '--output', required=True)
+    replay = commands.add_parser('replay', help='Replay traces and compare with their expectations')
+    replay.add_argument('traces')
+    replay.add_argument('--json', action='store_true', help='Print the report as JSON')
+    args = parser.parse_args(argv)
+
+    if args.command == 'export':
+        out = open(args.output, 'w') if args.output else sys.stdout
+        count = 0
+        for trace in export_traces(raw_archive_entries(args.hours)):
+            out.write(json.dumps(trace) + '\n')
+            count += 1
+        if args.output:
+            out.close()
+        print(f"Exported {count} traces", file=sys.stderr)
+        return 0
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        app = load_app()
+    traces = list(read_traces(args.traces))
+    all_results = []
+    failures = []
+    for trace in traces:
+        # The app narrates every turn on stdout; keep the report readable
+        with contextlib.redirect_stdout(io.StringIO()):
+            results = run_trace(app, trace)
+        all_results.append(results)
+        if args.command == 'record':
+            trace['expected'] = [{'step': r['step'], 'outbound': r['outbound']} for r in results]
+        else:
+            difference = compare(trace, results)
+            if difference:
+                failures.append({'phone': trace['phone'], 'difference': difference})
+
+    if args.command == 'record':
+        with open(args.output, 'w') as out:
+            for trace in traces:
+                out.write(json.dumps(trace) + '\n')
+        print(f"Recorded {len(traces)} traces to {args.output}", file=sys.stderr)
+
+    report = {'traces': len(traces), 'failures': failures, **summarize(all_results)}
+    if getattr(args, 'json', False):
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"{report['traces']} traces, {report['turns']} turns, {len(failures)} differing", file=sys.stderr)
+        if report['turns']:
+            latency = report['latency_ms']
+            print(f"latency p50 {latency['p50']}ms, p95 {latency['p95']}ms, max {latency['max']}ms; "
+                  f"per turn {report['redis_round_trips_per_turn']} Redis round trips "
+                  f"({report['redis_commands_per_turn']} commands), {report['http_calls_per_turn']} HTTP calls",
+                  file=sys.stderr)
+        for failure in failures:
+            print(f"  {failure['phone']}: {failure['difference']}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main_cli())